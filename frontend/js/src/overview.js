@@ -32,7 +32,7 @@
                     $this.find(".spinner").remove();
                     $this.append(data.videos.map(function(vid) {
                         var url = bucketUrl + "?start=" + vid.ordering_key;
-                        return "<a href=\"" + url + "\">" + vid.html_snippet + "</a>";
+                        return $("<a>", {href: url}).append($.videoSnippet(vid));
                     }));
                 }
             });
@@ -27,6 +27,8 @@
         this.queue = [];
         this.index = -1;
         this.semaphore = false;
+        // the API's link to the page after the end of the queue
+        this.next = undefined;
 
         Object.defineProperty(this, "length", {
             get: function() {
@@ -94,8 +96,24 @@
 
             $.ajax({
                 url: apiUrl,
+                // ask for the page after this one too, so we don't have to
+                // come back for more so often
+                data: {include_next: 1},
                 success: function(data, textStatus, jqXHR) {
-                    callback(data.videos, back);
+                    var videos = data.videos;
+                    var lastPage = data;
+
+                    if (data.next_page !== undefined) {
+                        videos = videos.concat(data.next_page.videos);
+                        lastPage = data.next_page;
+                    }
+
+                    if (back === undefined) {
+                        // an empty page has nothing to follow on from
+                        queue.next = lastPage.videos.length > 0 ? lastPage.next : undefined;
+                    }
+
+                    callback(videos, back);
                     queue.semaphore = false;
                 }
             });
@@ -104,6 +122,8 @@
         function generateUrl(back) {
             if (queue.index < 0) {
                 return baseApiUrl;
+            } else if (back === undefined && queue.next !== undefined) {
+                return queue.next;
             } else if (back === undefined) {
                 return baseApiUrl + "?after=" + queue.queue[queue.queue.length - 1].ordering_key;
             } else {
@@ -118,9 +138,7 @@
             } else {
                 Array.prototype.unshift.apply(queue.queue, videos);
             }
-            addVideosToPlaylist(videos.map(function(vid) {
-                return vid.html_snippet;
-            }), prepend);
+            addVideosToPlaylist(videos.map($.videoSnippet), prepend);
         }
 
         function checkQueueAndFetchMoreVideos() {
@@ -0,0 +1,37 @@
+/*!
+*    Copyright (C) 2019 Matt Molyneaux <moggers87+git@moggers87.co.uk>
+*
+*    This file is part of Subscribae.
+*
+*    Subscribae is free software: you can redistribute it and/or modify
+*    it under the terms of the GNU Affero General Public License as published by
+*    the Free Software Foundation, either version 3 of the License, or
+*    (at your option) any later version.
+*
+*    Subscribae is distributed in the hope that it will be useful,
+*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+*    GNU Affero General Public License for more details.
+*
+*    You should have received a copy of the GNU Affero General Public License
+*    along with Subscribae.  If not, see <http://www.gnu.org/licenses/>.
+*/
+
+(function($) {
+    'use strict';
+
+    /* Markup for a video from the video API, the same as
+     * subscribae/includes/videos.html renders. The API only sends
+     * html_snippet when API_HTML_SNIPPETS is set, otherwise the markup is
+     * built here */
+    $.videoSnippet = function(video) {
+        if (video.html_snippet !== undefined) {
+            return video.html_snippet;
+        }
+
+        return $("<div>", {"class": "video-item flex flex-row padding-xs"}).append(
+            $("<img>", {"class": "margin-right-xs border-radius", src: video.thumbnail}),
+            $("<p>", {"class": "title", text: video.title})
+        );
+    };
+})(jQuery);
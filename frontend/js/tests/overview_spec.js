@@ -52,6 +52,14 @@ describe("The overviewVideoFetcher plugin", function() {
         expect($("#snippet").parent()[0].search).toEqual("?start=321");
     });
 
+    it("should build the snippet if there's no html_snippet", function() {
+        $("#fixture").overviewVideoFetcher();
+        window.jQuery.ajax.calls.first().args[0].success({"videos": [{id: "123", ordering_key: "321", title: "hello title", thumbnail: "thumb.jpg"}]});
+
+        expect($("#fixture a .video-item .title").text()).toEqual("hello title");
+        expect($("#fixture a")[0].search).toEqual("?start=321");
+    });
+
     it("should remove the spinner once loaded", function() {
         $("#fixture").overviewVideoFetcher();
         window.jQuery.ajax.calls.first().args[0].success({"videos": [{id: "123", ordering_key: "321", html_snippet: "<div id=\"snippet\"></div>"}]});
@@ -120,6 +120,13 @@ describe("The player", function() {
                 expect($("#playlist").children().text()).toBe("Hello");
             });
 
+            it("should populate the playlist without html_snippet", function() {
+                this.ajaxFunc({"videos": [{id: "123", title: "hello title", description: "hello description", thumbnail: "thumb.jpg"}]});
+
+                expect($("#playlist").children().length).toBe(1);
+                expect($("#playlist .video-item p").text()).toBe("hello title");
+            });
+
             it("should work even if there are no videos", function() {
                 this.ajaxFunc({"videos": []});
                 expect(window.YT.Player.calls.count()).toBe(0);
@@ -262,6 +269,66 @@ describe("The player", function() {
                         expect($("#playlist").children()[3].textContent).toEqual("forth");
                     });
 
+                    it("should add the bundled next page to the queue", function() {
+                        $("#playlist-box .forward").click();
+                        expect(window.jQuery.ajax.calls.count()).toBe(2);
+                        expect(window.jQuery.ajax.calls.argsFor(1)[0].data).toEqual({include_next: 1});
+                        var ajaxFunc = window.jQuery.ajax.calls.argsFor(1)[0].success;
+                        ajaxFunc({
+                            "videos": [
+                                {id: "789", title: "third", description: "third", html_snippet: "<div>third</div>", ordering_key: "3"},
+                            ],
+                            "next_page": {"videos": [
+                                {id: "abc", title: "forth", description: "forth", html_snippet: "<div>forth</div>", ordering_key: "4"},
+                            ]}
+                        });
+                        expect($("#playlist").children().length).toBe(4);
+                        expect($("#playlist").children()[2].textContent).toEqual("third");
+                        expect($("#playlist").children()[3].textContent).toEqual("forth");
+
+                        $("#playlist-box .forward").click();
+                        expect(window.jQuery.ajax.calls.argsFor(2)[0].url).toBe("https://example.com/videos?after=4");
+                    });
+
+                    it("should follow the next link from the API", function() {
+                        var ajaxFunc;
+                        $("#playlist-box .forward").click();
+                        expect(window.jQuery.ajax.calls.argsFor(1)[0].url).toBe("https://example.com/videos?after=2");
+                        ajaxFunc = window.jQuery.ajax.calls.argsFor(1)[0].success;
+                        ajaxFunc({"next": "/videos?cursor=abc", "videos": [
+                            {id: "789", title: "third", description: "third", html_snippet: "<div>third</div>", ordering_key: "3"},
+                        ]});
+
+                        $("#playlist-box .forward").click();
+                        expect(window.jQuery.ajax.calls.argsFor(2)[0].url).toBe("/videos?cursor=abc");
+                        ajaxFunc = window.jQuery.ajax.calls.argsFor(2)[0].success;
+                        ajaxFunc({
+                            "next": "/videos?cursor=def",
+                            "videos": [
+                                {id: "abc", title: "forth", description: "forth", html_snippet: "<div>forth</div>", ordering_key: "4"},
+                            ],
+                            "next_page": {"next": "/videos?cursor=ghi", "videos": [
+                                {id: "def", title: "fifth", description: "fifth", html_snippet: "<div>fifth</div>", ordering_key: "5"},
+                            ]}
+                        });
+
+                        // the bundled page's link is the one to follow
+                        $("#playlist-box .forward").click();
+                        expect(window.jQuery.ajax.calls.argsFor(3)[0].url).toBe("/videos?cursor=ghi");
+                        ajaxFunc = window.jQuery.ajax.calls.argsFor(3)[0].success;
+                        ajaxFunc({"videos": []});
+
+                        // nothing to follow on from an empty page
+                        $("#playlist-box .forward").click();
+                        expect(window.jQuery.ajax.calls.argsFor(4)[0].url).toBe("https://example.com/videos?after=5");
+                        ajaxFunc = window.jQuery.ajax.calls.argsFor(4)[0].success;
+                        ajaxFunc({"videos": []});
+
+                        // and going backwards never uses it
+                        $("#playlist-box .back").click();
+                        expect(window.jQuery.ajax.calls.argsFor(5)[0].url).toBe("https://example.com/videos?before=1");
+                    });
+
                     it("should add videos to the begining of the queue", function() {
                         $("#playlist-box .back").click();
                         expect(window.jQuery.ajax.calls.count()).toBe(2);
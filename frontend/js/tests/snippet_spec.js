@@ -0,0 +1,33 @@
+/*!
+*    Subscribae
+*    Copyright (C) 2018  Matt Molyneaux <moggers87+git@moggers87.co.uk>
+*
+*    This program is free software: you can redistribute it and/or modify
+*    it under the terms of the GNU General Public License as published by
+*    the Free Software Foundation, either version 3 of the License, or
+*    (at your option) any later version.
+*
+*    This program is distributed in the hope that it will be useful,
+*    but WITHOUT ANY WARRANTY; without even the implied warranty of
+*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+*    GNU General Public License for more details.
+*
+*    You should have received a copy of the GNU General Public License
+*    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+*/
+
+describe("The videoSnippet function", function() {
+    it("should use html_snippet if there is one", function() {
+        expect($.videoSnippet({id: "123", html_snippet: "<div>Hello</div>"})).toBe("<div>Hello</div>");
+    });
+
+    it("should build the snippet otherwise", function() {
+        var $snippet = $.videoSnippet({id: "123", title: "<b>hello</b>", thumbnail: "thumb.jpg"});
+
+        expect($snippet.hasClass("video-item")).toBe(true);
+        expect($snippet.find("img").attr("src")).toBe("thumb.jpg");
+        // titles are text, not markup
+        expect($snippet.find(".title").text()).toBe("<b>hello</b>");
+        expect($snippet.find("b").length).toBe(0);
+    });
+});
@@ -33,7 +33,7 @@ class UserAddForm(ErrorClassMixin, ModelForm):
 class UserEditForm(ErrorClassMixin, ModelForm):
     class Meta:
         model = get_user_model()
-        fields = ["is_active"]
+        fields = ["is_active", "api_page_limit"]
 
 
 class SiteConfigForm(ErrorClassMixin, ModelForm):
@@ -20,6 +20,7 @@
 import os
 
 from djangae.test import TestCase, inconsistent_db
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 from django.core.cache import cache
@@ -229,6 +230,19 @@ class UserEditTestCase(TestCase):
         user.refresh_from_db()
         self.assertEqual(user.is_active, True)
 
+    def test_post_page_limit(self):
+        user = get_user_model().objects.create(username='2', email='other@example.com',
+                                               is_active=True)
+        self.assertEqual(user.max_page_size, settings.API_MAX_PAGE_SIZE)
+
+        data = {"is_active": "1", "api_page_limit": "100"}
+        response = self.client.post(reverse("admin:user-edit", kwargs={"user_id": user.id}), data)
+        self.assertRedirects(response, reverse("admin:user-index"))
+
+        user.refresh_from_db()
+        self.assertEqual(user.api_page_limit, 100)
+        self.assertEqual(user.max_page_size, 100)
+
     def test_404_post(self):
         response = self.client.post(reverse("admin:user-edit", kwargs={"user_id": "123"}), {})
         self.assertEqual(response.status_code, 404)
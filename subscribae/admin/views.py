@@ -22,13 +22,13 @@ import logging
 
 from djangae.db.consistency import ensure_instance_consistent
 from django.contrib.auth import get_user_model
-from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.http import Http404, HttpResponseRedirect
 from django.shortcuts import get_object_or_404
 from django.template.response import TemplateResponse
 
 from subscribae.admin.forms import SiteConfigForm, UserAddForm, UserEditForm
+from subscribae.local_cache import tiered_cache
 from subscribae.utils import SITE_CONFIG_CACHE_KEY, get_site_config
 
 _log = logging.getLogger(__name__)
@@ -116,7 +116,7 @@ def site_config(request):
         form = SiteConfigForm(instance=config, data=request.POST)
         if form.is_valid():
             form.save()
-            cache.delete(SITE_CONFIG_CACHE_KEY)
+            tiered_cache.delete(SITE_CONFIG_CACHE_KEY)
             return HttpResponseRedirect(reverse('admin:index'))
     else:
         form = SiteConfigForm(instance=config)
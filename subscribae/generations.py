@@ -0,0 +1,74 @@
+##
+#    Copyright (C) 2019  Matt Molyneaux <moggers87+git@moggers87.co.uk>
+#
+#    This file is part of Subscribae.
+#
+#    Subscribae is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Subscribae is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Subscribae.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from datetime import timedelta
+import uuid
+
+from django.core.cache import cache
+
+# each bucket and subscription has a generation that changes whenever the
+# videos listed for it might have changed, API responses use it in their ETags
+GENERATION_CACHE_PREFIX = "generation"
+GENERATION_CACHE_TIMEOUT = timedelta(days=7).total_seconds()
+
+BUCKET = "bucket"
+SUBSCRIPTION = "subscription"
+
+
+def generation_key(kind, id):
+    return "{}-{}-{}".format(GENERATION_CACHE_PREFIX, kind, id)
+
+
+def new_generation():
+    # not a counter, so a generation that's been evicted from the cache can't
+    # come back with a value that's been used before
+    return uuid.uuid4().hex
+
+
+def get_generation(kind, id):
+    """The current generation of a bucket or subscription"""
+    key = generation_key(kind, id)
+    generation = cache.get(key)
+    if generation is None:
+        generation = new_generation()
+        if not cache.add(key, generation, GENERATION_CACHE_TIMEOUT):
+            # someone else got there first
+            generation = cache.get(key, generation)
+
+    return generation
+
+
+def bump_generations(kind, ids):
+    """Start new generations for several buckets or subscriptions at once"""
+    ids = set(ids)
+    if ids:
+        generation = new_generation()
+        cache.set_many({generation_key(kind, id): generation for id in ids}, GENERATION_CACHE_TIMEOUT)
+
+
+def bump_video_generations(videos):
+    """Start new generations for everything that lists `videos`"""
+    subscription_ids = set()
+    bucket_ids = set()
+    for video in videos:
+        subscription_ids.add(video.subscription_id)
+        bucket_ids.update(video.buckets_ids)
+
+    bump_generations(SUBSCRIPTION, subscription_ids)
+    bump_generations(BUCKET, bucket_ids)
@@ -0,0 +1,208 @@
+##
+#    Copyright (C) 2019  Matt Molyneaux <moggers87+git@moggers87.co.uk>
+#
+#    This file is part of Subscribae.
+#
+#    Subscribae is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Subscribae is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Subscribae.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from collections import OrderedDict
+import cPickle as pickle
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+# how long an instance can keep using its own copy of a value
+LOCAL_CACHE_TIMEOUT = 60
+
+
+class LocalCache(object):
+    """A least recently used cache that lives in this instance's memory
+
+    Values are pickled, both so that callers can't change what's cached by
+    accident and so we know how much memory we're using. Once `max_bytes` is
+    reached, the least recently used values are dropped.
+    """
+    def __init__(self, max_bytes, timeout=LOCAL_CACHE_TIMEOUT):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._data = OrderedDict()
+            self.size = 0
+
+    def _pop(self, key):
+        expires, value = self._data.pop(key)
+        self.size -= len(value)
+        return expires, value
+
+    def get(self, key, now=None):
+        """Returns a tuple of whether `key` was found and its value"""
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            if key not in self._data:
+                return False, None
+
+            expires, value = self._pop(key)
+            if expires < now:
+                return False, None
+
+            # most recently used go to the end
+            self._data[key] = (expires, value)
+            self.size += len(value)
+
+        return True, pickle.loads(value)
+
+    def set(self, key, value, timeout=None, now=None):
+        if now is None:
+            now = time.time()
+        if timeout is None or timeout > self.timeout:
+            timeout = self.timeout
+
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(value) > self.max_bytes:
+            self.delete(key)
+            return
+
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (now + timeout, value)
+            self.size += len(value)
+
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self._data)))
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+
+
+class TieredCache(object):
+    """Django's cache with a LocalCache in front of it
+
+    Reads look in the local tier first and keep a local copy of anything they
+    find in Django's cache. Writes and deletes go to both tiers, but other
+    instances may carry on using their local copy for up to `timeout` seconds.
+    Hits and misses are counted for each tier.
+    """
+    def __init__(self, max_bytes=None, timeout=LOCAL_CACHE_TIMEOUT, remote=None):
+        self._max_bytes = max_bytes
+        self.timeout = timeout
+        self._remote = remote
+        self._local = None
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def remote(self):
+        if self._remote is None:
+            return cache
+        return self._remote
+
+    @property
+    def local(self):
+        if self._local is None:
+            max_bytes = self._max_bytes
+            if max_bytes is None:
+                max_bytes = settings.LOCAL_CACHE_MAX_BYTES
+            self._local = LocalCache(max_bytes, self.timeout)
+        return self._local
+
+    @property
+    def enabled(self):
+        return self.local.max_bytes > 0
+
+    def reset_stats(self):
+        self.local_hits = 0
+        self.local_misses = 0
+        self.remote_hits = 0
+        self.remote_misses = 0
+
+    def stats(self):
+        def ratio(hits, misses):
+            return hits / float(hits + misses) if hits + misses else 0.0
+
+        return {
+            "local_hits": self.local_hits,
+            "local_misses": self.local_misses,
+            "local_hit_ratio": ratio(self.local_hits, self.local_misses),
+            "remote_hits": self.remote_hits,
+            "remote_misses": self.remote_misses,
+            "remote_hit_ratio": ratio(self.remote_hits, self.remote_misses),
+        }
+
+    def _count(self, local_hits=0, local_misses=0, remote_hits=0, remote_misses=0):
+        with self._lock:
+            self.local_hits += local_hits
+            self.local_misses += local_misses
+            self.remote_hits += remote_hits
+            self.remote_misses += remote_misses
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        found = {}
+        if self.enabled:
+            for key in keys:
+                hit, value = self.local.get(key)
+                if hit:
+                    found[key] = value
+            self._count(local_hits=len(found), local_misses=len(keys) - len(found))
+
+        remaining = [key for key in keys if key not in found]
+        if remaining:
+            remote = self.remote.get_many(remaining)
+            self._count(remote_hits=len(remote), remote_misses=len(remaining) - len(remote))
+            if self.enabled:
+                for key, value in remote.items():
+                    self.local.set(key, value)
+            found.update(remote)
+
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        self.set_many({key: value}, timeout)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT):
+        self.remote.set_many(data, timeout)
+
+        if self.enabled:
+            if timeout is DEFAULT_TIMEOUT:
+                timeout = None
+            for key, value in data.items():
+                self.local.set(key, value, timeout)
+
+    def delete(self, key):
+        """Remove `key` from both tiers, use this to invalidate things that have changed"""
+        self.remote.delete(key)
+        if self.enabled:
+            self.local.delete(key)
+
+    def clear_local(self):
+        self.local.clear()
+
+
+tiered_cache = TieredCache()
@@ -18,19 +18,28 @@
 ##
 
 import base64
+import hashlib
 
 from djangae.contrib.gauth_datastore.models import GaeAbstractDatastoreUser
 from djangae.db.constraints import UniquenessMixin
 from djangae.fields import ComputedCharField, JSONField, RelatedSetField
 from django.conf import settings
+from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.template import Context, Template
 from django.template.loader import get_template
 from oauth2client.client import Credentials
 
+from subscribae.generations import BUCKET, bump_generations, bump_video_generations
+from subscribae.local_cache import tiered_cache
 from subscribae.managers import SubscriptionQuerySet, VideoQuerySet
 
 DEFAULT_SIZE = 'medium'
+OAUTH_TOKEN_CACHE_PREFIX = 'oauth-token'
+VIDEO_SNIPPET_CACHE_PREFIX = 'video-snippet'
+VIDEO_SNIPPET_CACHE_TIMEOUT = 60 * 60 * 24
 
 
 def create_composite_key(*args):
@@ -38,18 +47,26 @@ def create_composite_key(*args):
     return base64.urlsafe_b64encode(key)
 
 
+def pick_thumbnail(thumbnails, size=DEFAULT_SIZE):
+    if size in thumbnails:
+        return thumbnails[size]
+    elif DEFAULT_SIZE in thumbnails:
+        return thumbnails[DEFAULT_SIZE]
+    elif len(thumbnails) > 0:
+        return thumbnails.values()[0]
+    else:
+        return ""
+
+
 class ThumbnailAbstract(models.Model):
     thumbnails = JSONField()
 
     def get_thumbnail(self, size=DEFAULT_SIZE):
-        if size in self.thumbnails:
-            return self.thumbnails[size]
-        elif DEFAULT_SIZE in self.thumbnails:
-            return self.thumbnails[DEFAULT_SIZE]
-        elif len(self.thumbnails) > 0:
-            return self.thumbnails.values()[0]
-        else:
-            return ""
+        return pick_thumbnail(self.thumbnails, size)
+
+    @property
+    def thumbnail(self):
+        return self.get_thumbnail()
 
     class Meta:
         abstract = True
@@ -64,10 +81,22 @@ class Subscription(ThumbnailAbstract):
 
     # from subscription endpoint
     channel_id = models.CharField(max_length=200)  # snippet.resourceId.channelId
+    title = models.CharField(max_length=500, blank=True)  # snippet.title
+    description = models.TextField(blank=True)  # snippet.description
+
+    # when title and description were last saved from the API
+    titles_updated = models.DateTimeField(null=True)
 
     # from channel endpoint
     upload_playlist = models.CharField(max_length=200)  # contentDetails.relatedPlaylists.uploads
 
+    # what the first page of upload_playlist looked like when we last imported it
+    playlist_etag = models.CharField(max_length=200, blank=True)
+    head_video_id = models.CharField(max_length=200, blank=True)
+
+    # newest published_at of the videos we've imported
+    last_video_published_at = models.DateTimeField(null=True)
+
     # calculate id based on user ID + channel ID so we can get by keys later
     id = ComputedCharField(lambda self: create_composite_key(str(self.user_id), self.channel_id),
                            primary_key=True, max_length=200)
@@ -81,10 +110,21 @@ class Subscription(ThumbnailAbstract):
     def __repr__(self):
         return "<Subscription {}>".format(self.channel_id.encode("utf-8", "ignore"))
 
-    def add_titles(self):
-        """Fetches titles and descriptions for Subscription"""
-        from subscribae.utils import subscription_add_titles
-        return list(subscription_add_titles([self]))[0]
+
+class SubscriptionListPage(models.Model):
+    """A page of a user's subscriptions as we last saw it
+
+    Allows us to make conditional requests for the subscription list and still
+    know which subscriptions were on that page and where the next page is
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL)
+    page_token = models.CharField(max_length=200, blank=True)
+    next_page_token = models.CharField(max_length=200, blank=True)
+    etag = models.CharField(max_length=200, blank=True)
+    subscriptions = RelatedSetField(Subscription)
+
+    id = ComputedCharField(lambda self: create_composite_key(str(self.user_id), self.page_token or ""),
+                           primary_key=True, max_length=200)
 
 
 class Bucket(UniquenessMixin, models.Model):
@@ -122,6 +162,16 @@ class Video(ThumbnailAbstract):
     # from video endpoint
     youtube_id = models.CharField(max_length=200)  # id
     published_at = models.DateTimeField()
+    title = models.CharField(max_length=500, blank=True)  # snippet.title
+    description = models.TextField(blank=True)  # snippet.description
+
+    # when title and description were last saved from the API
+    titles_updated = models.DateTimeField(null=True)
+
+    # the API no longer knows about this video, it's been deleted or made private
+    tombstone = models.BooleanField(default=False)
+    # refreshes in a row that the API hasn't returned this video for
+    missed_refreshes = models.PositiveIntegerField(default=0)
 
     # calculate id based on user ID + video ID so we can get by keys later
     id = ComputedCharField(lambda self: create_composite_key(str(self.user_id), self.youtube_id),
@@ -136,13 +186,34 @@ class Video(ThumbnailAbstract):
 
     @property
     def html_snippet(self):
+        if getattr(self, "_html_snippet", None) is None:
+            self._html_snippet = self.render_html_snippet()
+        return self._html_snippet
+
+    def render_html_snippet(self):
         tmpl = get_template("subscribae/includes/videos.html")
         return tmpl.render({"video": self})
 
-    def add_titles(self):
-        """Fetches titles and descriptions for Video"""
-        from subscribae.utils import video_add_titles
-        return list(video_add_titles([self]))[0]
+    def html_snippet_cache_key(self):
+        """Cache key for html_snippet, which changes if anything it displays changes"""
+        digest = hashlib.md5(u"{}|{}".format(self.title, self.thumbnail).encode("utf-8")).hexdigest()
+        return "{}{}|{}|{}".format(VIDEO_SNIPPET_CACHE_PREFIX, self.pk, DEFAULT_SIZE, digest)
+
+
+class TitleRefresh(models.Model):
+    """How far a user's title refresh has got through one kind of object
+
+    Objects are refreshed in pk order, so only the last pk needs to be kept
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL)
+    name = models.CharField(max_length=200)
+    # blank when no refresh is in progress
+    last_pk = models.CharField(max_length=200, blank=True)
+    # when the current or most recent refresh started
+    started = models.DateTimeField(null=True)
+
+    id = ComputedCharField(lambda self: create_composite_key(str(self.user_id), self.name),
+                           primary_key=True, max_length=200)
 
 
 class OauthToken(models.Model):
@@ -153,6 +224,46 @@ class OauthToken(models.Model):
     def get(self):
         return Credentials.new_from_json(self.data)
 
+    @staticmethod
+    def cache_key(user_id):
+        return "{}{}".format(OAUTH_TOKEN_CACHE_PREFIX, user_id)
+
+
+def prefetch_html_snippets(videos):
+    """Fill in html_snippet for `videos` from the cache
+
+    Snippets that aren't cached are rendered and cached in one go
+    """
+    keys = {video.html_snippet_cache_key(): video for video in videos}
+    if not keys:
+        return
+
+    cached = tiered_cache.get_many(keys.keys())
+    rendered = {}
+    for key, video in keys.items():
+        if key in cached:
+            video._html_snippet = cached[key]
+        else:
+            rendered[key] = video.html_snippet
+
+    if rendered:
+        tiered_cache.set_many(rendered, VIDEO_SNIPPET_CACHE_TIMEOUT)
+
+
+@receiver([post_save, post_delete], sender=OauthToken)
+def invalidate_oauth_token(sender, instance, **kwargs):
+    cache.delete(OauthToken.cache_key(instance.user_id))
+
+
+@receiver([post_save, post_delete], sender=Bucket)
+def bump_bucket_generation(sender, instance, **kwargs):
+    bump_generations(BUCKET, [instance.pk])
+
+
+@receiver([post_save, post_delete], sender=Video)
+def bump_video_generation(sender, instance, **kwargs):
+    bump_video_generations([instance])
+
 
 class SiteConfig(models.Model):
     """
@@ -172,3 +283,12 @@ class SiteConfig(models.Model):
 
 class SubscribaeUser(GaeAbstractDatastoreUser):
     is_active = models.BooleanField(default=False)
+    # overrides settings.API_MAX_PAGE_SIZE for this user
+    api_page_limit = models.PositiveIntegerField(null=True, blank=True)
+
+    @property
+    def max_page_size(self):
+        """Largest page of videos this user can ask for"""
+        if self.api_page_limit is None:
+            return settings.API_MAX_PAGE_SIZE
+        return self.api_page_limit
@@ -0,0 +1,279 @@
+##
+#    Copyright (C) 2019  Matt Molyneaux <moggers87+git@moggers87.co.uk>
+#
+#    This file is part of Subscribae.
+#
+#    Subscribae is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Subscribae is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Subscribae.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from datetime import datetime, timedelta
+import json
+import logging
+import math
+import random
+
+from apiclient.errors import HttpError
+from apiclient.http import HttpRequest
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+import pytz
+
+# YouTube resets quotas at midnight Pacific time
+QUOTA_TIMEZONE = pytz.timezone("America/Los_Angeles")
+QUOTA_CACHE_PREFIX = "api-quota"
+QUOTA_CACHE_TIMEOUT = timedelta(days=2).total_seconds()
+
+# users who haven't logged in for this long are only synced if their share of
+# the quota is at least MIN_USER_SHARE
+ACTIVE_USER_PERIOD = timedelta(days=14)
+MIN_USER_SHARE = 50
+
+# work put off until the quota resets is spread over this long afterwards, so
+# it doesn't all start at once
+QUOTA_RESET_SPREAD = timedelta(hours=6)
+
+QUOTA_ERROR_REASONS = ["dailyLimitExceeded", "quotaExceeded"]
+
+DEFAULT_API_COST = 1
+API_COSTS = {
+    "youtube.channels.list": 1,
+    "youtube.playlistItems.list": 1,
+    "youtube.subscriptions.list": 1,
+    "youtube.videos.list": 1,
+}
+
+_log = logging.getLogger(__name__)
+
+
+def import_page_cost():
+    """Units it costs to import a page of playlist items
+
+    The videos on the page are only asked for separately if they aren't taken
+    from the playlist items
+    """
+    cost = API_COSTS["youtube.playlistItems.list"]
+    if not settings.IMPORT_VIDEOS_FROM_PLAYLIST:
+        cost += API_COSTS["youtube.videos.list"]
+    return cost
+
+
+def quota_day(now=None):
+    """The day that the YouTube API quota is currently counting against"""
+    if now is None:
+        now = timezone.now()
+    return now.astimezone(QUOTA_TIMEZONE).date()
+
+
+def next_reset(now=None):
+    """When the YouTube API quota will next be reset"""
+    day = quota_day(now) + timedelta(days=1)
+    reset = QUOTA_TIMEZONE.localize(datetime(day.year, day.month, day.day))
+    return reset.astimezone(pytz.utc)
+
+
+def is_quota_error(exc):
+    """Returns True if `exc` is the API telling us we've run out of quota"""
+    if not isinstance(exc, HttpError) or exc.resp.status != 403:
+        return False
+
+    try:
+        errors = json.loads(exc.content)["error"]["errors"]
+    except (ValueError, KeyError, TypeError):
+        return False
+
+    return any(error.get("reason") in QUOTA_ERROR_REASONS for error in errors)
+
+
+class QuotaLedger(object):
+    """Keeps count of how many API units have been spent today
+
+    Counts live in the cache, keyed by quota day, so they're shared between
+    instances
+    """
+    def __init__(self, daily_limit=None):
+        self._daily_limit = daily_limit
+
+    @property
+    def daily_limit(self):
+        if self._daily_limit is None:
+            return settings.YOUTUBE_API_DAILY_QUOTA
+        return self._daily_limit
+
+    def _key(self, now=None):
+        return "{}{}".format(QUOTA_CACHE_PREFIX, quota_day(now).isoformat())
+
+    def _add(self, key, units):
+        cache.add(key, 0, QUOTA_CACHE_TIMEOUT)
+        try:
+            return cache.incr(key, units)
+        except ValueError:
+            # evicted between add and incr
+            cache.set(key, units, QUOTA_CACHE_TIMEOUT)
+            return units
+
+    def _get(self, key):
+        return cache.get(key, 0)
+
+    def _set(self, key, units):
+        cache.set(key, units, QUOTA_CACHE_TIMEOUT)
+
+    def charge(self, method_id, units=None):
+        """Record that an API call has been made, returns units used today"""
+        if units is None:
+            units = API_COSTS.get(method_id, DEFAULT_API_COST)
+        return self._add(self._key(), units)
+
+    def used(self):
+        return self._get(self._key())
+
+    def remaining(self):
+        return max(self.daily_limit - self.used(), 0)
+
+    def exhaust(self):
+        """Mark today's quota as used up, e.g. because the API told us so"""
+        self._set(self._key(), self.daily_limit)
+
+
+class LocalQuotaLedger(QuotaLedger):
+    """A QuotaLedger that only exists in this process, used for simulations"""
+    def __init__(self, daily_limit=None):
+        super(LocalQuotaLedger, self).__init__(daily_limit)
+        self.counts = {}
+
+    def _add(self, key, units):
+        self.counts[key] = self.counts.get(key, 0) + units
+        return self.counts[key]
+
+    def _get(self, key):
+        return self.counts.get(key, 0)
+
+    def _set(self, key, units):
+        self.counts[key] = units
+
+
+class QuotaScheduler(object):
+    """Shares out the quota that's left between `users`
+
+    Each user gets an equal share of what's left today. Recently active users
+    are always synced, others only if their share is at least MIN_USER_SHARE.
+    History pages are imported until a task has spent its share, first pages
+    always are. Once the quota has run out, nothing is allowed.
+    """
+    def __init__(self, ledger=None, users=1):
+        self.ledger = ledger if ledger is not None else quota_ledger
+        self.users = users
+        # units promised to users by allocate, but maybe not spent yet
+        self.allocated = 0
+
+    def is_exhausted(self):
+        return self.ledger.remaining() <= 0
+
+    def user_share(self, users_left=None):
+        """Units each of the next `users_left` users can spend"""
+        if users_left is None:
+            users_left = self.users
+        return max(self.ledger.remaining() - self.allocated, 0) / float(max(users_left, 1))
+
+    def allocate(self, units):
+        self.allocated += units
+
+    def is_recently_active(self, user, now=None):
+        if now is None:
+            now = timezone.now()
+        return user.last_login is not None and user.last_login > now - ACTIVE_USER_PERIOD
+
+    def should_sync_user(self, user, share=None):
+        if share is None:
+            share = self.user_share()
+
+        if self.is_exhausted():
+            return False
+        return self.is_recently_active(user) or share >= MIN_USER_SHARE
+
+    def should_import_page(self, page_token, spent=0, share=None):
+        """First pages are always wanted, history pages only while there's some of `share` left to spend"""
+        if share is None:
+            share = self.user_share()
+
+        if self.is_exhausted():
+            return False
+        return page_token is None or spent + import_page_cost() <= share
+
+    def next_reset(self):
+        return next_reset()
+
+    def after_reset(self):
+        """A random time in the QUOTA_RESET_SPREAD after the next reset"""
+        return self.next_reset() + timedelta(seconds=random.uniform(0, QUOTA_RESET_SPREAD.total_seconds()))
+
+
+class QuotaHttpRequest(HttpRequest):
+    """HttpRequest that charges the quota ledger when it's executed
+
+    Batched requests aren't executed individually, batch_execute charges for
+    those instead
+    """
+    def execute(self, *args, **kwargs):
+        quota_ledger.charge(self.methodId)
+        return super(QuotaHttpRequest, self).execute(*args, **kwargs)
+
+
+def simulate(users, subscription_count, history_pages, daily_limit, page_size=50):
+    """Simulate a sync of all users against a local ledger
+
+    `users` is a list of user-like objects (they only need `last_login`), each
+    with `subscription_count` subscriptions that have `history_pages` pages of
+    videos we've not seen yet. Returns counts of what would have been done.
+    """
+    ledger = LocalQuotaLedger(daily_limit)
+    scheduler = QuotaScheduler(ledger, len(users))
+    stats = {
+        "users_synced": 0,
+        "users_skipped": 0,
+        "pages_imported": 0,
+        "pages_deferred": 0,
+    }
+
+    sub_pages = int(math.ceil(subscription_count / float(page_size)))
+    for users_left, user in zip(range(len(users), 0, -1), users):
+        share = scheduler.user_share(users_left)
+        if not scheduler.should_sync_user(user, share):
+            stats["users_skipped"] += 1
+            continue
+
+        stats["users_synced"] += 1
+        started = ledger.used()
+        # uploads playlists are derived from channel ids, so there's no
+        # channels.list for each page
+        for _ in range(sub_pages):
+            ledger.charge("youtube.subscriptions.list")
+
+        for _ in range(subscription_count):
+            for page in range(history_pages):
+                page_token = None if page == 0 else str(page)
+                if scheduler.should_import_page(page_token, ledger.used() - started, share):
+                    ledger.charge("youtube.playlistItems.list")
+                    if not settings.IMPORT_VIDEOS_FROM_PLAYLIST:
+                        ledger.charge("youtube.videos.list")
+                    stats["pages_imported"] += 1
+                else:
+                    stats["pages_deferred"] += history_pages - page
+                    break
+
+    stats["units_used"] = ledger.used()
+    return stats
+
+
+quota_ledger = QuotaLedger()
@@ -158,6 +158,32 @@ OAUTH_SCOPES = [
 
 OAUTH_RETURN_SESSION_KEY = 'subscribae-oauth-return-url-name'
 
+# YouTube Data API units available per day
+YOUTUBE_API_DAILY_QUOTA = 10000
+
+# number of playlists imported by each import task
+IMPORT_TASK_BATCH_SIZE = 20
+
+# take video details from playlistItems rather than asking videos().list for
+# them, halving the API calls made for each page of a playlist
+IMPORT_VIDEOS_FROM_PLAYLIST = True
+
+# include rendered markup for each video in the video APIs, without it the
+# frontend builds its own
+API_HTML_SNIPPETS = True
+
+# viewed videos are queued up and written in batches by a task rather than
+# when the player tells us about them
+VIEWED_WRITE_BEHIND = True
+
+# largest page of videos a user can ask the video APIs for, unless they've
+# been given their own limit
+API_MAX_PAGE_SIZE = 50
+
+# memory each instance can use to keep its own copy of hot cache values, 0
+# turns it off so that changes show up straight away while developing
+LOCAL_CACHE_MAX_BYTES = 0
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/1.6/howto/static-files/
 
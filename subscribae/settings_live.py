@@ -55,6 +55,9 @@ SECURE_REDIRECT_EXEMPT = [
 DEBUG = False
 ASSETS_DEBUG = DEBUG
 
+# F1 instances only have 128MB
+LOCAL_CACHE_MAX_BYTES = 4 * 1024 * 1024
+
 # Remove unsafe-inline from CSP_STYLE_SRC. It's there in default to allow
 # Django error pages in DEBUG mode render necessary styles
 if "'unsafe-inline'" in CSP_STYLE_SRC:  # noqa: F405
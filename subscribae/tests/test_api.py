@@ -18,16 +18,22 @@
 ##
 
 import json
+import sys
 
+from djangae.db import transaction
 from djangae.test import TestCase
 from django.contrib.auth import get_user_model
 from django.core.urlresolvers import reverse
+from django.db.models.signals import post_init
+from django.test import override_settings
+from google.appengine.api.datastore_errors import BadRequestError
 import mock
 
-from subscribae.models import Video
+from subscribae.models import Bucket, Video
 from subscribae.test import gae_login, gae_logout
 from subscribae.tests.utils import BucketFactory, SubscriptionFactory, VideoFactory
-from subscribae.views.api import queryset_to_json
+from subscribae.viewed import apply_viewed_events
+from subscribae.views.api import VIDEO_JSON_API_MAP, VideoRow, queryset_to_json
 
 
 def datetime_to_js_iso(dt):
@@ -78,27 +84,230 @@ class BucketVideoApiTestCase(TestCase):
     def test_get(self):
         bucket = BucketFactory(user=self.user)
         video = VideoFactory(user=self.user, buckets=[bucket])
-        video = video.add_titles()
 
         response = self.client.get(reverse("bucket-video-api", kwargs={"bucket": bucket.pk}))
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.content)
         self.assertEqual(data, {
-            "next": "{}?after={}".format(reverse("bucket-video-api", kwargs={"bucket": bucket.pk}), video.ordering_key),
+            "next": mock.ANY,
             "videos": [{
                 "id": video.youtube_id,
                 "title": video.title,
                 "description": video.description,
                 "published": datetime_to_js_iso(video.published_at),
                 "html_snippet": video.html_snippet,
+                "thumbnail": video.thumbnail,
                 "ordering_key": video.ordering_key,
             }],
         })
 
+    def test_get_with_cursor(self):
+        bucket = BucketFactory(user=self.user)
+        VideoFactory.create_batch(25, user=self.user, buckets=[bucket])
+        url = reverse("bucket-video-api", kwargs={"bucket": bucket.pk})
+        expected = list(Video.objects.all().order_by("ordering_key").values_list("youtube_id", flat=True))
+
+        pages = []
+        next_url = url
+        while next_url:
+            data = json.loads(self.client.get(next_url).content)
+            if data["videos"]:
+                self.assertTrue(data["next"].startswith("{}?cursor=".format(url)), data["next"])
+                pages.append([video["id"] for video in data["videos"]])
+            next_url = data.get("next")
+
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(sum(pages, []), expected)
+
+        # cursors carry on from the filter of the first page
+        after = Video.objects.get(youtube_id=expected[14]).ordering_key
+        data = json.loads(self.client.get("{}?after={}".format(url, after)).content)
+        self.assertEqual([video["id"] for video in data["videos"]], expected[15:25])
+        data = json.loads(self.client.get(data["next"]).content)
+        self.assertEqual(data, {"videos": []})
+
+    def test_get_bad_cursor(self):
+        bucket = BucketFactory(user=self.user)
+        VideoFactory(user=self.user, buckets=[bucket])
+        url = reverse("bucket-video-api", kwargs={"bucket": bucket.pk})
+        next_url = json.loads(self.client.get(url).content)["next"]
+
+        response = self.client.get(next_url + "nope")
+        self.assertEqual(response.status_code, 404)
+
+        # cursors only work for the bucket they came from
+        other_bucket = BucketFactory(user=self.user)
+        other_url = reverse("bucket-video-api", kwargs={"bucket": other_bucket.pk})
+        response = self.client.get(next_url.replace(url, other_url))
+        self.assertEqual(response.status_code, 404)
+
+    def test_get_stale_cursor(self):
+        bucket = BucketFactory(user=self.user)
+        VideoFactory.create_batch(12, user=self.user, buckets=[bucket])
+        url = reverse("bucket-video-api", kwargs={"bucket": bucket.pk})
+        expected = list(Video.objects.all().order_by("ordering_key").values_list("youtube_id", flat=True))
+        next_url = json.loads(self.client.get(url).content)["next"]
+
+        with mock.patch("subscribae.views.api.set_cursor", side_effect=BadRequestError("stale")):
+            response = self.client.get(next_url)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual([video["id"] for video in data["videos"]], expected[10:])
+
+    def test_get_with_limit(self):
+        bucket = BucketFactory(user=self.user)
+        VideoFactory.create_batch(12, user=self.user, buckets=[bucket])
+        url = reverse("bucket-video-api", kwargs={"bucket": bucket.pk})
+
+        for limit, expected in [("3", 3), ("0", 1), ("11", 11), ("1000", 12)]:
+            data = json.loads(self.client.get("{}?limit={}".format(url, limit)).content)
+            self.assertEqual(len(data["videos"]), expected, limit)
+
+        # next pages keep the same size
+        data = json.loads(self.client.get("{}?limit=5".format(url)).content)
+        data = json.loads(self.client.get("{}&limit=5".format(data["next"])).content)
+        self.assertEqual(len(data["videos"]), 5)
+
+        response = self.client.get("{}?limit=lots".format(url))
+        self.assertEqual(response.status_code, 404)
+
+    def test_get_with_limit_per_user(self):
+        bucket = BucketFactory(user=self.user)
+        VideoFactory.create_batch(12, user=self.user, buckets=[bucket])
+        url = reverse("bucket-video-api", kwargs={"bucket": bucket.pk})
+
+        with override_settings(API_MAX_PAGE_SIZE=4):
+            data = json.loads(self.client.get("{}?limit=1000".format(url)).content)
+            self.assertEqual(len(data["videos"]), 4)
+            # the default page size is also capped
+            data = json.loads(self.client.get(url).content)
+            self.assertEqual(len(data["videos"]), 4)
+
+            self.user.api_page_limit = 6
+            self.user.save()
+            data = json.loads(self.client.get("{}?limit=1000".format(url)).content)
+            self.assertEqual(len(data["videos"]), 6)
+
+    def test_get_include_next(self):
+        bucket = BucketFactory(user=self.user)
+        VideoFactory.create_batch(25, user=self.user, buckets=[bucket])
+        url = reverse("bucket-video-api", kwargs={"bucket": bucket.pk})
+        expected = list(Video.objects.all().order_by("ordering_key").values_list("youtube_id", flat=True))
+
+        data = json.loads(self.client.get("{}?include_next=1".format(url)).content)
+        self.assertEqual([video["id"] for video in data["videos"]], expected[:10])
+        self.assertEqual([video["id"] for video in data["next_page"]["videos"]], expected[10:20])
+
+        # next is still the page after the first one, next_page has its own
+        data = json.loads(self.client.get("{}&include_next=1".format(data["next_page"]["next"])).content)
+        self.assertEqual([video["id"] for video in data["videos"]], expected[20:])
+        self.assertEqual(data["next_page"], {"videos": []})
+
+        # going backwards, the bundled page carries on backwards
+        before = Video.objects.get(youtube_id=expected[20]).ordering_key
+        data = json.loads(self.client.get("{}?before={}&include_next=1".format(url, before)).content)
+        self.assertEqual([video["id"] for video in data["videos"]], expected[19:9:-1])
+        self.assertEqual([video["id"] for video in data["next_page"]["videos"]], expected[9::-1])
+
+    def test_get_include_next_round_trips(self):
+        bucket = BucketFactory(user=self.user)
+        VideoFactory.create_batch(40, user=self.user, buckets=[bucket])
+        url = reverse("bucket-video-api", kwargs={"bucket": bucket.pk})
+
+        def fetch_all(args):
+            requests = 0
+            videos = []
+            next_url = url
+            while next_url:
+                data = json.loads(self.client.get("{}{}{}".format(next_url, "&" if "?" in next_url else "?",
+                                                                  args)).content)
+                requests += 1
+                pages = [data, data.get("next_page", {})]
+                videos.extend(video["id"] for page in pages for video in page.get("videos", []))
+                next_url = pages[-1].get("next") if "next_page" in data else data.get("next")
+            return requests, videos
+
+        requests, videos = fetch_all("")
+        bundled_requests, bundled_videos = fetch_all("include_next=1")
+        self.assertEqual(bundled_videos, videos)
+        self.assertEqual(requests, 5)
+        self.assertEqual(bundled_requests, 3)
+
+    def test_get_stored_titles(self):
+        bucket = BucketFactory(user=self.user)
+        VideoFactory(user=self.user, buckets=[bucket], title="henlo", description="bluh bluh")
+
+        response = self.client.get(reverse("bucket-video-api", kwargs={"bucket": bucket.pk}))
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(data["videos"][0]["title"], "henlo")
+        self.assertEqual(data["videos"][0]["description"], "bluh bluh")
+        # titles come from the datastore, not the API
+        self.assertEqual(self.service_mock.call_count, 0)
+
+    @override_settings(API_HTML_SNIPPETS=False)
+    def test_get_json_only(self):
+        bucket = BucketFactory(user=self.user)
+        video = VideoFactory(user=self.user, buckets=[bucket], thumbnails={"medium": "thumb.jpg"})
+
+        with mock.patch.object(Video, "render_html_snippet") as render_mock:
+            response = self.client.get(reverse("bucket-video-api", kwargs={"bucket": bucket.pk}))
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertNotIn("html_snippet", data["videos"][0])
+        self.assertEqual(data["videos"][0]["thumbnail"], "thumb.jpg")
+        self.assertEqual(data["videos"][0]["title"], video.title)
+        self.assertEqual(render_mock.call_count, 0)
+
+    def test_get_not_modified(self):
+        bucket = BucketFactory(user=self.user)
+        video = VideoFactory(user=self.user, buckets=[bucket])
+        url = reverse("bucket-video-api", kwargs={"bucket": bucket.pk})
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+
+        with mock.patch("subscribae.views.api.queryset_to_json") as json_mock:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(json_mock.call_count, 0)
+
+        # other pages have their own ETags
+        response = self.client.get("{}?after={}".format(url, video.ordering_key), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        # a new video in the bucket
+        VideoFactory(user=self.user, buckets=[bucket])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        etag = response["ETag"]
+
+        # bucket has been edited
+        bucket.title = "new title"
+        bucket.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_get_cached_snippets(self):
+        bucket = BucketFactory(user=self.user)
+        VideoFactory.create_batch(3, user=self.user, buckets=[bucket])
+
+        with mock.patch.object(Video, "render_html_snippet", return_value="<div></div>") as render_mock:
+            self.client.get(reverse("bucket-video-api", kwargs={"bucket": bucket.pk}))
+            self.assertEqual(render_mock.call_count, 3)
+
+            response = self.client.get(reverse("bucket-video-api", kwargs={"bucket": bucket.pk}))
+            self.assertEqual(render_mock.call_count, 3)
+
+        data = json.loads(response.content)
+        self.assertEqual([video["html_snippet"] for video in data["videos"]], ["<div></div>"] * 3)
+
     def test_get_with_start(self):
         bucket = BucketFactory(user=self.user)
         VideoFactory.create_batch(3, user=self.user, buckets=[bucket])
-        videos = list(Video.objects.all().order_by("ordering_key").add_titles())
+        videos = list(Video.objects.all().order_by("ordering_key"))
 
         response = self.client.get("{}?start={}".format(reverse("bucket-video-api",
                                                         kwargs={"bucket": bucket.pk}), videos[1].ordering_key))
@@ -106,8 +315,7 @@ class BucketVideoApiTestCase(TestCase):
         data = json.loads(response.content)
         self.assertEqual(len(data["videos"]), 2)
         self.assertEqual(data, {
-            "next": "{}?after={}".format(reverse("bucket-video-api",
-                                                 kwargs={"bucket": bucket.pk}), videos[2].ordering_key),
+            "next": mock.ANY,
             "videos": [
                 {
                     "id": videos[1].youtube_id,
@@ -115,6 +323,7 @@ class BucketVideoApiTestCase(TestCase):
                     "description": videos[1].description,
                     "published": datetime_to_js_iso(videos[1].published_at),
                     "html_snippet": videos[1].html_snippet,
+                    "thumbnail": videos[1].thumbnail,
                     "ordering_key": videos[1].ordering_key,
                 },
                 {
@@ -123,6 +332,7 @@ class BucketVideoApiTestCase(TestCase):
                     "description": videos[2].description,
                     "published": datetime_to_js_iso(videos[2].published_at),
                     "html_snippet": videos[2].html_snippet,
+                    "thumbnail": videos[2].thumbnail,
                     "ordering_key": videos[2].ordering_key,
                 },
             ],
@@ -131,7 +341,7 @@ class BucketVideoApiTestCase(TestCase):
     def test_get_with_after(self):
         bucket = BucketFactory(user=self.user)
         VideoFactory.create_batch(3, user=self.user, buckets=[bucket])
-        videos = list(Video.objects.all().order_by("ordering_key").add_titles())
+        videos = list(Video.objects.all().order_by("ordering_key"))
 
         response = self.client.get("{}?after={}".format(reverse("bucket-video-api",
                                                         kwargs={"bucket": bucket.pk}), videos[0].ordering_key))
@@ -139,8 +349,7 @@ class BucketVideoApiTestCase(TestCase):
         data = json.loads(response.content)
         self.assertEqual(len(data["videos"]), 2)
         self.assertEqual(data, {
-            "next": "{}?after={}".format(reverse("bucket-video-api",
-                                         kwargs={"bucket": bucket.pk}), videos[2].ordering_key),
+            "next": mock.ANY,
             "videos": [
                 {
                     "id": videos[1].youtube_id,
@@ -148,6 +357,7 @@ class BucketVideoApiTestCase(TestCase):
                     "description": videos[1].description,
                     "published": datetime_to_js_iso(videos[1].published_at),
                     "html_snippet": videos[1].html_snippet,
+                    "thumbnail": videos[1].thumbnail,
                     "ordering_key": videos[1].ordering_key,
                 },
                 {
@@ -156,12 +366,14 @@ class BucketVideoApiTestCase(TestCase):
                     "description": videos[2].description,
                     "published": datetime_to_js_iso(videos[2].published_at),
                     "html_snippet": videos[2].html_snippet,
+                    "thumbnail": videos[2].thumbnail,
                     "ordering_key": videos[2].ordering_key,
                 },
             ],
         })
 
 
+@override_settings(VIEWED_WRITE_BEHIND=False)
 class BucketVideoViewApiTestCase(TestCase):
     def setUp(self):
         super(BucketVideoViewApiTestCase, self).setUp()
@@ -223,6 +435,53 @@ class BucketVideoViewApiTestCase(TestCase):
         self.assertEqual(video.viewed, True)
         self.assertEqual(video.buckets.all()[0].last_watched_video, video.ordering_key)
 
+    def test_post_batch(self):
+        bucket = BucketFactory(user=self.user)
+        VideoFactory.create_batch(5, user=self.user, buckets=[bucket])
+        videos = list(Video.objects.all().order_by("ordering_key"))
+        ids = [videos[3].youtube_id, videos[1].youtube_id, videos[4].youtube_id, videos[1].youtube_id]
+
+        with mock.patch("subscribae.viewed.VIEWED_BATCH_SIZE", 2), \
+                mock.patch.object(transaction, "atomic", wraps=transaction.atomic) as atomic_mock:
+            response = self.client.post(reverse("bucket-video-viewed-api", kwargs={"bucket": bucket.pk}),
+                                        data={"id": ids})
+        self.assertEqual(response.status_code, 200)
+        # three different videos in batches of two
+        self.assertEqual(atomic_mock.call_count, 2)
+
+        bucket.refresh_from_db()
+        self.assertEqual(bucket.last_watched_video, videos[4].ordering_key)
+        self.assertEqual(list(Video.objects.filter(viewed=True).order_by("ordering_key")),
+                         [videos[1], videos[3], videos[4]])
+
+    def test_post_batch_too_many(self):
+        self.user.api_page_limit = 2
+        self.user.save()
+        bucket = BucketFactory(user=self.user)
+        videos = VideoFactory.create_batch(3, user=self.user, buckets=[bucket])
+        url = reverse("bucket-video-viewed-api", kwargs={"bucket": bucket.pk})
+
+        response = self.client.post(url, data={"id": [video.youtube_id for video in videos]})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(Video.objects.filter(viewed=True).count(), 0)
+
+        response = self.client.post(url, data={"id": [video.youtube_id for video in videos[:2]]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Video.objects.filter(viewed=True).count(), 2)
+
+    def test_post_batch_video_not_found(self):
+        bucket = BucketFactory(user=self.user)
+        video = VideoFactory(user=self.user, buckets=[bucket])
+        response = self.client.post(reverse("bucket-video-viewed-api", kwargs={"bucket": bucket.pk}),
+                                    data={"id": [video.youtube_id, "12"]})
+        self.assertEqual(response.status_code, 404)
+
+        # nothing was written
+        video.refresh_from_db()
+        bucket.refresh_from_db()
+        self.assertEqual(video.viewed, False)
+        self.assertEqual(bucket.last_watched_video, "")
+
 
 class SubscriptionVideoApiTestCase(TestCase):
     def setUp(self):
@@ -256,23 +515,39 @@ class SubscriptionVideoApiTestCase(TestCase):
         data = json.loads(response.content)
         self.assertEqual(data, {"videos": []})
 
+    def test_get_not_modified(self):
+        subscription = SubscriptionFactory(user=self.user)
+        video = VideoFactory(user=self.user, subscription=subscription)
+        url = reverse("subscription-video-api", kwargs={"subscription": subscription.pk})
+
+        response = self.client.get(url)
+        etag = response["ETag"]
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # marked as viewed
+        self.client.post(reverse("subscription-video-viewed-api", kwargs={"subscription": subscription.pk}),
+                         {"id": video.youtube_id})
+        apply_viewed_events()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
     def test_get(self):
         subscription = SubscriptionFactory(user=self.user)
         video = VideoFactory(user=self.user, subscription=subscription)
-        video = video.add_titles()
 
         response = self.client.get(reverse("subscription-video-api", kwargs={"subscription": subscription.pk}))
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.content)
         self.assertEqual(data, {
-            "next": "{}?after={}".format(reverse("subscription-video-api",
-                                         kwargs={"subscription": subscription.pk}), video.ordering_key),
+            "next": mock.ANY,
             "videos": [{
                 "id": video.youtube_id,
                 "title": video.title,
                 "description": video.description,
                 "published": datetime_to_js_iso(video.published_at),
                 "html_snippet": video.html_snippet,
+                "thumbnail": video.thumbnail,
                 "ordering_key": video.ordering_key,
             }],
         })
@@ -280,7 +555,7 @@ class SubscriptionVideoApiTestCase(TestCase):
     def test_get_with_start(self):
         subscription = SubscriptionFactory(user=self.user)
         VideoFactory.create_batch(3, user=self.user, subscription=subscription)
-        videos = list(Video.objects.all().order_by("ordering_key").add_titles())
+        videos = list(Video.objects.all().order_by("ordering_key"))
 
         response = self.client.get(
             "{}?start={}".format(reverse("subscription-video-api",
@@ -289,8 +564,7 @@ class SubscriptionVideoApiTestCase(TestCase):
         data = json.loads(response.content)
         self.assertEqual(len(data["videos"]), 2)
         self.assertEqual(data, {
-            "next": "{}?after={}".format(reverse("subscription-video-api",
-                                                 kwargs={"subscription": subscription.pk}), videos[2].ordering_key),
+            "next": mock.ANY,
             "videos": [
                 {
                     "id": videos[1].youtube_id,
@@ -298,6 +572,7 @@ class SubscriptionVideoApiTestCase(TestCase):
                     "description": videos[1].description,
                     "published": datetime_to_js_iso(videos[1].published_at),
                     "html_snippet": videos[1].html_snippet,
+                    "thumbnail": videos[1].thumbnail,
                     "ordering_key": videos[1].ordering_key,
                 },
                 {
@@ -306,6 +581,7 @@ class SubscriptionVideoApiTestCase(TestCase):
                     "description": videos[2].description,
                     "published": datetime_to_js_iso(videos[2].published_at),
                     "html_snippet": videos[2].html_snippet,
+                    "thumbnail": videos[2].thumbnail,
                     "ordering_key": videos[2].ordering_key,
                 },
             ],
@@ -314,7 +590,7 @@ class SubscriptionVideoApiTestCase(TestCase):
     def test_get_with_after(self):
         subscription = SubscriptionFactory(user=self.user)
         VideoFactory.create_batch(3, user=self.user, subscription=subscription)
-        videos = list(Video.objects.all().order_by("ordering_key").add_titles())
+        videos = list(Video.objects.all().order_by("ordering_key"))
 
         response = self.client.get(
             "{}?after={}".format(reverse("subscription-video-api",
@@ -323,8 +599,7 @@ class SubscriptionVideoApiTestCase(TestCase):
         data = json.loads(response.content)
         self.assertEqual(len(data["videos"]), 2)
         self.assertEqual(data, {
-            "next": "{}?after={}".format(reverse("subscription-video-api",
-                                         kwargs={"subscription": subscription.pk}), videos[2].ordering_key),
+            "next": mock.ANY,
             "videos": [
                 {
                     "id": videos[1].youtube_id,
@@ -332,6 +607,7 @@ class SubscriptionVideoApiTestCase(TestCase):
                     "description": videos[1].description,
                     "published": datetime_to_js_iso(videos[1].published_at),
                     "html_snippet": videos[1].html_snippet,
+                    "thumbnail": videos[1].thumbnail,
                     "ordering_key": videos[1].ordering_key,
                 },
                 {
@@ -340,12 +616,14 @@ class SubscriptionVideoApiTestCase(TestCase):
                     "description": videos[2].description,
                     "published": datetime_to_js_iso(videos[2].published_at),
                     "html_snippet": videos[2].html_snippet,
+                    "thumbnail": videos[2].thumbnail,
                     "ordering_key": videos[2].ordering_key,
                 },
             ],
         })
 
 
+@override_settings(VIEWED_WRITE_BEHIND=False)
 class SubscriptionVideoViewApiTestCase(TestCase):
     def setUp(self):
         super(SubscriptionVideoViewApiTestCase, self).setUp()
@@ -393,6 +671,65 @@ class SubscriptionVideoViewApiTestCase(TestCase):
         self.assertEqual(video.viewed, True)
         self.assertEqual(video.subscription.last_watched_video, video.ordering_key)
 
+    def test_post_batch(self):
+        subscription = SubscriptionFactory(user=self.user)
+        VideoFactory.create_batch(3, user=self.user, subscription=subscription)
+        videos = list(Video.objects.all().order_by("ordering_key"))
+
+        response = self.client.post(reverse("subscription-video-viewed-api", kwargs={"subscription": subscription.pk}),
+                                    data={"id": [video.youtube_id for video in reversed(videos)]})
+        self.assertEqual(response.status_code, 200)
+
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.last_watched_video, videos[2].ordering_key)
+        self.assertEqual(Video.objects.filter(viewed=True).count(), 3)
+
+
+class VideoViewWriteBehindApiTestCase(TestCase):
+    def setUp(self):
+        super(VideoViewWriteBehindApiTestCase, self).setUp()
+        self.user = get_user_model().objects.create(username='1', email='test@example.com', is_active=True)
+        gae_login(self.user)
+
+    def tearDown(self):
+        gae_logout()
+        super(VideoViewWriteBehindApiTestCase, self).tearDown()
+
+    @mock.patch("subscribae.viewed.time")
+    def test_post(self, time_mock):
+        time_mock.time.return_value = 1000
+        bucket = BucketFactory(user=self.user)
+        videos = VideoFactory.create_batch(3, user=self.user, buckets=[bucket])
+        videos.sort(key=lambda video: video.ordering_key)
+        url = reverse("bucket-video-viewed-api", kwargs={"bucket": bucket.pk})
+
+        with mock.patch.object(Bucket, "save") as save_mock:
+            for video in videos:
+                response = self.client.post(url, {"id": video.youtube_id})
+                self.assertEqual(response.status_code, 200)
+        # nothing has been written yet
+        self.assertEqual(save_mock.call_count, 0)
+        self.assertEqual(Video.objects.filter(viewed=True).count(), 0)
+        self.assertNumTasksEquals(1)
+
+        # but the bucket page already knows where we are
+        response = self.client.get(reverse("bucket", kwargs={"bucket": bucket.pk}))
+        self.assertEqual(response.context["bucket"].last_watched_video, videos[2].ordering_key)
+
+        with mock.patch.object(Bucket, "save", autospec=True, side_effect=Bucket.save) as save_mock:
+            apply_viewed_events()
+        self.assertEqual(save_mock.call_count, 1)
+
+        bucket.refresh_from_db()
+        self.assertEqual(bucket.last_watched_video, videos[2].ordering_key)
+        self.assertEqual(Video.objects.filter(viewed=True).count(), 3)
+
+    def test_video_not_found(self):
+        bucket = BucketFactory(user=self.user)
+        response = self.client.post(reverse("bucket-video-viewed-api", kwargs={"bucket": bucket.pk}), {"id": "12"})
+        self.assertEqual(response.status_code, 404)
+        self.assertNumTasksEquals(0)
+
 
 class QuerySetToJsonTestCase(TestCase):
     def setUp(self):
@@ -412,14 +749,14 @@ class QuerySetToJsonTestCase(TestCase):
         qs = Video.objects.none()
         result = queryset_to_json(qs, "pk", {"id": "id"})
 
-        self.assertEqual(result, ([], None, None))
+        self.assertEqual(result, ([], None, None, None))
 
     def test_pagination_options(self):
         VideoFactory.create_batch(3)
-        videos = list(Video.objects.all().order_by("pk").add_titles())
+        videos = list(Video.objects.all().order_by("pk"))
 
         qs = Video.objects.all()
-        items, first, last = queryset_to_json(qs, "pk", {"id": "id"})
+        items, first, last, _ = queryset_to_json(qs, "pk", {"id": "id"})
         self.assertEqual(items, [{"id": v.id} for v in videos])
         self.assertEqual(first, videos[0].pk)
         self.assertEqual(last, videos[2].pk)
@@ -429,58 +766,134 @@ class QuerySetToJsonTestCase(TestCase):
         VideoFactory.create_batch(3)
 
         qs = Video.objects.all()
-        items, _, _ = queryset_to_json(qs, "pk", {"id": "id"})
+        items, _, _, _ = queryset_to_json(qs, "pk", {"id": "id"})
         self.assertEqual(len(items), 2)
 
     def test_before(self):
         videos = VideoFactory.create_batch(3)
-        videos = list(Video.objects.all().order_by("pk").add_titles())
+        videos = list(Video.objects.all().order_by("pk"))
 
         qs = Video.objects.all()
-        items, first, last = queryset_to_json(qs, "pk", {"id": "id"}, before=videos[2].pk)
+        items, first, last, _ = queryset_to_json(qs, "pk", {"id": "id"}, before=videos[2].pk)
         self.assertEqual(items, [{"id": v.id} for v in reversed(videos[:2])])
         self.assertEqual(first, videos[1].pk)
         self.assertEqual(last, videos[0].pk)
 
     def test_after(self):
         videos = VideoFactory.create_batch(3)
-        videos = list(Video.objects.all().order_by("pk").add_titles())
+        videos = list(Video.objects.all().order_by("pk"))
 
         qs = Video.objects.all()
-        items, first, last = queryset_to_json(qs, "pk", {"id": "id"}, after=videos[0].pk)
+        items, first, last, _ = queryset_to_json(qs, "pk", {"id": "id"}, after=videos[0].pk)
         self.assertEqual(items, [{"id": v.id} for v in videos[1:]])
         self.assertEqual(first, videos[1].pk)
         self.assertEqual(last, videos[2].pk)
 
     def test_start(self):
         videos = VideoFactory.create_batch(3)
-        videos = list(Video.objects.all().order_by("pk").add_titles())
+        videos = list(Video.objects.all().order_by("pk"))
 
         qs = Video.objects.all()
-        items, first, last = queryset_to_json(qs, "pk", {"id": "id"}, start=videos[1].pk)
+        items, first, last, _ = queryset_to_json(qs, "pk", {"id": "id"}, start=videos[1].pk)
         self.assertEqual(items, [{"id": v.id} for v in videos[1:]])
         self.assertEqual(first, videos[1].pk)
         self.assertEqual(last, videos[2].pk)
 
     def test_end(self):
         videos = VideoFactory.create_batch(3)
-        videos = list(Video.objects.all().order_by("pk").add_titles())
+        videos = list(Video.objects.all().order_by("pk"))
 
         qs = Video.objects.all()
-        items, first, last = queryset_to_json(qs, "pk", {"id": "id"}, end=videos[1].pk)
+        items, first, last, _ = queryset_to_json(qs, "pk", {"id": "id"}, end=videos[1].pk)
         self.assertEqual(items, [{"id": v.id} for v in reversed(videos[:2])])
         self.assertEqual(first, videos[1].pk)
         self.assertEqual(last, videos[0].pk)
 
+    @mock.patch("subscribae.views.api.API_PAGE_SIZE", 2)
+    def test_cursor(self):
+        VideoFactory.create_batch(3)
+        videos = list(Video.objects.all().order_by("pk"))
+
+        qs = Video.objects.all()
+        items, _, _, cursor = queryset_to_json(qs, "pk", {"id": "id"})
+        self.assertEqual(items, [{"id": v.id} for v in videos[:2]])
+        self.assertNotEqual(cursor, None)
+
+        items, first, last, _ = queryset_to_json(qs, "pk", {"id": "id"}, cursor=cursor)
+        self.assertEqual(items, [{"id": videos[2].id}])
+        self.assertEqual(first, videos[2].pk)
+        self.assertEqual(last, videos[2].pk)
+
+        # no cursors for pages that go backwards
+        _, _, _, cursor = queryset_to_json(qs, "pk", {"id": "id"}, before=videos[2].pk)
+        self.assertEqual(cursor, None)
+        with self.assertRaises(TypeError):
+            queryset_to_json(qs, "pk", {"id": "id"}, end=videos[2].pk, cursor="abc")
+
+    def test_limit(self):
+        VideoFactory.create_batch(3)
+
+        qs = Video.objects.all()
+        items, _, _, _ = queryset_to_json(qs, "pk", {"id": "id"}, limit=2)
+        self.assertEqual(len(items), 2)
+
     def test_property_map(self):
-        video = VideoFactory().add_titles()
+        video = VideoFactory()
 
         qs = Video.objects.all()
-        items, _, _ = queryset_to_json(qs, "pk", {"bob": "title"})
+        items, _, _, _ = queryset_to_json(qs, "pk", {"bob": "title"})
 
         self.assertEqual(items[0].keys(), ["bob"])
         self.assertEqual(items[0]["bob"], video.title)
 
+    def test_prefetch(self):
+        VideoFactory.create_batch(3)
+        prefetch = mock.Mock()
+
+        items, _, _, _ = queryset_to_json(Video.objects.all(), "pk", {"id": "id"}, prefetch=prefetch)
+        self.assertEqual(prefetch.call_count, 1)
+        self.assertEqual([obj.id for obj in prefetch.call_args[0][0]], [item["id"] for item in items])
+
+    def test_row_class(self):
+        VideoFactory.create_batch(3, thumbnails={"medium": "thumb.jpg"})
+        ordering_keys = sorted(Video.objects.values_list("ordering_key", flat=True))
+
+        for kwargs in [{}, {"before": ordering_keys[2]}, {"end": ordering_keys[1]}, {"after": ordering_keys[0]}]:
+            objects = queryset_to_json(Video.objects.all(), "ordering_key", VIDEO_JSON_API_MAP, **kwargs)
+            rows = queryset_to_json(Video.objects.all(), "ordering_key", VIDEO_JSON_API_MAP, row_class=VideoRow,
+                                    **kwargs)
+            self.assertEqual(rows[:3], objects[:3])
+
+        items, _, _, _ = rows
+        self.assertEqual([item["thumbnail"] for item in items], ["thumb.jpg"] * 2)
+
+    def test_row_class_benchmark(self):
+        VideoFactory.create_batch(10, thumbnails={"default": "a.jpg", "medium": "b.jpg", "high": "c.jpg"})
+        created = []
+
+        def count_videos(sender, instance, **kwargs):
+            created.append(instance)
+
+        post_init.connect(count_videos, sender=Video)
+        try:
+            objects = queryset_to_json(Video.objects.all(), "ordering_key", VIDEO_JSON_API_MAP)
+            self.assertEqual(len(created), 10)
+            video = created[0]
+
+            rows = queryset_to_json(Video.objects.all(), "ordering_key", VIDEO_JSON_API_MAP, row_class=VideoRow)
+            # no Video objects, so no computed fields or related sets to build
+            self.assertEqual(len(created), 10)
+        finally:
+            post_init.disconnect(count_videos, sender=Video)
+
+        self.assertEqual(rows[:3], objects[:3])
+
+        row = VideoRow(*[getattr(video, name) for name in VideoRow.__slots__])
+        video_size = sys.getsizeof(video) + sys.getsizeof(video.__dict__)
+        row_size = sys.getsizeof(row)
+        self.assertFalse(hasattr(row, "__dict__"))
+        self.assertTrue(row_size * 2 < video_size, (row_size, video_size))
+
     def test_property_map_value_error(self):
         VideoFactory()
 
@@ -492,6 +905,6 @@ class QuerySetToJsonTestCase(TestCase):
         VideoFactory.create_batch(3)
 
         qs = Video.objects.all()
-        forward, _, _ = queryset_to_json(qs, "pk", {"id": "id"})
-        backward, _, _ = queryset_to_json(qs, "-pk", {"id": "id"})
+        forward, _, _, _ = queryset_to_json(qs, "pk", {"id": "id"})
+        backward, _, _, _ = queryset_to_json(qs, "-pk", {"id": "id"})
         self.assertEqual(forward, list(reversed(backward)))
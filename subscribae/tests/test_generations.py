@@ -0,0 +1,59 @@
+##
+#    Copyright (C) 2019  Matt Molyneaux <moggers87+git@moggers87.co.uk>
+#
+#    This file is part of Subscribae.
+#
+#    Subscribae is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Subscribae is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Subscribae.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from djangae.test import TestCase
+from django.core.cache import cache
+
+from subscribae.generations import (BUCKET, SUBSCRIPTION, bump_generations, bump_video_generations, generation_key,
+                                    get_generation)
+from subscribae.tests.utils import BucketFactory, SubscriptionFactory, VideoFactory
+
+
+class GenerationTestCase(TestCase):
+    def test_get_generation(self):
+        generation = get_generation(BUCKET, 123)
+        self.assertEqual(get_generation(BUCKET, 123), generation)
+        self.assertEqual(get_generation(BUCKET, "123"), generation)
+        self.assertNotEqual(get_generation(SUBSCRIPTION, 123), generation)
+
+    def test_evicted(self):
+        generation = get_generation(BUCKET, 123)
+        cache.delete(generation_key(BUCKET, 123))
+        self.assertNotEqual(get_generation(BUCKET, 123), generation)
+
+    def test_bump_generations(self):
+        first = get_generation(BUCKET, 1)
+        second = get_generation(BUCKET, 2)
+        third = get_generation(BUCKET, 3)
+
+        bump_generations(BUCKET, [1, 2])
+        self.assertNotEqual(get_generation(BUCKET, 1), first)
+        self.assertNotEqual(get_generation(BUCKET, 2), second)
+        self.assertEqual(get_generation(BUCKET, 3), third)
+
+    def test_bump_video_generations(self):
+        subscription = SubscriptionFactory()
+        bucket = BucketFactory(subs=[subscription])
+        video = VideoFactory.build(subscription=subscription, buckets=[bucket])
+        bucket_generation = get_generation(BUCKET, bucket.pk)
+        subscription_generation = get_generation(SUBSCRIPTION, subscription.pk)
+
+        bump_video_generations([video])
+        self.assertNotEqual(get_generation(BUCKET, bucket.pk), bucket_generation)
+        self.assertNotEqual(get_generation(SUBSCRIPTION, subscription.pk), subscription_generation)
@@ -17,20 +17,30 @@
 #    along with Subscribae.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
-from datetime import datetime
+from datetime import datetime, timedelta
+import json
 
+from apiclient.errors import HttpError
 from djangae.test import TestCase
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import override_settings
 from django.utils import timezone
+from google.appengine.ext.deferred import deferred
 from google.appengine.runtime import DeadlineExceededError as RuntimeExceededError
 from pytz import UTC
+import httplib2
 import mock
 
+from subscribae.generations import BUCKET, get_generation
 from subscribae.models import OauthToken, Subscription, Video, create_composite_key
+from subscribae.quota import next_reset, quota_ledger
 from subscribae.tests.utils import BucketFactory, MockExecute
-from subscribae.utils import API_MAX_RESULTS, import_videos
+from subscribae.utils import (API_MAX_RESULTS, MISSING_TITLE, SYNC_INTERVAL, VIDEO_TITLE_CACHE_PREFIX, ImportWork,
+                              defer_imports, import_playlists, import_videos, playlist_videos, save_videos)
 
 
+@override_settings(IMPORT_VIDEOS_FROM_PLAYLIST=False)
 class ImportVideoTasksTestCase(TestCase):
     @mock.patch('subscribae.utils.deferred')
     @mock.patch('subscribae.utils.get_service')
@@ -80,17 +90,21 @@ class ImportVideoTasksTestCase(TestCase):
         self.assertEqual(playlistitems_mock.call_args, (
             (),
             {'playlistId': 'upload123', 'part': 'contentDetails',
-             'fields': 'items(contentDetails(videoId))', 'maxResults': API_MAX_RESULTS, 'pageToken': None}
+             'fields': 'etag,items(contentDetails(videoId,videoPublishedAt))', 'maxResults': API_MAX_RESULTS,
+             'pageToken': None}
         ))
         self.assertEqual(videos_mock.call_args, (
             (),
             {'id': 'video123,video456', 'part': 'snippet',
-             'fields': 'items(snippet(publishedAt,thumbnails))', 'maxResults': API_MAX_RESULTS}
+             'fields': 'items(snippet(publishedAt,thumbnails,title,description))', 'maxResults': API_MAX_RESULTS}
         ))
 
         self.assertEqual(Video.objects.count(), 2)
         video1 = Video.objects.get(youtube_id="video123")
         self.assertEqual(video1.published_at, datetime(1997, 7, 16, 19, 20, 30, 450000, tzinfo=UTC))
+        self.assertEqual(video1.title, "my video")
+        self.assertEqual(video1.description, "this is my video")
+        self.assertNotEqual(video1.titles_updated, None)
         self.assertEqual(video1.ordering_key,
                          create_composite_key(str(datetime(1997, 7, 16, 19, 20, 30, 450000, tzinfo=UTC)), "video123"))
         video2 = Video.objects.get(youtube_id="video456")
@@ -121,10 +135,10 @@ class ImportVideoTasksTestCase(TestCase):
         self.assertEqual(playlistitems_mock.call_count, 2)
 
         self.assertEqual(playlistitems_mock.call_args_list, [
-            ((), {'part': 'contentDetails', 'fields': 'items(contentDetails(videoId))', 'playlistId': 'upload123',
-                  'maxResults': API_MAX_RESULTS, 'pageToken': None}),
-            ((), {'part': 'contentDetails', 'fields': 'items(contentDetails(videoId))', 'playlistId': 'upload123',
-                  'maxResults': API_MAX_RESULTS, 'pageToken': '123'}),
+            ((), {'part': 'contentDetails', 'fields': 'etag,items(contentDetails(videoId,videoPublishedAt))',
+                  'playlistId': 'upload123', 'maxResults': API_MAX_RESULTS, 'pageToken': None}),
+            ((), {'part': 'contentDetails', 'fields': 'etag,items(contentDetails(videoId,videoPublishedAt))',
+                  'playlistId': 'upload123', 'maxResults': API_MAX_RESULTS, 'pageToken': '123'}),
         ])
 
     @mock.patch('subscribae.utils.deferred')
@@ -149,8 +163,8 @@ class ImportVideoTasksTestCase(TestCase):
         self.assertEqual(playlistitems_mock.call_count, 2)
         self.assertEqual(defer_mock.defer.call_count, 1)
         self.assertEqual(defer_mock.defer.call_args, (
-            (import_videos, user.id, subscription.id, "upload123", [bucket.id]),
-            {"page_token": "123", "only_first_page": False},
+            (import_playlists, user.id, [ImportWork(subscription.id, "upload123", [bucket.id], "123", False, None)]),
+            {},
         ))
 
     @mock.patch('subscribae.utils.get_service')
@@ -176,7 +190,8 @@ class ImportVideoTasksTestCase(TestCase):
         self.assertEqual(playlistitems_mock.call_count, 1)
 
         self.assertEqual(playlistitems_mock.call_args_list, [
-            ((), {'part': 'contentDetails', 'playlistId': 'upload123', 'fields': 'items(contentDetails(videoId))',
+            ((), {'part': 'contentDetails', 'playlistId': 'upload123',
+                  'fields': 'etag,items(contentDetails(videoId,videoPublishedAt))',
                   'maxResults': API_MAX_RESULTS, 'pageToken': None}),
         ])
 
@@ -242,12 +257,13 @@ class ImportVideoTasksTestCase(TestCase):
         self.assertEqual(playlistitems_mock.call_args, (
             (),
             {'playlistId': 'upload123', 'part': 'contentDetails',
-             'fields': 'items(contentDetails(videoId))', 'maxResults': API_MAX_RESULTS, 'pageToken': None}
+             'fields': 'etag,items(contentDetails(videoId,videoPublishedAt))', 'maxResults': API_MAX_RESULTS,
+             'pageToken': None}
         ))
         self.assertEqual(videos_mock.call_args, (
             (),
             {'id': 'video123,video456', 'part': 'snippet',
-             'fields': 'items(snippet(publishedAt,thumbnails))', 'maxResults': API_MAX_RESULTS}
+             'fields': 'items(snippet(publishedAt,thumbnails,title,description))', 'maxResults': API_MAX_RESULTS}
         ))
 
         self.assertEqual(Video.objects.count(), 2)
@@ -261,9 +277,390 @@ class ImportVideoTasksTestCase(TestCase):
                             create_composite_key(str(datetime(1997, 7, 16, 19, 20, 30, 450000, tzinfo=UTC)),
                                                  "video456"))
 
+    @mock.patch('subscribae.utils.get_service')
+    def test_import_videos_watermark(self, service_mock):
+        playlistitems_mock = service_mock.return_value.playlistItems.return_value.list
+        videos_mock = service_mock.return_value.videos.return_value.list
+
+        playlistitems_mock.return_value.execute.return_value = {
+            'items': [
+                {'contentDetails': {'videoId': 'video123', 'videoPublishedAt': '1997-07-16T19:20:30.45Z'}},
+                {'contentDetails': {'videoId': 'video456', 'videoPublishedAt': '1997-07-15T19:20:30.45Z'}},
+            ],
+            'nextPageToken': '123',
+        }
+        videos_mock.return_value.execute.return_value = {
+            'items': [
+                {
+                    'id': 'video123',
+                    'snippet': {
+                        'thumbnails': {},
+                        'publishedAt': '1997-07-16T19:20:30.45Z',
+                    },
+                },
+            ],
+        }
+
+        user = get_user_model().objects.create(username='1')
+        OauthToken.objects.create(user=user, data={})
+        subscription = Subscription.objects.create(user=user, channel_id="123", last_update=timezone.now())
+
+        watermark = datetime(1997, 7, 15, 19, 20, 30, 450000, tzinfo=UTC)
+        import_videos(user.id, subscription.id, "upload123", [], watermark=watermark)
+        # stopped at the watermark, even though there's another page
+        self.assertEqual(playlistitems_mock.call_count, 1)
+        self.assertEqual(videos_mock.call_count, 1)
+        self.assertEqual(videos_mock.call_args[1]['id'], 'video123')
+        self.assertEqual(Video.objects.count(), 1)
+
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.head_video_id, 'video123')
+        self.assertEqual(subscription.last_video_published_at, datetime(1997, 7, 16, 19, 20, 30, 450000, tzinfo=UTC))
+
+        # nothing new on the first page
+        import_videos(user.id, subscription.id, "upload123", [], watermark=subscription.last_video_published_at)
+        self.assertEqual(playlistitems_mock.call_count, 2)
+        self.assertEqual(videos_mock.call_count, 1)
+
+    @mock.patch('subscribae.utils.get_service')
+    def test_import_videos_missing(self, service_mock):
+        playlistitems_mock = service_mock.return_value.playlistItems.return_value.list
+        videos_mock = service_mock.return_value.videos.return_value.list
+
+        playlistitems_mock.return_value.execute.return_value = {
+            'items': [
+                {'contentDetails': {'videoId': 'video123'}},
+                {'contentDetails': {'videoId': 'private'}},
+            ],
+        }
+        videos_mock.return_value.execute.return_value = {
+            'items': [{'id': 'video123', 'snippet': {'thumbnails': {}, 'publishedAt': '1997-07-16T19:20:30.45Z'}}],
+        }
+
+        user = get_user_model().objects.create(username='1')
+        OauthToken.objects.create(user=user, data={})
+        subscription = Subscription.objects.create(user=user, channel_id="123", last_update=timezone.now())
+
+        import_videos(user.id, subscription.id, "upload123", [])
+        self.assertEqual(videos_mock.call_args[1]['id'], 'video123,private')
+        self.assertEqual(cache.get(VIDEO_TITLE_CACHE_PREFIX + "private"), MISSING_TITLE)
+
+        # next time around, we don't ask about the private video
+        Video.objects.all().delete()
+        import_videos(user.id, subscription.id, "upload123", [])
+        self.assertEqual(videos_mock.call_args[1]['id'], 'video123')
+
     def test_missing_oauth_token(self):
         user = get_user_model().objects.create(username='1')
         subscription = Subscription.objects.create(user=user, channel_id="123", last_update=timezone.now())
         bucket = BucketFactory(user=user, subs=[subscription])
 
         import_videos(user.id, subscription.id, "upload123", [bucket.id])
+
+
+class ImportPlaylistsTestCase(TestCase):
+    def setUp(self):
+        super(ImportPlaylistsTestCase, self).setUp()
+        self.service_patch = mock.patch('subscribae.utils.get_service')
+        self.service_mock = self.service_patch.start()
+        self.playlistitems_mock = self.service_mock.return_value.playlistItems.return_value.list
+        self.playlistitems_mock.return_value.execute.return_value = {'items': []}
+
+        self.user = get_user_model().objects.create(username='1')
+        OauthToken.objects.create(user=self.user, data={})
+        self.work = []
+        for i in range(3):
+            subscription = Subscription.objects.create(user=self.user, channel_id=str(i), last_update=timezone.now())
+            self.work.append(ImportWork(subscription.pk, "upload%s" % i, [], "abc", False, None))
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def test_import_playlists(self):
+        import_playlists(self.user.id, self.work)
+        # one service for all of the playlists
+        self.assertEqual(self.service_mock.call_count, 1)
+        self.assertEqual([call[1]['playlistId'] for call in self.playlistitems_mock.call_args_list],
+                         ["upload0", "upload1", "upload2"])
+        self.assertNumTasksEquals(0)
+
+    @mock.patch('subscribae.utils.deferred')
+    @mock.patch('subscribae.utils.time')
+    def test_import_playlists_out_of_time(self, time_mock, defer_mock):
+        # the task starts, the first playlist gets imported and then we're out of time
+        time_mock.time.side_effect = [0, 0, 60 * 60]
+        self.playlistitems_mock.return_value.execute = MockExecute([
+            {'items': [], 'nextPageToken': 'def'},
+            {'items': []},
+        ])
+
+        import_playlists(self.user.id, self.work)
+        self.assertEqual(self.playlistitems_mock.call_count, 1)
+        self.assertEqual(defer_mock.defer.call_count, 1)
+        self.assertEqual(defer_mock.defer.call_args, (
+            (import_playlists, self.user.id, [self.work[0]._replace(page_token="def")] + self.work[1:]),
+            {},
+        ))
+
+    @mock.patch('subscribae.utils.deferred')
+    def test_import_playlists_runtime_exceeded(self, defer_mock):
+        self.playlistitems_mock.return_value.execute = MockExecute([{'items': []}, RuntimeExceededError()])
+
+        import_playlists(self.user.id, self.work)
+        self.assertEqual(defer_mock.defer.call_count, 1)
+        self.assertEqual(defer_mock.defer.call_args, ((import_playlists, self.user.id, self.work[1:]), {}))
+
+    @mock.patch('subscribae.quota.random')
+    @mock.patch('subscribae.utils.deferred')
+    def test_import_playlists_quota(self, defer_mock, random_mock):
+        random_mock.uniform.return_value = 60
+        error = HttpError(httplib2.Response({"status": 403}),
+                          json.dumps({"error": {"errors": [{"reason": "quotaExceeded"}]}}))
+        self.playlistitems_mock.return_value.execute = MockExecute([{'items': []}, error])
+
+        import_playlists(self.user.id, self.work)
+        self.assertEqual(quota_ledger.remaining(), 0)
+        self.assertEqual(defer_mock.defer.call_count, 1)
+        self.assertEqual(defer_mock.defer.call_args, (
+            (import_playlists, self.user.id, self.work[1:]),
+            {"_eta": next_reset() + timedelta(seconds=60)},
+        ))
+
+    @mock.patch('subscribae.utils.sync_user_count', return_value=100)
+    @mock.patch('subscribae.utils.deferred')
+    def test_import_playlists_share(self, defer_mock, count_mock):
+        def other_tasks(*args, **kwargs):
+            # other tasks are spending quota too
+            quota_ledger.charge("", 50)
+            return {'items': [], 'nextPageToken': 'def'}
+        self.playlistitems_mock.return_value.execute.side_effect = other_tasks
+
+        # a share of 100 units at 1 unit a page, only this task's spending counts
+        import_playlists(self.user.id, self.work[:1])
+        self.assertEqual(self.playlistitems_mock.call_count, 100)
+        self.assertEqual(defer_mock.defer.call_args_list, [
+            ((import_playlists, self.user.id, [self.work[0]._replace(page_token="def")]),
+             {"_countdown": SYNC_INTERVAL.total_seconds()}),
+        ])
+
+    @mock.patch('subscribae.utils.deferred')
+    def test_import_playlists_broken_playlist(self, defer_mock):
+        error = HttpError(httplib2.Response({"status": 500}), "")
+        self.playlistitems_mock.return_value.execute = MockExecute([error, {'items': []}, {'items': []}])
+
+        import_playlists(self.user.id, self.work)
+        self.assertEqual(self.playlistitems_mock.call_count, 3)
+        # the broken playlist is split off into its own task
+        self.assertEqual(defer_mock.defer.call_args_list, [((import_playlists, self.user.id, self.work[:1]), {})])
+
+        # on its own, it just fails
+        self.playlistitems_mock.return_value.execute = MockExecute([error])
+        with self.assertRaises(HttpError):
+            import_playlists(self.user.id, self.work[:1])
+
+    @mock.patch('subscribae.utils.deferred')
+    def test_import_playlists_missing_playlist(self, defer_mock):
+        error = HttpError(httplib2.Response({"status": 404}), "")
+        self.playlistitems_mock.return_value.execute = MockExecute([error, {'items': []}, {'items': []}])
+
+        import_playlists(self.user.id, self.work)
+        self.assertEqual(self.playlistitems_mock.call_count, 3)
+        # no point trying again
+        self.assertEqual(defer_mock.defer.call_count, 0)
+
+        # even on its own
+        self.playlistitems_mock.return_value.execute = MockExecute([error])
+        import_playlists(self.user.id, self.work[:1])
+        self.assertEqual(defer_mock.defer.call_count, 0)
+
+    @override_settings(IMPORT_TASK_BATCH_SIZE=2)
+    @mock.patch('subscribae.utils.deferred')
+    def test_defer_imports(self, defer_mock):
+        defer_imports(self.user.id, self.work)
+        self.assertEqual(defer_mock.defer.call_args_list, [
+            ((import_playlists, self.user.id, self.work[:2]), {}),
+            ((import_playlists, self.user.id, self.work[2:]), {}),
+        ])
+
+    @override_settings(IMPORT_TASK_BATCH_SIZE=20)
+    def test_benchmark(self):
+        # compare with the old way of doing things: one task per playlist
+        work = self.work * 10
+        for item in work:
+            deferred.defer(import_videos, self.user.id, item.subscription_id, item.playlist, item.bucket_ids,
+                           page_token=item.page_token)
+        self.assertNumTasksEquals(30)
+        self.process_task_queues()
+        self.assertEqual(self.service_mock.call_count, 30)
+        self.assertEqual(self.playlistitems_mock.call_count, 30)
+
+        self.service_mock.reset_mock()
+        defer_imports(self.user.id, work)
+        self.assertNumTasksEquals(2)
+        self.process_task_queues()
+        self.assertEqual(self.service_mock.call_count, 2)
+        self.assertEqual(self.playlistitems_mock.call_count, 30)
+
+
+class ImportFromPlaylistTestCase(TestCase):
+    def setUp(self):
+        super(ImportFromPlaylistTestCase, self).setUp()
+        self.service_patch = mock.patch('subscribae.utils.get_service')
+        self.service_mock = self.service_patch.start()
+        self.playlistitems_mock = self.service_mock.return_value.playlistItems.return_value.list
+        self.videos_mock = self.service_mock.return_value.videos.return_value.list
+
+        self.playlist_page = {
+            'items': [
+                {
+                    'snippet': {'title': 'my video', 'description': 'this is my video', 'thumbnails': {}},
+                    'contentDetails': {'videoId': 'video123', 'videoPublishedAt': '1997-07-16T19:20:30.45Z'},
+                },
+                {
+                    'snippet': {'title': 'Private video', 'description': 'This video is private.', 'thumbnails': {}},
+                    'contentDetails': {'videoId': 'private'},
+                },
+            ],
+        }
+        self.video_list = {
+            'items': [{
+                'id': 'video123',
+                'snippet': {'title': 'my video', 'description': 'this is my video', 'thumbnails': {},
+                            'publishedAt': '1997-07-16T19:20:30.45Z'},
+            }],
+        }
+        self.playlistitems_mock.return_value.execute.return_value = self.playlist_page
+        self.videos_mock.return_value.execute.return_value = self.video_list
+
+        self.user = get_user_model().objects.create(username='1')
+        OauthToken.objects.create(user=self.user, data={})
+        self.subscription = Subscription.objects.create(user=self.user, channel_id="123", last_update=timezone.now())
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def test_playlist_videos(self):
+        self.assertEqual(playlist_videos(self.playlist_page, ['video123', 'private']), self.video_list)
+        self.assertEqual(playlist_videos(self.playlist_page, []), {'items': []})
+
+    def test_import_videos(self):
+        import_videos(self.user.id, self.subscription.id, "upload123", [])
+        self.assertEqual(self.playlistitems_mock.call_count, 1)
+        self.assertEqual(self.videos_mock.call_count, 0)
+        self.assertEqual(self.playlistitems_mock.call_args, (
+            (),
+            {'playlistId': 'upload123', 'part': 'snippet,contentDetails',
+             'fields': 'etag,items(snippet(thumbnails,title,description),contentDetails(videoId,videoPublishedAt))',
+             'maxResults': API_MAX_RESULTS, 'pageToken': None}
+        ))
+
+        video = Video.objects.get()
+        self.assertEqual(video.youtube_id, "video123")
+        self.assertEqual(video.published_at, datetime(1997, 7, 16, 19, 20, 30, 450000, tzinfo=UTC))
+        self.assertEqual((video.title, video.description), ("my video", "this is my video"))
+
+        # titles were cached while we were at it
+        cached = cache.get(VIDEO_TITLE_CACHE_PREFIX + "video123")
+        self.assertEqual((cached["title"], cached["description"]), ("my video", "this is my video"))
+        self.assertEqual(cache.get(VIDEO_TITLE_CACHE_PREFIX + "private"), MISSING_TITLE)
+
+    def test_benchmark(self):
+        # compare with fetching video details from videos().list
+        pages = []
+        video_lists = []
+        for i in range(5):
+            video_id = 'video%s' % i
+            published = '1997-07-1%sT19:20:30.45Z' % i
+            pages.append({
+                'items': [{
+                    'snippet': {'title': 'video', 'description': '', 'thumbnails': {}},
+                    'contentDetails': {'videoId': video_id, 'videoPublishedAt': published},
+                }],
+                'nextPageToken': 'abc',
+            })
+            video_lists.append({
+                'items': [{
+                    'id': video_id,
+                    'snippet': {'title': 'video', 'description': '', 'thumbnails': {}, 'publishedAt': published},
+                }],
+            })
+        del pages[-1]['nextPageToken']
+        work = [ImportWork(self.subscription.pk, "upload123", [], None, False, None)]
+
+        with override_settings(IMPORT_VIDEOS_FROM_PLAYLIST=False):
+            self.playlistitems_mock.return_value.execute = MockExecute(pages)
+            self.videos_mock.return_value.execute = MockExecute(video_lists)
+            import_playlists(self.user.id, work)
+        self.assertEqual(Video.objects.count(), 5)
+        self.assertEqual(self.playlistitems_mock.call_count + self.videos_mock.call_count, 10)
+        two_call_videos = sorted(Video.objects.values_list("youtube_id", "published_at", "title"))
+
+        Video.objects.all().delete()
+        cache.clear()
+        self.service_mock.reset_mock()
+        self.playlistitems_mock.return_value.execute = MockExecute(pages)
+        import_playlists(self.user.id, work)
+        self.assertEqual(Video.objects.count(), 5)
+        self.assertEqual(self.playlistitems_mock.call_count + self.videos_mock.call_count, 5)
+        # same videos, half the API calls
+        self.assertEqual(sorted(Video.objects.values_list("youtube_id", "published_at", "title")), two_call_videos)
+
+
+class SaveVideosTestCase(TestCase):
+    def setUp(self):
+        super(SaveVideosTestCase, self).setUp()
+        self.user = get_user_model().objects.create(username='1')
+        self.subscription = Subscription.objects.create(user=self.user, channel_id="123", last_update=timezone.now())
+        self.video_list = {
+            'items': [
+                {
+                    'id': 'video123',
+                    'snippet': {'thumbnails': {}, 'publishedAt': '1997-07-16T19:20:30.45Z'},
+                },
+                {
+                    'id': 'video456',
+                    'snippet': {'thumbnails': {}, 'publishedAt': '1997-07-17T19:20:30.45Z'},
+                },
+                {
+                    'id': 'video789',
+                    'snippet': {'thumbnails': {}, 'publishedAt': '1997-07-18T19:20:30.45Z'},
+                },
+            ],
+        }
+
+    def test_save_videos(self):
+        bucket = BucketFactory(user=self.user, subs=[self.subscription])
+        generation = get_generation(BUCKET, bucket.id)
+        result = save_videos(self.user.id, self.subscription.id, [bucket.id], ['video123', 'video456'],
+                             self.video_list)
+        # API responses for the bucket have changed
+        self.assertNotEqual(get_generation(BUCKET, bucket.id), generation)
+        self.assertEqual(result, (2, 0, datetime(1997, 7, 17, 19, 20, 30, 450000, tzinfo=UTC)))
+
+        self.assertEqual(Video.objects.count(), 2)
+        video = Video.objects.get(youtube_id="video456")
+        self.assertEqual(video.id, create_composite_key(str(self.user.id), "video456"))
+        self.assertEqual(video.subscription_id, self.subscription.id)
+        self.assertEqual(video.buckets_ids, {bucket.id})
+        self.assertEqual(video.viewed, False)
+
+    def test_save_videos_seen(self):
+        Video.objects.create(user=self.user, subscription=self.subscription, youtube_id="video456",
+                             published_at=timezone.now(), viewed=True)
+
+        result = save_videos(self.user.id, self.subscription.id, [], ['video123', 'video456', 'video789'],
+                             self.video_list)
+        self.assertEqual(result, (2, 1, datetime(1997, 7, 18, 19, 20, 30, 450000, tzinfo=UTC)))
+
+        self.assertEqual(Video.objects.count(), 3)
+        # existing videos aren't overwritten
+        self.assertEqual(Video.objects.get(youtube_id="video456").viewed, True)
+
+    def test_save_videos_all_seen(self):
+        save_videos(self.user.id, self.subscription.id, [], ['video123'], self.video_list)
+        result = save_videos(self.user.id, self.subscription.id, [], ['video123'], self.video_list)
+        self.assertEqual(result, (0, 1, None))
+
+    def test_save_videos_empty(self):
+        result = save_videos(self.user.id, self.subscription.id, [], [], {'items': []})
+        self.assertEqual(result, (0, 0, None))
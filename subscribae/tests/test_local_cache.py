@@ -0,0 +1,158 @@
+##
+#    Copyright (C) 2019  Matt Molyneaux <moggers87+git@moggers87.co.uk>
+#
+#    This file is part of Subscribae.
+#
+#    Subscribae is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Subscribae is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Subscribae.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from djangae.test import TestCase
+from django.core.cache import cache
+import mock
+
+from subscribae.local_cache import LocalCache, TieredCache
+from subscribae.models import OauthToken
+from subscribae.tests.utils import UserFactory
+from subscribae.utils import get_oauth_token
+
+
+class LocalCacheTestCase(TestCase):
+    def test_get_set(self):
+        local = LocalCache(1024)
+        self.assertEqual(local.get("key"), (False, None))
+
+        value = {"title": "henlo"}
+        local.set("key", value)
+        value["title"] = "changed"
+        self.assertEqual(local.get("key"), (True, {"title": "henlo"}))
+
+        local.delete("key")
+        self.assertEqual(local.get("key"), (False, None))
+        self.assertEqual(local.size, 0)
+
+    def test_timeout(self):
+        local = LocalCache(1024, timeout=60)
+        local.set("short", 1, timeout=10, now=100)
+        local.set("long", 2, timeout=600, now=100)
+
+        self.assertEqual(local.get("short", now=105), (True, 1))
+        self.assertEqual(local.get("short", now=111), (False, None))
+        # can't be kept for longer than the local timeout
+        self.assertEqual(local.get("long", now=159), (True, 2))
+        self.assertEqual(local.get("long", now=161), (False, None))
+
+    def test_least_recently_used(self):
+        local = LocalCache(1024)
+        local.set("a", "x" * 300)
+        local.set("b", "x" * 300)
+        local.set("c", "x" * 300)
+        local.get("a")
+        local.set("d", "x" * 300)
+
+        self.assertTrue(local.get("a")[0])
+        self.assertFalse(local.get("b")[0])
+        self.assertTrue(local.get("c")[0])
+        self.assertTrue(local.get("d")[0])
+        self.assertTrue(local.size <= 1024)
+
+    def test_too_big(self):
+        local = LocalCache(100)
+        local.set("a", "small")
+        local.set("a", "x" * 200)
+
+        self.assertEqual(local.get("a"), (False, None))
+        self.assertEqual(local.size, 0)
+
+
+class TieredCacheTestCase(TestCase):
+    def test_tiers(self):
+        tiered = TieredCache(max_bytes=1024)
+        cache.set("key", "value")
+
+        with mock.patch("subscribae.local_cache.cache", wraps=cache) as cache_mock:
+            self.assertEqual(tiered.get("key"), "value")
+            self.assertEqual(tiered.get("key"), "value")
+            self.assertEqual(tiered.get("other"), None)
+
+        self.assertEqual(cache_mock.get_many.call_count, 2)
+        self.assertEqual(tiered.stats(), {
+            "local_hits": 1,
+            "local_misses": 2,
+            "local_hit_ratio": 1 / 3.0,
+            "remote_hits": 1,
+            "remote_misses": 1,
+            "remote_hit_ratio": 0.5,
+        })
+
+        tiered.reset_stats()
+        self.assertEqual(tiered.stats()["local_hits"], 0)
+
+    def test_set_and_delete(self):
+        tiered = TieredCache(max_bytes=1024)
+        tiered.set_many({"a": 1, "b": 2})
+        self.assertEqual(cache.get_many(["a", "b"]), {"a": 1, "b": 2})
+        self.assertEqual(tiered.get_many(["a", "b"]), {"a": 1, "b": 2})
+        self.assertEqual(tiered.stats()["local_hits"], 2)
+
+        tiered.delete("a")
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(tiered.get("a"), None)
+
+    def test_disabled(self):
+        tiered = TieredCache(max_bytes=0)
+        tiered.set("key", "value")
+        self.assertEqual(tiered.local.size, 0)
+
+        cache.set("key", "changed")
+        self.assertEqual(tiered.get("key"), "changed")
+        self.assertEqual(tiered.stats()["local_misses"], 0)
+        self.assertEqual(tiered.stats()["remote_hits"], 1)
+
+
+class OauthTokenCacheTestCase(TestCase):
+    def test_get_oauth_token(self):
+        user = UserFactory()
+        OauthToken.objects.create(user=user, data={"token": "abc"})
+
+        token = get_oauth_token(user.id)
+        self.assertEqual(token.data, {"token": "abc"})
+
+        with mock.patch("subscribae.models.OauthToken.objects") as objects_mock:
+            token = get_oauth_token(user.id)
+        self.assertEqual(objects_mock.get.call_count, 0)
+        self.assertEqual(token.user_id, user.id)
+        self.assertEqual(token.data, {"token": "abc"})
+
+    def test_not_kept_locally(self):
+        user = UserFactory()
+        OauthToken.objects.create(user=user, data={"token": "abc"})
+
+        with mock.patch("subscribae.utils.tiered_cache") as tiered_mock:
+            get_oauth_token(user.id)
+            get_oauth_token(user.id)
+        self.assertEqual(tiered_mock.method_calls, [])
+        self.assertEqual(cache.get(OauthToken.cache_key(user.id)), {"token": "abc"})
+
+    def test_invalidated_on_save(self):
+        user = UserFactory()
+        token = OauthToken.objects.create(user=user, data={"token": "abc"})
+        get_oauth_token(user.id)
+
+        token.data = {"token": "def"}
+        token.save()
+        self.assertEqual(get_oauth_token(user.id).data, {"token": "def"})
+
+        token.delete()
+        with self.assertRaises(OauthToken.DoesNotExist):
+            get_oauth_token(user.id)
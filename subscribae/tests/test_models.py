@@ -23,7 +23,7 @@ from djangae.test import TestCase
 from pytz import UTC
 import mock
 
-from subscribae.models import Bucket, SiteConfig, Subscription, Video, create_composite_key
+from subscribae.models import Bucket, SiteConfig, Video, create_composite_key, prefetch_html_snippets
 from subscribae.tests.utils import BucketFactory, SubscriptionFactory, UserFactory, VideoFactory
 
 
@@ -101,128 +101,28 @@ class ModelTestCase(TestCase):
         self.assertEqual(len(videos2), 1)
         self.assertEqual(videos2[0], video)
 
-
-class AddTitlesSubscriptionTestCase(TestCase):
-    def setUp(self):
-        super(AddTitlesSubscriptionTestCase, self).setUp()
-
-        self.service_patch = mock.patch('subscribae.utils.get_service')
-        self.service_mock = self.service_patch.start()
-
-        self.channel_mock = self.service_mock.return_value.channels.return_value.list
-
-        self.channel_mock.return_value.execute.return_value = {
-            'items': [
-                {
-                    'id': '123',
-                    'snippet': {
-                        "title": "henlo",
-                        "description": "bluh bluh",
-                    },
-                },
-                {
-                    'id': '456',
-                    'snippet': {
-                        "title": "bye-q",
-                        "description": "blah blah",
-                    },
-                },
-            ],
-        }
-
-    def tearDown(self):
-        mock.patch.stopall()
-
-    def test_model_method(self):
-        sub = SubscriptionFactory(channel_id="123")
-        with self.assertRaises(AttributeError):
-            sub.title
-        with self.assertRaises(AttributeError):
-            sub.description
-
-        sub.add_titles()
-
-        self.assertEqual(sub.title, "henlo")
-        self.assertEqual(sub.description, "bluh bluh")
-
-    def test_queryset_method(self):
-        SubscriptionFactory(channel_id="123")
-        SubscriptionFactory(channel_id="456")
-
-        subs = Subscription.objects.all()
-        for obj in subs:
-            with self.assertRaises(AttributeError):
-                obj.title
-            with self.assertRaises(AttributeError):
-                obj.description
-
-        titled_subs = subs.add_titles()
-        for obj in titled_subs:
-            self.assertNotEqual(obj.title, None)
-            self.assertNotEqual(obj.description, None)
-
-    def test_empty_queryset_method(self):
-        Subscription.objects.all().add_titles()
-
-
-class AddTitlesVideoTestCase(TestCase):
-    def setUp(self):
-        super(AddTitlesVideoTestCase, self).setUp()
-
-        self.service_patch = mock.patch('subscribae.utils.get_service')
-        self.service_mock = self.service_patch.start()
-
-        self.video_mock = self.service_mock.return_value.videos.return_value.list
-
-        self.video_mock.return_value.execute.return_value = {
-            'items': [
-                {
-                    'id': '123',
-                    'snippet': {
-                        "title": "henlo",
-                        "description": "bluh bluh",
-                    },
-                },
-                {
-                    'id': '456',
-                    'snippet': {
-                        "title": "bye-q",
-                        "description": "blah blah",
-                    },
-                },
-            ],
-        }
-
-    def tearDown(self):
-        mock.patch.stopall()
-
-    def test_model_method(self):
-        vid = VideoFactory(youtube_id="123")
-        with self.assertRaises(AttributeError):
-            vid.title
-        with self.assertRaises(AttributeError):
-            vid.description
-
-        vid.add_titles()
-
-        self.assertEqual(vid.title, "henlo")
-        self.assertEqual(vid.description, "bluh bluh")
-
-    def test_queryset_method(self):
-        VideoFactory(youtube_id="123")
-        VideoFactory(youtube_id="456")
-
-        vids = Video.objects.all()
-        for obj in vids:
-            with self.assertRaises(AttributeError):
-                obj.title
-            with self.assertRaises(AttributeError):
-                obj.description
-
-        titled_vids = vids.add_titles()
-        for obj in titled_vids:
-            self.assertNotEqual(obj.title, None)
-            self.assertNotEqual(obj.description, None)
-
-    def test_empty_queryset_method(self):
-        Video.objects.all().add_titles()
+    def test_html_snippet_cache_key(self):
+        video = VideoFactory(title="henlo", thumbnails={"medium": "thumb.jpg"})
+        key = video.html_snippet_cache_key()
+        self.assertEqual(key, video.html_snippet_cache_key())
+
+        video.title = "bye"
+        self.assertNotEqual(key, video.html_snippet_cache_key())
+        video.title = "henlo"
+        video.thumbnails = {"medium": "other.jpg"}
+        self.assertNotEqual(key, video.html_snippet_cache_key())
+
+    def test_prefetch_html_snippets(self):
+        VideoFactory.create_batch(2)
+
+        videos = list(Video.objects.all())
+        prefetch_html_snippets(videos)
+        self.assertEqual([video.html_snippet for video in videos],
+                         [video.render_html_snippet() for video in videos])
+
+        videos = list(Video.objects.all())
+        with mock.patch.object(Video, "render_html_snippet") as render_mock:
+            prefetch_html_snippets(videos)
+            snippets = [video.html_snippet for video in videos]
+        self.assertEqual(render_mock.call_count, 0)
+        self.assertEqual(snippets, [video.render_html_snippet() for video in videos])
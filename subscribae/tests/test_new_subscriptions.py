@@ -17,15 +17,24 @@
 #    along with Subscribae.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+from datetime import datetime
+
+from apiclient.errors import HttpError
 from djangae.test import TestCase
+from django.test import override_settings
+from django.utils import timezone
 from google.appengine.runtime import DeadlineExceededError as RuntimeExceededError
+from pytz import UTC
+import httplib2
 import mock
 
-from subscribae.models import OauthToken, Subscription
-from subscribae.tests.utils import MockExecute, UserFactory
-from subscribae.utils import API_MAX_RESULTS, subscriptions
+from subscribae.models import OauthToken, Subscription, SubscriptionListPage, Video
+from subscribae.tests.utils import MockExecute, UserFactory, fake_batch_execute
+from subscribae.utils import (API_MAX_PAGE_SIZE, API_MAX_RESULTS, ImportWork, derive_upload_playlist,
+                              get_upload_playlists, import_playlists, subscriptions)
 
 
+@override_settings(IMPORT_VIDEOS_FROM_PLAYLIST=False)
 class NewSubscriptionTestCase(TestCase):
     def setUp(self):
         super(NewSubscriptionTestCase, self).setUp()
@@ -33,8 +42,13 @@ class NewSubscriptionTestCase(TestCase):
         self.service_patch = mock.patch('subscribae.utils.get_service')
         self.service_mock = self.service_patch.start()
 
+        self.batch_patch = mock.patch('subscribae.utils.batch_execute', side_effect=fake_batch_execute)
+        self.batch_mock = self.batch_patch.start()
+
         self.subscription_mock = self.service_mock.return_value.subscriptions.return_value.list
         self.channel_mock = self.service_mock.return_value.channels.return_value.list
+        self.playlistitems_mock = self.service_mock.return_value.playlistItems.return_value.list
+        self.videos_mock = self.service_mock.return_value.videos.return_value.list
 
         self.subscription_mock.return_value.execute.return_value = {
             'items': [
@@ -42,6 +56,8 @@ class NewSubscriptionTestCase(TestCase):
                     'snippet': {
                         'resourceId': {'channelId': '123'},
                         'thumbnails': {},
+                        'title': 'henlo',
+                        'description': 'bluh bluh',
                     },
                 },
                 {
@@ -70,6 +86,9 @@ class NewSubscriptionTestCase(TestCase):
             ],
         }
 
+        self.playlistitems_mock.return_value.execute.return_value = {'items': []}
+        self.videos_mock.return_value.execute.return_value = {'items': []}
+
         self.user = UserFactory.create()
         OauthToken.objects.create(user=self.user, data={})
 
@@ -81,13 +100,21 @@ class NewSubscriptionTestCase(TestCase):
         self.assertEqual(self.subscription_mock.call_count, 1)
         self.assertEqual(self.channel_mock.call_count, 1)
         self.assertEqual(Subscription.objects.count(), 2)
-        # two import video tasks for the two subscriptions
-        self.assertNumTasksEquals(2)
+        sub = Subscription.objects.get(channel_id='123')
+        self.assertEqual((sub.title, sub.description), ('henlo', 'bluh bluh'))
+        self.assertNotEqual(sub.titles_updated, None)
+        # first pages for both subscriptions are fetched in one batch
+        self.assertEqual(self.batch_mock.call_count, 2)
+        self.assertEqual(self.playlistitems_mock.call_count, 2)
+        self.assertEqual(self.videos_mock.call_count, 2)
+        # no more pages to import
+        self.assertNumTasksEquals(0)
 
         self.assertEqual(self.subscription_mock.call_args, (
             (),
-            {'mine': True, 'part': 'snippet', 'fields': 'items(snippet(resourceId(channelId),thumbnails))',
-             'maxResults': API_MAX_RESULTS, 'pageToken': None}
+            {'mine': True, 'part': 'snippet',
+             'fields': 'etag,items(snippet(resourceId(channelId),thumbnails,title,description))',
+             'maxResults': API_MAX_PAGE_SIZE, 'pageToken': None}
         ))
         self.assertEqual(self.channel_mock.call_args, (
             (),
@@ -99,9 +126,245 @@ class NewSubscriptionTestCase(TestCase):
 
         subscriptions(self.user.id)
         self.assertEqual(self.subscription_mock.call_count, 2)
-        self.assertEqual(self.channel_mock.call_count, 2)
+        # uploads playlists are known now
+        self.assertEqual(self.channel_mock.call_count, 1)
         self.assertEqual(Subscription.objects.count(), 2)
-        self.assertNumTasksEquals(2)  # two import_video tasks
+        self.assertEqual(self.batch_mock.call_count, 4)
+        self.assertNumTasksEquals(0)
+
+    @mock.patch('subscribae.utils.deferred')
+    def test_subscriptions_first_pages(self, defer_mock):
+        self.playlistitems_mock.return_value.execute.return_value = {
+            'items': [{'contentDetails': {'videoId': 'video123'}}],
+            'nextPageToken': 'abc',
+        }
+        self.videos_mock.return_value.execute.return_value = {
+            'items': [{
+                'id': 'video123',
+                'snippet': {'thumbnails': {}, 'publishedAt': '1997-07-16T19:20:30.45Z'},
+            }],
+        }
+
+        subscriptions(self.user.id)
+        self.assertEqual(self.batch_mock.call_count, 2)
+        self.assertEqual(sorted(call[1]['playlistId'] for call in self.playlistitems_mock.call_args_list),
+                         ['upload123', 'upload456'])
+        # the same video on both playlists, but only one user
+        self.assertEqual(Video.objects.count(), 1)
+        # new subscriptions only get their first page imported
+        self.assertEqual(defer_mock.defer.call_count, 0)
+        self.assertEqual([sub.head_video_id for sub in Subscription.objects.all()], ['video123'] * 2)
+
+        self.playlistitems_mock.return_value.execute.return_value = {
+            'items': [{'contentDetails': {'videoId': 'video789'}}],
+            'nextPageToken': 'abc',
+        }
+        self.videos_mock.return_value.execute.return_value = {
+            'items': [{
+                'id': 'video789',
+                'snippet': {'thumbnails': {}, 'publishedAt': '1997-07-17T19:20:30.45Z'},
+            }],
+        }
+        defer_mock.reset_mock()
+
+        subscriptions(self.user.id)
+        # existing subscriptions get the rest of the playlist, but the second
+        # playlist has already seen video789
+        self.assertEqual(Video.objects.count(), 2)
+        self.assertEqual(defer_mock.defer.call_count, 1)
+        self.assertEqual(defer_mock.defer.call_args[0][:2], (import_playlists, self.user.id))
+        work = defer_mock.defer.call_args[0][2]
+        self.assertEqual(len(work), 1)
+        self.assertEqual(work[0].page_token, 'abc')
+        self.assertEqual(work[0].only_first_page, False)
+        self.assertEqual(work[0].watermark, None)
+
+    @mock.patch('subscribae.utils.deferred')
+    def test_subscriptions_playlist_head(self, defer_mock):
+        self.playlistitems_mock.return_value.execute.return_value = {
+            'items': [{'contentDetails': {'videoId': 'video123'}}],
+            'nextPageToken': 'abc',
+        }
+        Subscription.objects.create(user=self.user, channel_id='123', last_update=timezone.now(),
+                                    head_video_id='video123')
+        Subscription.objects.create(user=self.user, channel_id='456', last_update=timezone.now(),
+                                    head_video_id='video123')
+
+        subscriptions(self.user.id)
+        self.assertEqual(self.playlistitems_mock.call_count, 2)
+        # nothing new at the head of either playlist
+        self.assertEqual(self.videos_mock.call_count, 0)
+        self.assertEqual(defer_mock.defer.call_count, 0)
+        self.assertEqual(Video.objects.count(), 0)
+
+    @mock.patch('subscribae.utils.deferred')
+    def test_subscriptions_watermark(self, defer_mock):
+        watermark = datetime(1997, 7, 16, 19, 20, 30, 450000, tzinfo=UTC)
+        self.playlistitems_mock.return_value.execute.return_value = {
+            'items': [
+                {'contentDetails': {'videoId': 'video789', 'videoPublishedAt': '1997-07-17T19:20:30.45Z'}},
+                {'contentDetails': {'videoId': 'video123', 'videoPublishedAt': '1997-07-16T19:20:30.45Z'}},
+            ],
+            'nextPageToken': 'abc',
+        }
+        self.videos_mock.return_value.execute.return_value = {
+            'items': [{
+                'id': 'video789',
+                'snippet': {'thumbnails': {}, 'publishedAt': '1997-07-17T19:20:30.45Z'},
+            }],
+        }
+        Subscription.objects.create(user=self.user, channel_id='123', last_update=timezone.now(),
+                                    head_video_id='video123', last_video_published_at=watermark)
+        del self.subscription_mock.return_value.execute.return_value['items'][1]
+
+        subscriptions(self.user.id)
+        self.assertEqual(self.playlistitems_mock.call_count, 1)
+        # only new videos are fetched
+        self.assertEqual(self.videos_mock.call_args, ((), {
+            'id': 'video789', 'part': 'snippet', 'fields': 'items(snippet(publishedAt,thumbnails,title,description))',
+            'maxResults': API_MAX_RESULTS,
+        }))
+        # watermark reached, so no need to look any further
+        self.assertEqual(defer_mock.defer.call_count, 0)
+
+        sub = Subscription.objects.get(channel_id='123')
+        self.assertEqual(sub.head_video_id, 'video789')
+        self.assertEqual(sub.last_video_published_at, datetime(1997, 7, 17, 19, 20, 30, 450000, tzinfo=UTC))
+
+    @mock.patch('subscribae.utils.deferred')
+    def test_subscriptions_batch_error(self, defer_mock):
+        self.batch_mock.side_effect = None
+        self.batch_mock.return_value = [(None, Exception()), (None, Exception())]
+
+        subscriptions(self.user.id)
+        self.assertEqual(self.batch_mock.call_count, 2)
+        # both playlists are retried in the same task
+        self.assertEqual(defer_mock.defer.call_count, 1)
+        self.assertEqual(defer_mock.defer.call_args[0][:2], (import_playlists, self.user.id))
+        work = sorted(defer_mock.defer.call_args[0][2], key=lambda item: item.playlist)
+        subs = dict(Subscription.objects.values_list("upload_playlist", "pk"))
+        self.assertEqual(work, [
+            ImportWork(subs['upload123'], 'upload123', [], None, True, None),
+            ImportWork(subs['upload456'], 'upload456', [], None, True, None),
+        ])
+
+    def test_subscriptions_etags(self):
+        not_modified = HttpError(httplib2.Response({"status": 304}), "")
+        self.subscription_mock.return_value.execute.return_value['etag'] = 'sub-etag'
+        self.playlistitems_mock.return_value.execute.return_value = {'etag': 'playlist-etag', 'items': []}
+
+        subscriptions(self.user.id)
+        self.assertEqual(self.subscription_mock.return_value.headers.__setitem__.call_count, 0)
+        self.assertEqual(self.playlistitems_mock.return_value.headers.__setitem__.call_count, 0)
+        self.assertEqual([sub.playlist_etag for sub in Subscription.objects.all()], ['playlist-etag'] * 2)
+
+        page = SubscriptionListPage.objects.get()
+        self.assertEqual(page.etag, 'sub-etag')
+        self.assertEqual(page.page_token, '')
+        self.assertEqual(page.next_page_token, '')
+        self.assertEqual(page.subscriptions_ids, set(Subscription.objects.values_list('pk', flat=True)))
+
+        self.subscription_mock.return_value.execute.side_effect = not_modified
+        self.playlistitems_mock.return_value.execute.side_effect = not_modified
+
+        subscriptions(self.user.id)
+        self.assertEqual(self.subscription_mock.return_value.headers.__setitem__.call_args,
+                         (('If-None-Match', 'sub-etag'), {}))
+        self.assertEqual(self.playlistitems_mock.return_value.headers.__setitem__.call_args_list,
+                         [(('If-None-Match', 'playlist-etag'), {})] * 2)
+        # subscription list not modified, so no need to update subscriptions
+        self.assertEqual(self.channel_mock.call_count, 1)
+        # playlists were still checked, but they weren't modified either
+        self.assertEqual(self.playlistitems_mock.call_count, 4)
+        self.assertEqual(self.videos_mock.call_count, 2)
+        self.assertNumTasksEquals(0)
+
+    def test_subscriptions_derived_playlists(self):
+        channel_ids = ['UC' + 'a' * 22, 'UC' + 'b' * 22]
+        for item, channel_id in zip(self.subscription_mock.return_value.execute.return_value['items'], channel_ids):
+            item['snippet']['resourceId']['channelId'] = channel_id
+
+        subscriptions(self.user.id)
+        # no need to ask the channels endpoint
+        self.assertEqual(self.channel_mock.call_count, 0)
+        self.assertEqual(sorted(Subscription.objects.values_list('upload_playlist', flat=True)),
+                         ['UU' + 'a' * 22, 'UU' + 'b' * 22])
+        self.assertEqual(sorted(call[1]['playlistId'] for call in self.playlistitems_mock.call_args_list),
+                         ['UU' + 'a' * 22, 'UU' + 'b' * 22])
+        self.assertEqual(get_upload_playlists(channel_ids), {
+            channel_ids[0]: 'UU' + 'a' * 22,
+            channel_ids[1]: 'UU' + 'b' * 22,
+        })
+
+    @mock.patch('subscribae.utils.deferred')
+    def test_subscriptions_derived_playlist_not_found(self, defer_mock):
+        channel_id = 'UC' + 'a' * 22
+        self.subscription_mock.return_value.execute.return_value['items'] = [{
+            'snippet': {'resourceId': {'channelId': channel_id}, 'thumbnails': {}},
+        }]
+        self.channel_mock.return_value.execute.return_value = {
+            'items': [{'id': channel_id, 'contentDetails': {'relatedPlaylists': {'uploads': 'uploadsomething'}}}],
+        }
+        self.playlistitems_mock.return_value.execute.side_effect = HttpError(httplib2.Response({"status": 404}), "")
+
+        subscriptions(self.user.id)
+        # only asked about the channel once the derived playlist didn't work
+        self.assertEqual(self.playlistitems_mock.call_args[1]['playlistId'], 'UU' + 'a' * 22)
+        self.assertEqual(self.channel_mock.call_count, 1)
+        self.assertEqual(self.channel_mock.call_args[1]['id'], channel_id)
+
+        sub = Subscription.objects.get()
+        self.assertEqual(sub.upload_playlist, 'uploadsomething')
+        self.assertEqual(get_upload_playlists([channel_id]), {channel_id: 'uploadsomething'})
+        self.assertEqual(defer_mock.defer.call_count, 1)
+        self.assertEqual(defer_mock.defer.call_args[0], (import_playlists, self.user.id, [
+            ImportWork(sub.pk, 'uploadsomething', [], None, True, None),
+        ]))
+
+        # the confirmed playlist is used from now on
+        self.playlistitems_mock.return_value.execute.side_effect = None
+        subscriptions(self.user.id)
+        self.assertEqual(self.playlistitems_mock.call_args[1]['playlistId'], 'uploadsomething')
+        self.assertEqual(self.channel_mock.call_count, 1)
+
+    @mock.patch('subscribae.utils.deferred')
+    def test_subscriptions_derived_playlist_really_not_found(self, defer_mock):
+        channel_id = 'UC' + 'a' * 22
+        self.subscription_mock.return_value.execute.return_value['items'] = [{
+            'snippet': {'resourceId': {'channelId': channel_id}, 'thumbnails': {}},
+        }]
+        self.channel_mock.return_value.execute.return_value = {
+            'items': [{'id': channel_id, 'contentDetails': {'relatedPlaylists': {'uploads': 'UU' + 'a' * 22}}}],
+        }
+        self.playlistitems_mock.return_value.execute.side_effect = HttpError(httplib2.Response({"status": 404}), "")
+
+        subscriptions(self.user.id)
+        self.assertEqual(self.channel_mock.call_count, 1)
+        # the channel agrees with us, so there's nothing to import
+        sub = Subscription.objects.get()
+        self.assertEqual(sub.upload_playlist, 'UU' + 'a' * 22)
+        self.assertEqual(defer_mock.defer.call_count, 0)
+
+    @override_settings(IMPORT_VIDEOS_FROM_PLAYLIST=True)
+    def test_subscriptions_from_playlist(self):
+        self.playlistitems_mock.return_value.execute.return_value = {
+            'items': [{
+                'snippet': {'title': 'my video', 'description': '', 'thumbnails': {}},
+                'contentDetails': {'videoId': 'video123', 'videoPublishedAt': '1997-07-16T19:20:30.45Z'},
+            }],
+        }
+
+        subscriptions(self.user.id)
+        # only the playlist items batch
+        self.assertEqual(self.batch_mock.call_count, 1)
+        self.assertEqual(self.playlistitems_mock.call_count, 2)
+        self.assertEqual(self.videos_mock.call_count, 0)
+        self.assertEqual(Video.objects.get().title, 'my video')
+
+    def test_derive_upload_playlist(self):
+        self.assertEqual(derive_upload_playlist('UC' + 'a' * 22), 'UU' + 'a' * 22)
+        self.assertEqual(derive_upload_playlist('UC123'), None)
+        self.assertEqual(derive_upload_playlist('HC' + 'a' * 22), None)
 
     def test_subscriptions_pagination(self):
         self.subscription_mock.return_value.execute = MockExecute([
@@ -119,10 +382,12 @@ class NewSubscriptionTestCase(TestCase):
         self.assertEqual(self.subscription_mock.call_count, 2)
 
         self.assertEqual(self.subscription_mock.call_args_list, [
-            ((), {'mine': True, 'part': 'snippet', 'fields': 'items(snippet(resourceId(channelId),thumbnails))',
-                  'maxResults': API_MAX_RESULTS, 'pageToken': None}),
-            ((), {'mine': True, 'part': 'snippet', 'fields': 'items(snippet(resourceId(channelId),thumbnails))',
-                  'maxResults': API_MAX_RESULTS, 'pageToken': '123'}),
+            ((), {'mine': True, 'part': 'snippet',
+                  'fields': 'etag,items(snippet(resourceId(channelId),thumbnails,title,description))',
+                  'maxResults': API_MAX_PAGE_SIZE, 'pageToken': None}),
+            ((), {'mine': True, 'part': 'snippet',
+                  'fields': 'etag,items(snippet(resourceId(channelId),thumbnails,title,description))',
+                  'maxResults': API_MAX_PAGE_SIZE, 'pageToken': '123'}),
         ])
 
     def test_subscriptions_runtime_exceeded(self):
@@ -0,0 +1,284 @@
+##
+#    Copyright (C) 2019  Matt Molyneaux <moggers87+git@moggers87.co.uk>
+#
+#    This file is part of Subscribae.
+#
+#    Subscribae is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Subscribae is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Subscribae.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from datetime import datetime, timedelta
+import json
+
+from apiclient.errors import HttpError
+from djangae.test import TestCase
+from django.test import override_settings
+from django.utils import timezone
+from pytz import UTC
+import httplib2
+import mock
+
+from subscribae.models import OauthToken, Subscription
+from subscribae.quota import (MIN_USER_SHARE, QUOTA_RESET_SPREAD, LocalQuotaLedger, QuotaLedger, QuotaScheduler,
+                              is_quota_error, next_reset, quota_day, quota_ledger, simulate)
+from subscribae.tests.utils import UserFactory
+from subscribae.utils import (SYNC_INTERVAL, ImportWork, import_playlists, import_videos, subscriptions,
+                              sync_user_count, update_subscriptions)
+
+
+def make_http_error(status, reason):
+    content = json.dumps({"error": {"errors": [{"reason": reason}]}})
+    return HttpError(httplib2.Response({"status": status}), content)
+
+
+class QuotaDayTestCase(TestCase):
+    def test_quota_day(self):
+        # 7am UTC is still the previous day in California
+        self.assertEqual(quota_day(datetime(2019, 1, 2, 7, 0, tzinfo=UTC)).isoformat(), "2019-01-01")
+        self.assertEqual(quota_day(datetime(2019, 1, 2, 9, 0, tzinfo=UTC)).isoformat(), "2019-01-02")
+
+    def test_next_reset(self):
+        self.assertEqual(next_reset(datetime(2019, 1, 2, 7, 0, tzinfo=UTC)), datetime(2019, 1, 2, 8, 0, tzinfo=UTC))
+        self.assertEqual(next_reset(datetime(2019, 1, 2, 9, 0, tzinfo=UTC)), datetime(2019, 1, 3, 8, 0, tzinfo=UTC))
+
+    def test_is_quota_error(self):
+        self.assertTrue(is_quota_error(make_http_error(403, "quotaExceeded")))
+        self.assertTrue(is_quota_error(make_http_error(403, "dailyLimitExceeded")))
+        self.assertFalse(is_quota_error(make_http_error(403, "forbidden")))
+        self.assertFalse(is_quota_error(make_http_error(404, "quotaExceeded")))
+        self.assertFalse(is_quota_error(HttpError(httplib2.Response({"status": 403}), "not json")))
+        self.assertFalse(is_quota_error(Exception()))
+
+
+class QuotaLedgerTestCase(TestCase):
+    def test_charge(self):
+        ledger = QuotaLedger(100)
+        self.assertEqual(ledger.used(), 0)
+        self.assertEqual(ledger.remaining(), 100)
+
+        ledger.charge("youtube.videos.list")
+        ledger.charge("youtube.playlistItems.list")
+        ledger.charge("something.else", 5)
+        self.assertEqual(ledger.used(), 7)
+        self.assertEqual(ledger.remaining(), 93)
+
+        # shared via the cache
+        self.assertEqual(QuotaLedger(100).used(), 7)
+
+    def test_exhaust(self):
+        ledger = QuotaLedger(100)
+        ledger.exhaust()
+        self.assertEqual(ledger.remaining(), 0)
+        ledger.charge("youtube.videos.list")
+        self.assertEqual(ledger.remaining(), 0)
+
+    @override_settings(YOUTUBE_API_DAILY_QUOTA=42)
+    def test_daily_limit_from_settings(self):
+        self.assertEqual(QuotaLedger().daily_limit, 42)
+
+    def test_local_ledger(self):
+        ledger = LocalQuotaLedger(100)
+        ledger.charge("youtube.videos.list")
+        self.assertEqual(ledger.used(), 1)
+        self.assertEqual(QuotaLedger(100).used(), 0)
+
+
+class QuotaSchedulerTestCase(TestCase):
+    def setUp(self):
+        super(QuotaSchedulerTestCase, self).setUp()
+        self.ledger = LocalQuotaLedger(100)
+        self.scheduler = QuotaScheduler(self.ledger)
+        self.active_user = UserFactory.build(last_login=timezone.now())
+        self.inactive_user = UserFactory.build(last_login=None)
+
+    def test_plenty(self):
+        self.assertTrue(self.scheduler.should_sync_user(self.active_user))
+        self.assertTrue(self.scheduler.should_sync_user(self.inactive_user))
+        self.assertTrue(self.scheduler.should_import_page(None))
+        self.assertTrue(self.scheduler.should_import_page("abc"))
+
+    def test_tight(self):
+        self.ledger.charge("", 100 - MIN_USER_SHARE + 1)
+        self.assertTrue(self.scheduler.should_sync_user(self.active_user))
+        self.assertFalse(self.scheduler.should_sync_user(self.inactive_user))
+        self.assertTrue(self.scheduler.should_import_page(None))
+        self.assertTrue(self.scheduler.should_import_page("abc"))
+        # history pages stop once the share has been spent
+        self.assertTrue(self.scheduler.should_import_page("abc", spent=MIN_USER_SHARE - 2))
+        self.assertFalse(self.scheduler.should_import_page("abc", spent=MIN_USER_SHARE - 1))
+        self.assertTrue(self.scheduler.should_import_page(None, spent=MIN_USER_SHARE - 1))
+        # pages cost more when their videos are asked for separately
+        with override_settings(IMPORT_VIDEOS_FROM_PLAYLIST=False):
+            self.assertFalse(self.scheduler.should_import_page("abc", spent=MIN_USER_SHARE - 2))
+
+    def test_user_share(self):
+        scheduler = QuotaScheduler(self.ledger, users=4)
+        self.assertEqual(scheduler.user_share(), 25)
+        self.assertEqual(scheduler.user_share(2), 50)
+        self.assertTrue(scheduler.should_sync_user(self.inactive_user, scheduler.user_share(2)))
+        self.assertFalse(scheduler.should_sync_user(self.inactive_user))
+        self.assertTrue(scheduler.should_sync_user(self.active_user))
+
+        # what's been promised to other users isn't shared again
+        scheduler.allocate(50)
+        self.assertEqual(scheduler.user_share(2), 25)
+
+    @mock.patch('subscribae.quota.random')
+    def test_after_reset(self, random_mock):
+        random_mock.uniform.return_value = 60
+        self.assertEqual(self.scheduler.after_reset(), next_reset() + timedelta(seconds=60))
+        self.assertEqual(random_mock.uniform.call_args, ((0, QUOTA_RESET_SPREAD.total_seconds()), {}))
+
+    def test_exhausted(self):
+        self.ledger.exhaust()
+        self.assertFalse(self.scheduler.should_sync_user(self.active_user))
+        self.assertFalse(self.scheduler.should_sync_user(self.inactive_user))
+        self.assertFalse(self.scheduler.should_import_page(None))
+        self.assertFalse(self.scheduler.should_import_page("abc"))
+
+
+class SimulateTestCase(TestCase):
+    def test_plenty_of_quota(self):
+        users = [UserFactory.build(last_login=timezone.now()) for i in range(2)]
+        stats = simulate(users, subscription_count=10, history_pages=2, daily_limit=10000)
+        self.assertEqual(stats, {
+            "users_synced": 2,
+            "users_skipped": 0,
+            "pages_imported": 40,
+            "pages_deferred": 0,
+            "units_used": 42,
+        })
+
+    @override_settings(IMPORT_VIDEOS_FROM_PLAYLIST=False)
+    def test_videos_fetched_separately(self):
+        users = [UserFactory.build(last_login=timezone.now()) for i in range(2)]
+        stats = simulate(users, subscription_count=10, history_pages=2, daily_limit=10000)
+        self.assertEqual(stats["pages_imported"], 40)
+        self.assertEqual(stats["units_used"], 82)
+
+    def test_tight_quota(self):
+        users = [
+            UserFactory.build(last_login=timezone.now() - timedelta(days=30)),
+            UserFactory.build(last_login=timezone.now()),
+            UserFactory.build(last_login=None),
+        ]
+        stats = simulate(users, subscription_count=10, history_pages=3, daily_limit=45)
+        # nobody's share is big enough for inactive users, the active user
+        # imports history pages until their share is spent
+        self.assertEqual(stats, {
+            "users_synced": 1,
+            "users_skipped": 2,
+            "pages_imported": 24,
+            "pages_deferred": 6,
+            "units_used": 25,
+        })
+
+
+class QuotaTasksTestCase(TestCase):
+    def setUp(self):
+        super(QuotaTasksTestCase, self).setUp()
+        self.user = UserFactory(last_login=None)
+        OauthToken.objects.create(user=self.user, data={})
+
+    @mock.patch('subscribae.utils.deferred')
+    def test_update_subscriptions_tight(self, defer_mock):
+        active_user = UserFactory(last_login=timezone.now())
+        OauthToken.objects.create(user=active_user, data={})
+        quota_ledger.charge("", quota_ledger.daily_limit - 1)
+
+        update_subscriptions()
+        self.assertEqual(defer_mock.defer.call_count, 1)
+        self.assertEqual(defer_mock.defer.call_args, ((subscriptions, active_user.pk), {}))
+
+    @mock.patch('subscribae.utils.deferred')
+    def test_update_subscriptions_inactive_users(self, defer_mock):
+        inactive_user = UserFactory(is_active=False)
+        OauthToken.objects.create(user=inactive_user, data={})
+        # enough for one user, but not two
+        quota_ledger.charge("", quota_ledger.daily_limit - MIN_USER_SHARE * 2 + 1)
+
+        update_subscriptions()
+        # inactive users don't take a share
+        self.assertEqual(defer_mock.defer.call_args_list, [((subscriptions, self.user.pk), {})])
+        self.assertEqual(sync_user_count(), 1)
+
+    @mock.patch('subscribae.quota.random')
+    @mock.patch('subscribae.utils.deferred')
+    @mock.patch('subscribae.utils.get_service')
+    def test_subscriptions_exhausted(self, service_mock, defer_mock, random_mock):
+        random_mock.uniform.return_value = 60
+        quota_ledger.exhaust()
+
+        subscriptions(self.user.pk)
+        self.assertEqual(service_mock.call_count, 0)
+        self.assertEqual(defer_mock.defer.call_count, 1)
+        self.assertEqual(defer_mock.defer.call_args, (
+            (subscriptions, self.user.pk, None),
+            {"_eta": next_reset() + timedelta(seconds=60)},
+        ))
+
+    @mock.patch('subscribae.quota.random')
+    @mock.patch('subscribae.utils.deferred')
+    @mock.patch('subscribae.utils.get_service')
+    def test_subscriptions_quota_error(self, service_mock, defer_mock, random_mock):
+        random_mock.uniform.return_value = 60
+        subscription_mock = service_mock.return_value.subscriptions.return_value.list
+        subscription_mock.return_value.execute.side_effect = make_http_error(403, "quotaExceeded")
+
+        subscriptions(self.user.pk)
+        self.assertEqual(quota_ledger.remaining(), 0)
+        self.assertEqual(defer_mock.defer.call_count, 1)
+        self.assertEqual(defer_mock.defer.call_args, (
+            (subscriptions, self.user.pk, None),
+            {"_eta": next_reset() + timedelta(seconds=60)},
+        ))
+
+    @mock.patch('subscribae.utils.get_service')
+    def test_subscriptions_other_error(self, service_mock):
+        subscription_mock = service_mock.return_value.subscriptions.return_value.list
+        subscription_mock.return_value.execute.side_effect = make_http_error(403, "forbidden")
+
+        with self.assertRaises(HttpError):
+            subscriptions(self.user.pk)
+
+    @mock.patch('subscribae.quota.random')
+    @mock.patch('subscribae.utils.deferred')
+    @mock.patch('subscribae.utils.get_service')
+    def test_import_videos_tight(self, service_mock, defer_mock, random_mock):
+        random_mock.uniform.return_value = 60
+        playlistitems_mock = service_mock.return_value.playlistItems.return_value.list
+        subscription = Subscription.objects.create(user=self.user, channel_id="123", last_update=timezone.now())
+        quota_ledger.charge("", quota_ledger.daily_limit - 1)
+
+        import_videos(self.user.pk, subscription.pk, "upload123", [], page_token="abc")
+        self.assertEqual(playlistitems_mock.call_count, 0)
+        self.assertEqual(defer_mock.defer.call_count, 1)
+        # there's still some quota, so it waits for the next sync rather than the reset
+        self.assertEqual(defer_mock.defer.call_args, (
+            (import_playlists, self.user.pk, [ImportWork(subscription.pk, "upload123", [], "abc", False, None)]),
+            {"_countdown": SYNC_INTERVAL.total_seconds()},
+        ))
+
+    @mock.patch('subscribae.quota.random')
+    @mock.patch('subscribae.utils.deferred')
+    @mock.patch('subscribae.utils.get_service')
+    def test_import_videos_exhausted(self, service_mock, defer_mock, random_mock):
+        random_mock.uniform.return_value = 60
+        subscription = Subscription.objects.create(user=self.user, channel_id="123", last_update=timezone.now())
+        quota_ledger.exhaust()
+
+        import_videos(self.user.pk, subscription.pk, "upload123", [])
+        self.assertEqual(defer_mock.defer.call_args, (
+            (import_playlists, self.user.pk, [ImportWork(subscription.pk, "upload123", [], None, False, None)]),
+            {"_eta": next_reset() + timedelta(seconds=60)},
+        ))
@@ -0,0 +1,270 @@
+##
+#    Copyright (C) 2019  Matt Molyneaux <moggers87+git@moggers87.co.uk>
+#
+#    This file is part of Subscribae.
+#
+#    Subscribae is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Subscribae is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Subscribae.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from datetime import timedelta
+import json
+
+from apiclient.errors import HttpError
+from djangae.db import transaction
+from djangae.test import TestCase
+from django.utils import timezone
+from google.appengine.api import datastore
+import httplib2
+import mock
+
+from subscribae.generations import BUCKET, SUBSCRIPTION, get_generation
+from subscribae.models import OauthToken, Subscription, TitleRefresh, Video
+from subscribae.quota import quota_ledger
+from subscribae.tests.utils import BucketFactory, SubscriptionFactory, UserFactory, VideoFactory, fake_batch_execute
+from subscribae.utils import (API_MAX_IDS, TITLE_REFRESH_PERIOD, TOMBSTONE_MISSES, TOMBSTONE_REFRESH_PERIOD,
+                              backfill_titles, refresh_titles, refresh_user_titles)
+
+
+def make_legacy(obj, *names):
+    """Remove properties from `obj`'s entity, like it was saved before they existed"""
+    key = datastore.Key.from_path(obj._meta.db_table, obj.pk)
+    entity = datastore.Get(key)
+    for name in names:
+        del entity[name]
+    datastore.Put(entity)
+
+
+class RefreshTitlesTestCase(TestCase):
+    def test_refresh_titles(self):
+        user1 = UserFactory()
+        OauthToken.objects.create(user=user1)
+        user2 = UserFactory(is_active=False)
+        OauthToken.objects.create(user=user2)
+
+        refresh_titles()
+        self.assertNumTasksEquals(1)
+
+    def test_refresh_titles_tight(self):
+        user = UserFactory()
+        OauthToken.objects.create(user=user)
+        quota_ledger.charge("", quota_ledger.daily_limit - 1)
+
+        refresh_titles()
+        self.assertNumTasksEquals(0)
+
+
+class RefreshUserTitlesTestCase(TestCase):
+    def setUp(self):
+        super(RefreshUserTitlesTestCase, self).setUp()
+        self.service_patch = mock.patch('subscribae.utils.get_service')
+        self.service_mock = self.service_patch.start()
+        self.channel_mock = self.service_mock.return_value.channels.return_value.list
+        self.video_mock = self.service_mock.return_value.videos.return_value.list
+
+        self.channel_mock.return_value.execute.return_value = {
+            'items': [{'id': '123', 'snippet': {'title': 'henlo', 'description': 'bluh bluh'}}],
+        }
+        self.video_mock.return_value.execute.return_value = {
+            'items': [{'id': 'video123', 'snippet': {'title': 'bye-q', 'description': 'blah blah'}}],
+        }
+
+        self.user = UserFactory()
+        OauthToken.objects.create(user=self.user, data={})
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def test_refresh(self):
+        now = timezone.now()
+        sub = SubscriptionFactory(user=self.user, channel_id='123', titles_updated=None)
+        renamed = VideoFactory(user=self.user, subscription=sub, youtube_id='video123', title='old',
+                               titles_updated=now - timedelta(days=1))
+        unchanged = VideoFactory(user=self.user, subscription=sub, youtube_id='video456', title='same',
+                                 description='same', titles_updated=now - timedelta(days=1))
+        self.video_mock.return_value.execute.return_value = {'items': [
+            {'id': 'video123', 'snippet': {'title': 'bye-q', 'description': 'blah blah'}},
+            {'id': 'video456', 'snippet': {'title': 'same', 'description': 'same'}},
+        ]}
+
+        refresh_user_titles(self.user.pk)
+        self.assertEqual(self.channel_mock.call_count, 1)
+        self.assertEqual(self.channel_mock.call_args[1]['id'], '123')
+        self.assertEqual(self.video_mock.call_count, 1)
+        self.assertEqual(self.video_mock.call_args[1]['id'], 'video123,video456')
+
+        sub = Subscription.objects.get(pk=sub.pk)
+        self.assertEqual((sub.title, sub.description), ('henlo', 'bluh bluh'))
+        self.assertNotEqual(sub.titles_updated, None)
+
+        renamed = Video.objects.get(pk=renamed.pk)
+        self.assertEqual((renamed.title, renamed.description), ('bye-q', 'blah blah'))
+        self.assertTrue(renamed.titles_updated > now)
+
+        # not saved again
+        unchanged = Video.objects.get(pk=unchanged.pk)
+        self.assertEqual(unchanged.titles_updated, now - timedelta(days=1))
+
+        # nothing is due until TITLE_REFRESH_PERIOD has passed
+        refresh_user_titles(self.user.pk)
+        self.assertEqual(self.channel_mock.call_count, 1)
+        self.assertEqual(self.video_mock.call_count, 1)
+
+        with mock.patch('subscribae.utils.timezone.now', return_value=now + TITLE_REFRESH_PERIOD + timedelta(days=1)):
+            refresh_user_titles(self.user.pk)
+        self.assertEqual(self.channel_mock.call_count, 2)
+        self.assertEqual(self.video_mock.call_count, 2)
+
+    def test_refresh_resumes(self):
+        sub = SubscriptionFactory(user=self.user, channel_id='123', title='henlo', description='bluh bluh',
+                                  titles_updated=timezone.now())
+        videos = sorted(VideoFactory.create_batch(3, user=self.user, subscription=sub, titles_updated=timezone.now()),
+                        key=lambda video: video.pk)
+        TitleRefresh.objects.create(user=self.user, name='videos', last_pk=videos[0].pk, started=timezone.now())
+
+        refresh_user_titles(self.user.pk)
+        self.assertEqual(self.video_mock.call_count, 1)
+        self.assertEqual(self.video_mock.call_args[1]['id'], ','.join(sorted(video.youtube_id for video in videos[1:])))
+
+        progress = TitleRefresh.objects.get(name='videos')
+        self.assertEqual(progress.last_pk, '')
+
+    def test_refresh_batches(self):
+        sub = SubscriptionFactory(user=self.user, channel_id='123', title='henlo', description='bluh bluh',
+                                  titles_updated=timezone.now())
+        VideoFactory.create_batch(30, user=self.user, subscription=sub, titles_updated=None)
+
+        with mock.patch("subscribae.utils.transaction.atomic", side_effect=transaction.atomic) as atomic_mock:
+            refresh_user_titles(self.user.pk)
+        # one API call, but transactions can only do 25 videos
+        self.assertEqual(self.video_mock.call_count, 1)
+        self.assertEqual(atomic_mock.call_count, 2)
+        self.assertEqual(Video.objects.filter(titles_updated__isnull=True).count(), 0)
+
+    @mock.patch('subscribae.utils.batch_execute', side_effect=fake_batch_execute)
+    def test_refresh_many(self, batch_mock):
+        sub = SubscriptionFactory(user=self.user, channel_id='123', titles_updated=timezone.now())
+        VideoFactory.create_batch(API_MAX_IDS * 2 + 1, user=self.user, subscription=sub, titles_updated=None)
+
+        refresh_user_titles(self.user.pk)
+        # three list calls, all in one batch
+        self.assertEqual(self.video_mock.call_count, 3)
+        self.assertEqual(batch_mock.call_count, 1)
+        self.assertEqual(Video.objects.filter(titles_updated__isnull=True).count(), 0)
+
+    def test_refresh_legacy(self):
+        sub = SubscriptionFactory(user=self.user, channel_id='123', title='old')
+        video = VideoFactory(user=self.user, subscription=sub, youtube_id='video123', title='old')
+        make_legacy(sub, 'title', 'description', 'titles_updated')
+        make_legacy(video, 'title', 'description', 'titles_updated', 'tombstone')
+
+        # the datastore can't find the video, filtering on tombstone doesn't match it
+        refresh_user_titles(self.user.pk)
+        self.assertEqual(self.channel_mock.call_count, 1)
+        self.assertEqual(self.video_mock.call_count, 0)
+
+        backfill_titles()
+        self.process_task_queues()
+        self.assertEqual(self.channel_mock.call_count, 1)
+        self.assertEqual(self.video_mock.call_count, 1)
+
+        sub = Subscription.objects.get(pk=sub.pk)
+        self.assertEqual(sub.title, 'henlo')
+        video = Video.objects.get(pk=video.pk)
+        self.assertEqual((video.title, video.tombstone), ('bye-q', False))
+
+    def test_refresh_bumps_generations(self):
+        sub = SubscriptionFactory(user=self.user, channel_id='123')
+        bucket = BucketFactory(user=self.user, subs=[sub])
+        VideoFactory(user=self.user, subscription=sub, buckets=[bucket], youtube_id='video123', titles_updated=None)
+        generations = get_generation(BUCKET, bucket.pk), get_generation(SUBSCRIPTION, sub.pk)
+
+        refresh_user_titles(self.user.pk)
+        self.assertNotEqual(get_generation(BUCKET, bucket.pk), generations[0])
+        self.assertNotEqual(get_generation(SUBSCRIPTION, sub.pk), generations[1])
+
+    def test_refresh_missing(self):
+        self.video_mock.return_value.execute.return_value = {'items': []}
+        sub = SubscriptionFactory(user=self.user, channel_id='123', titles_updated=timezone.now())
+        video = VideoFactory(user=self.user, subscription=sub, youtube_id='video123', title='old',
+                             titles_updated=None)
+
+        refresh_user_titles(self.user.pk)
+
+        # not in the API right now, but it might come back
+        video = Video.objects.get(pk=video.pk)
+        self.assertEqual(video.title, 'old')
+        self.assertNotEqual(video.titles_updated, None)
+        self.assertEqual((video.tombstone, video.missed_refreshes), (False, 1))
+
+    def test_refresh_missing_repeatedly(self):
+        self.video_mock.return_value.execute.return_value = {'items': []}
+        sub = SubscriptionFactory(user=self.user, channel_id='123', titles_updated=timezone.now())
+        video = VideoFactory(user=self.user, subscription=sub, youtube_id='video123', title='old',
+                             titles_updated=None, missed_refreshes=TOMBSTONE_MISSES - 1)
+
+        refresh_user_titles(self.user.pk)
+        video = Video.objects.get(pk=video.pk)
+        self.assertEqual(video.title, 'old')
+        self.assertEqual(video.tombstone, True)
+
+    def test_refresh_found_again(self):
+        sub = SubscriptionFactory(user=self.user, channel_id='123', titles_updated=timezone.now())
+        video = VideoFactory(user=self.user, subscription=sub, youtube_id='video123', titles_updated=None,
+                             missed_refreshes=TOMBSTONE_MISSES - 1)
+
+        refresh_user_titles(self.user.pk)
+        video = Video.objects.get(pk=video.pk)
+        self.assertEqual((video.title, video.tombstone, video.missed_refreshes), ('bye-q', False, 0))
+
+    def test_refresh_tombstone(self):
+        now = timezone.now()
+        sub = SubscriptionFactory(user=self.user, channel_id='123', titles_updated=now)
+        VideoFactory(user=self.user, subscription=sub, youtube_id='video123', titles_updated=now)
+        VideoFactory(user=self.user, subscription=sub, youtube_id='video456', tombstone=True, titles_updated=now)
+        for name in ['videos', 'tombstones']:
+            TitleRefresh.objects.create(user=self.user, name=name,
+                                        started=now - TITLE_REFRESH_PERIOD - timedelta(days=1))
+
+        # checked less often than other videos
+        refresh_user_titles(self.user.pk)
+        self.assertEqual(self.video_mock.call_count, 1)
+        self.assertEqual(self.video_mock.call_args[1]['id'], 'video123')
+
+    def test_refresh_tombstone_comes_back(self):
+        now = timezone.now()
+        sub = SubscriptionFactory(user=self.user, channel_id='123', titles_updated=now)
+        video = VideoFactory(user=self.user, subscription=sub, youtube_id='video123', tombstone=True,
+                             missed_refreshes=TOMBSTONE_MISSES,
+                             titles_updated=now - TOMBSTONE_REFRESH_PERIOD - timedelta(days=1))
+
+        refresh_user_titles(self.user.pk)
+        self.assertEqual(self.video_mock.call_count, 1)
+        video = Video.objects.get(pk=video.pk)
+        self.assertEqual((video.title, video.tombstone, video.missed_refreshes), ('bye-q', False, 0))
+
+    def test_refresh_quota(self):
+        SubscriptionFactory(user=self.user, channel_id='123', titles_updated=None)
+        content = json.dumps({"error": {"errors": [{"reason": "quotaExceeded"}]}})
+        self.channel_mock.return_value.execute.side_effect = HttpError(httplib2.Response({"status": 403}), content)
+
+        refresh_user_titles(self.user.pk)
+        self.assertEqual(quota_ledger.remaining(), 0)
+        self.assertNumTasksEquals(0)
+
+    def test_missing_oauth_token(self):
+        OauthToken.objects.all().delete()
+        self.service_patch.stop()
+
+        # should raise no exceptions
+        refresh_user_titles(self.user.pk)
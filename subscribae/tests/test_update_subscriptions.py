@@ -26,8 +26,8 @@ from google.appengine.runtime import DeadlineExceededError as RuntimeExceededErr
 import mock
 
 from subscribae.models import OauthToken
-from subscribae.tests.utils import MockExecute, SubscriptionFactory, UserFactory
-from subscribae.utils import import_videos, subscriptions, update_subscriptions
+from subscribae.tests.utils import BucketFactory, MockExecute, SubscriptionFactory, UserFactory, fake_batch_execute
+from subscribae.utils import import_playlists, subscription_bucket_map, subscriptions, update_subscriptions
 
 
 class UpdateSubscriptionsForUsersTestCase(TestCase):
@@ -37,8 +37,13 @@ class UpdateSubscriptionsForUsersTestCase(TestCase):
         self.service_patch = mock.patch('subscribae.utils.get_service')
         self.service_mock = self.service_patch.start()
 
+        self.batch_patch = mock.patch('subscribae.utils.batch_execute', side_effect=fake_batch_execute)
+        self.batch_mock = self.batch_patch.start()
+
         self.subscription_mock = self.service_mock.return_value.subscriptions.return_value.list
         self.channel_mock = self.service_mock.return_value.channels.return_value.list
+        self.playlistitems_mock = self.service_mock.return_value.playlistItems.return_value.list
+        self.videos_mock = self.service_mock.return_value.videos.return_value.list
 
         self.subscription_mock.return_value.execute = MockExecute([
             {
@@ -76,6 +81,13 @@ class UpdateSubscriptionsForUsersTestCase(TestCase):
             ],
         }
 
+        self.playlistitems_mock.return_value.execute = MockExecute([
+            {'items': [], 'nextPageToken': '123'},
+            {'items': [], 'nextPageToken': '123'},
+            {'items': []},
+        ])
+        self.videos_mock.return_value.execute.return_value = {'items': []}
+
         self.user = UserFactory.create()
         OauthToken.objects.create(user=self.user, data={})
 
@@ -97,11 +109,60 @@ class UpdateSubscriptionsForUsersTestCase(TestCase):
         sub2.refresh_from_db()
         self.assertNotEqual(sub2.last_update, last_week)
 
-        # two import_video calls
-        self.assertNumTasksEquals(2)
+        # first pages were fetched in a batch, one import_playlists task for
+        # the rest of both playlists
+        self.assertEqual(self.playlistitems_mock.call_count, 2)
+        self.assertNumTasksEquals(1)
         # make sure it doens't infinitely loop
         self.process_task_queues()
 
+    def test_subscriptions_unchanged(self):
+        last_week = timezone.now() - timedelta(7)
+        sub1 = SubscriptionFactory.create(user=self.user, channel_id="123", last_update=last_week,
+                                          upload_playlist="upload123", thumbnails={})
+        sub2 = SubscriptionFactory.create(user=self.user, channel_id="456", last_update=last_week,
+                                          upload_playlist="upload456", thumbnails={"default": "old.jpg"})
+
+        subscriptions(self.user.id)
+
+        # sub1 has not changed, so it wasn't saved
+        sub1.refresh_from_db()
+        self.assertEqual(sub1.last_update, last_week)
+
+        sub2.refresh_from_db()
+        self.assertNotEqual(sub2.last_update, last_week)
+        self.assertEqual(sub2.thumbnails, {})
+
+        self.assertNumTasksEquals(1)
+
+    @mock.patch('subscribae.utils.deferred')
+    def test_subscriptions_buckets(self, defer_mock):
+        sub1 = SubscriptionFactory.create(user=self.user, channel_id="123", upload_playlist="upload123")
+        sub2 = SubscriptionFactory.create(user=self.user, channel_id="456", upload_playlist="upload456")
+        bucket1 = BucketFactory(user=self.user, subs=[sub1, sub2])
+        bucket2 = BucketFactory(user=self.user, subs=[sub1])
+        BucketFactory(subs=[])
+
+        self.assertEqual(subscription_bucket_map(self.user.id), {
+            sub1.pk: sorted([bucket1.pk, bucket2.pk]),
+            sub2.pk: [bucket1.pk],
+        })
+
+        with mock.patch('subscribae.utils.subscription_bucket_map', wraps=subscription_bucket_map) as map_mock:
+            subscriptions(self.user.id)
+            self.assertEqual(map_mock.call_count, 1)
+
+            # already have a map from a previous task
+            subscriptions(self.user.id, bucket_map={})
+            self.assertEqual(map_mock.call_count, 1)
+
+        self.assertEqual(defer_mock.defer.call_args_list[0][0][:2], (import_playlists, self.user.id))
+        work = defer_mock.defer.call_args_list[0][0][2]
+        self.assertEqual(sorted((item.subscription_id, item.playlist, item.bucket_ids) for item in work), sorted([
+            (sub1.pk, "upload123", sorted([bucket1.pk, bucket2.pk])),
+            (sub2.pk, "upload456", [bucket1.pk]),
+        ]))
+
     @unittest.skip("this needs to change to page_token")
     def test_update_subscriptions_with_last_pk(self):
         last_week = timezone.now() - timedelta(7)
@@ -141,7 +202,7 @@ class UpdateSubscriptionsForUsersTestCase(TestCase):
 
     @mock.patch('subscribae.utils.deferred')
     def test_subscriptions_with_runtime_exceeded_error(self, defer_mock):
-        defer_mock.defer.side_effect = MockExecute([RuntimeExceededError(), None])
+        self.batch_mock.side_effect = MockExecute([RuntimeExceededError()])
 
         last_week = timezone.now() - timedelta(7)
         sub1 = SubscriptionFactory.create(user=self.user, channel_id="123", last_update=last_week)
@@ -150,21 +211,18 @@ class UpdateSubscriptionsForUsersTestCase(TestCase):
         subscriptions(self.user.id)
         self.assertEqual(self.subscription_mock.call_count, 1)
         self.assertEqual(self.channel_mock.call_count, 1)
-        self.assertEqual(defer_mock.defer.call_count, 2)
+        self.assertEqual(self.batch_mock.call_count, 1)
+        self.assertEqual(defer_mock.defer.call_count, 1)
 
         sub1.refresh_from_db()
         sub2.refresh_from_db()
 
-        self.assertEqual(
-            defer_mock.defer.call_args_list[0],
-            ((import_videos, self.user.id, sub1.pk, sub1.upload_playlist, []), {"only_first_page": False})
-        )
-        self.assertEqual(defer_mock.defer.call_args_list[1],
-                         ((subscriptions, self.user.id, None), {}))
+        self.assertEqual(defer_mock.defer.call_args_list[0],
+                         ((subscriptions, self.user.id, None), {"bucket_map": {}}))
 
+        # subscriptions were saved before their videos were fetched
         self.assertNotEqual(sub1.last_update, last_week)
-
-        self.assertEqual(sub2.last_update, last_week)
+        self.assertNotEqual(sub2.last_update, last_week)
 
     def test_missing_oauth_token(self):
         OauthToken.objects.get(user_id=self.user.id).delete()
@@ -18,17 +18,26 @@
 ##
 
 from djangae.test import TestCase
-from django.core.cache import cache
 from google.appengine.api import memcache
 import mock
 
+from subscribae.local_cache import tiered_cache
 from subscribae.models import OauthToken
-from subscribae.tests.utils import SubscriptionFactory, UserFactory, VideoFactory
-from subscribae.utils import (SUBSCRIPTION_TITLE_CACHE_PREFIX, VIDEO_TITLE_CACHE_PREFIX, get_service,
-                              subscription_add_titles, video_add_titles)
+from subscribae.tests.utils import UserFactory, fake_batch_execute
+from subscribae.utils import (API_BATCH_LIMIT, API_MAX_IDS, SERVICE_HTTP_CACHE_SIZE, batch_execute, fetch_titles,
+                              get_service, log_stats, service_factory)
 
 
 class GetServiceTestCase(TestCase):
+    def setUp(self):
+        super(GetServiceTestCase, self).setUp()
+        service_factory.reset()
+
+    def tearDown(self):
+        service_factory.max_size = SERVICE_HTTP_CACHE_SIZE
+        service_factory.reset()
+        super(GetServiceTestCase, self).tearDown()
+
     def test_get_service_no_user(self):
         with self.assertRaises(OauthToken.DoesNotExist):
             get_service(1)
@@ -45,9 +54,10 @@ class GetServiceTestCase(TestCase):
         with self.assertRaises(KeyError):
             get_service(user.pk)
 
+    @mock.patch("subscribae.utils.Resource")
     @mock.patch("subscribae.utils.build")
     @mock.patch("subscribae.models.Credentials")
-    def test_get_service_without_cache(self, credentials, build):
+    def test_get_service_without_cache(self, credentials, build, resource):
         user = UserFactory()
         OauthToken.objects.create(user=user, data='{}')
 
@@ -55,16 +65,20 @@ class GetServiceTestCase(TestCase):
 
         authorize = credentials.new_from_json.return_value.authorize
         self.assertEqual(build.call_count, 1)
-        self.assertEqual(build.return_value, service)
-        self.assertEqual(build.call_args, (("youtube", "v3"), {"http": authorize.return_value}))
+        self.assertEqual(build.call_args[0], ("youtube", "v3"))
+        self.assertEqual(build.call_args[1]["http"].cache, memcache)
+        self.assertEqual(resource.return_value, service)
+        self.assertEqual(resource.call_args[1]["http"], authorize.return_value)
+        self.assertEqual(resource.call_args[1]["resourceDesc"], build.return_value._resourceDesc)
         self.assertEqual(authorize.call_count, 1)
         self.assertEqual(authorize.call_args[0][0].cache, None)
         self.assertEqual(credentials.new_from_json.call_count, 1)
         self.assertEqual(credentials.new_from_json.call_args, ((u"{}",), {}))
 
+    @mock.patch("subscribae.utils.Resource")
     @mock.patch("subscribae.utils.build")
     @mock.patch("subscribae.models.Credentials")
-    def test_get_service_with_cache(self, credentials, build):
+    def test_get_service_with_cache(self, credentials, build, resource):
         user = UserFactory()
         OauthToken.objects.create(user=user, data='{}')
 
@@ -72,145 +86,176 @@ class GetServiceTestCase(TestCase):
 
         authorize = credentials.new_from_json.return_value.authorize
         self.assertEqual(build.call_count, 1)
-        self.assertEqual(build.return_value, service)
-        self.assertEqual(build.call_args, (("youtube", "v3"), {"http": authorize.return_value}))
+        self.assertEqual(resource.return_value, service)
+        self.assertEqual(resource.call_args[1]["http"], authorize.return_value)
         self.assertEqual(authorize.call_count, 1)
         self.assertEqual(authorize.call_args[0][0].cache, memcache)
         self.assertEqual(credentials.new_from_json.call_count, 1)
         self.assertEqual(credentials.new_from_json.call_args, ((u"{}",), {}))
 
+    @mock.patch("subscribae.utils.Resource")
+    @mock.patch("subscribae.utils.build")
+    @mock.patch("subscribae.models.Credentials")
+    def test_get_service_reused(self, credentials, build, resource):
+        user1 = UserFactory()
+        OauthToken.objects.create(user=user1, data='{}')
+        user2 = UserFactory()
+        OauthToken.objects.create(user=user2, data='{}')
 
-class AddTitlesSubscriptionTestCase(TestCase):
-    def setUp(self):
-        super(AddTitlesSubscriptionTestCase, self).setUp()
-
-        self.service_patch = mock.patch('subscribae.utils.get_service')
-        self.service_mock = self.service_patch.start()
-
-        self.channel_mock = self.service_mock.return_value.channels.return_value.list
-
-        self.channel_mock.return_value.execute.return_value = {
-            'items': [
-                {
-                    'id': '123',
-                    'snippet': {
-                        "title": "henlo",
-                        "description": "bluh bluh",
-                    },
-                },
-                {
-                    'id': '456',
-                    'snippet': {
-                        "title": "bye-q",
-                        "description": "blah blah",
-                    },
-                },
-            ],
-        }
-
-    def tearDown(self):
-        mock.patch.stopall()
-
-    def test_clean_cache(self):
-        sub = SubscriptionFactory.build(channel_id="123")
+        get_service(user1.pk)
+        get_service(user1.pk)
+        get_service(user2.pk)
 
-        cached_data = cache.get(SUBSCRIPTION_TITLE_CACHE_PREFIX + "123")
-        self.assertEqual(cached_data, None)
+        authorize = credentials.new_from_json.return_value.authorize
+        # discovery document is only used once
+        self.assertEqual(build.call_count, 1)
+        self.assertEqual(resource.call_count, 3)
+        # one authorised http per user
+        self.assertEqual(authorize.call_count, 2)
+        self.assertEqual(credentials.new_from_json.call_count, 2)
 
-        results = list(subscription_add_titles([sub]))
-        self.assertEqual(results, [sub])
+        stats = service_factory.stats()
+        self.assertEqual(stats["builds"], 1)
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 2)
 
-        self.assertEqual(sub.title, "henlo")
-        self.assertEqual(sub.description, "bluh bluh")
+    @mock.patch("subscribae.utils.Resource")
+    @mock.patch("subscribae.utils.build")
+    @mock.patch("subscribae.models.Credentials")
+    def test_get_service_token_changed(self, credentials, build, resource):
+        user = UserFactory()
+        token = OauthToken.objects.create(user=user, data='{}')
 
-        self.assertEqual(self.channel_mock.call_count, 1)
-        self.assertEqual(self.channel_mock.call_args[1]["id"], "123")
+        get_service(user.pk)
+        token.data = '{"new": true}'
+        token.save()
+        get_service(user.pk)
 
-        cached_data = cache.get(SUBSCRIPTION_TITLE_CACHE_PREFIX + "123")
-        self.assertEqual(cached_data, {"title": "henlo", "description": "bluh bluh"})
+        authorize = credentials.new_from_json.return_value.authorize
+        self.assertEqual(build.call_count, 1)
+        self.assertEqual(authorize.call_count, 2)
+        self.assertEqual(service_factory.hits, 0)
+        self.assertEqual(service_factory.misses, 2)
 
-    def test_cache_populated(self):
-        sub = SubscriptionFactory.build(channel_id="123")
+    @mock.patch("subscribae.utils.Resource")
+    @mock.patch("subscribae.utils.build")
+    @mock.patch("subscribae.models.Credentials")
+    def test_get_service_max_size(self, credentials, build, resource):
+        service_factory.max_size = 1
+        user1 = UserFactory()
+        OauthToken.objects.create(user=user1, data='{}')
+        user2 = UserFactory()
+        OauthToken.objects.create(user=user2, data='{}')
 
-        cache.set(SUBSCRIPTION_TITLE_CACHE_PREFIX + "123", {"title": "henlo", "description": "bluh bluh"})
+        get_service(user1.pk)
+        get_service(user2.pk)
+        get_service(user1.pk)
 
-        results = list(subscription_add_titles([sub]))
-        self.assertEqual(results, [sub])
+        authorize = credentials.new_from_json.return_value.authorize
+        self.assertEqual(authorize.call_count, 3)
+        self.assertEqual(service_factory.hits, 0)
 
-        self.assertEqual(sub.title, "henlo")
-        self.assertEqual(sub.description, "bluh bluh")
+    @mock.patch("subscribae.utils._log")
+    def test_log_stats(self, log_mock):
+        log_stats()
+        self.assertEqual(log_mock.info.call_args_list, [
+            (("Service factory stats: %s", service_factory.stats()),),
+            (("Tiered cache stats: %s", tiered_cache.stats()),),
+        ])
 
-        self.assertEqual(self.channel_mock.call_count, 0)
 
-    def test_no_objects(self):
-        results = list(subscription_add_titles([]))
+class BatchExecuteTestCase(TestCase):
+    def setUp(self):
+        super(BatchExecuteTestCase, self).setUp()
+        self.youtube = mock.Mock()
+        self.batches = []
+        self.youtube.new_batch_http_request.side_effect = self.new_batch
+
+    def new_batch(self, callback):
+        batch = mock.Mock()
+        requests = []
+
+        def execute():
+            for request_id, request in requests:
+                try:
+                    callback(request_id, request.execute(), None)
+                except Exception as exc:
+                    callback(request_id, None, exc)
+
+        batch.add.side_effect = lambda request, request_id: requests.append((request_id, request))
+        batch.execute.side_effect = execute
+        self.batches.append(batch)
+        return batch
+
+    def test_batch_execute(self):
+        requests = [mock.Mock(**{"execute.return_value": i}) for i in range(API_BATCH_LIMIT + 1)]
+
+        results = batch_execute(self.youtube, requests)
+        self.assertEqual(results, [(i, None) for i in range(API_BATCH_LIMIT + 1)])
+        self.assertEqual(len(self.batches), 2)
+        self.assertEqual(self.batches[0].add.call_count, API_BATCH_LIMIT)
+        self.assertEqual(self.batches[1].add.call_count, 1)
+
+    def test_batch_execute_exception(self):
+        exc = Exception()
+        requests = [mock.Mock(**{"execute.return_value": 1}), mock.Mock(**{"execute.side_effect": exc})]
+
+        results = batch_execute(self.youtube, requests)
+        self.assertEqual(results, [(1, None), (None, exc)])
+        self.assertEqual(len(self.batches), 1)
+
+    def test_batch_execute_empty(self):
+        results = batch_execute(self.youtube, [])
         self.assertEqual(results, [])
-        self.assertEqual(self.channel_mock.call_count, 0)
+        self.assertEqual(len(self.batches), 0)
 
 
-class AddTitlesVideoTestCase(TestCase):
+class FetchTitlesTestCase(TestCase):
     def setUp(self):
-        super(AddTitlesVideoTestCase, self).setUp()
-
-        self.service_patch = mock.patch('subscribae.utils.get_service')
-        self.service_mock = self.service_patch.start()
-
-        self.video_mock = self.service_mock.return_value.videos.return_value.list
-
-        self.video_mock.return_value.execute.return_value = {
-            'items': [
-                {
-                    'id': '123',
-                    'snippet': {
-                        "title": "henlo",
-                        "description": "bluh bluh",
-                    },
-                },
-                {
-                    'id': '456',
-                    'snippet': {
-                        "title": "bye-q",
-                        "description": "blah blah",
-                    },
-                },
-            ],
-        }
+        super(FetchTitlesTestCase, self).setUp()
+        self.youtube = mock.Mock()
+        self.resource = mock.Mock()
+        self.resource.list.side_effect = self.list
+
+        self.batch_patch = mock.patch('subscribae.utils.batch_execute', side_effect=fake_batch_execute)
+        self.batch_mock = self.batch_patch.start()
 
     def tearDown(self):
         mock.patch.stopall()
 
-    def test_clean_cache(self):
-        vid = VideoFactory.build(youtube_id="123")
-
-        cached_data = cache.get(VIDEO_TITLE_CACHE_PREFIX + "123")
-        self.assertEqual(cached_data, None)
-
-        results = list(video_add_titles([vid]))
-        self.assertEqual(results, [vid])
-
-        self.assertEqual(vid.title, "henlo")
-        self.assertEqual(vid.description, "bluh bluh")
-
-        self.assertEqual(self.video_mock.call_count, 1)
-        self.assertEqual(self.video_mock.call_args[1]["id"], "123")
-
-        cached_data = cache.get(VIDEO_TITLE_CACHE_PREFIX + "123")
-        self.assertEqual(cached_data, {"title": "henlo", "description": "bluh bluh"})
-
-    def test_cache_populated(self):
-        vid = VideoFactory.build(youtube_id="123")
-
-        cache.set(VIDEO_TITLE_CACHE_PREFIX + "123", {"title": "henlo", "description": "bluh bluh"})
-
-        results = list(video_add_titles([vid]))
-        self.assertEqual(results, [vid])
-
-        self.assertEqual(vid.title, "henlo")
-        self.assertEqual(vid.description, "bluh bluh")
-
-        self.assertEqual(self.video_mock.call_count, 0)
-
-    def test_no_objects(self):
-        results = list(video_add_titles([]))
-        self.assertEqual(results, [])
-        self.assertEqual(self.video_mock.call_count, 0)
+    def list(self, id, **kwargs):
+        items = [{"id": i, "snippet": {"title": "title %s" % i, "description": ""}} for i in id.split(",")]
+        return mock.Mock(**{"execute.return_value": {"items": items}})
+
+    def test_fetch_titles(self):
+        titles = fetch_titles(self.youtube, self.resource, ["1", "2"], "snippet", "items")
+        self.assertEqual(titles, {
+            "1": {"title": "title 1", "description": ""},
+            "2": {"title": "title 2", "description": ""},
+        })
+        self.assertEqual(self.resource.list.call_args, ((), {
+            "id": "1,2", "part": "snippet", "fields": "items", "maxResults": 2,
+        }))
+        # one chunk, no need for a batch
+        self.assertEqual(self.batch_mock.call_count, 0)
+
+    def test_fetch_titles_chunked(self):
+        ids = [str(i) for i in range(API_MAX_IDS * 2 + 1)]
+        titles = fetch_titles(self.youtube, self.resource, ids, "snippet", "items")
+        self.assertEqual(sorted(titles.keys()), sorted(ids))
+
+        self.assertEqual([len(call[1]["id"].split(",")) for call in self.resource.list.call_args_list],
+                         [API_MAX_IDS, API_MAX_IDS, 1])
+        # all chunks are sent together
+        self.assertEqual(self.batch_mock.call_count, 1)
+        self.assertEqual(len(self.batch_mock.call_args[0][1]), 3)
+
+    def test_fetch_titles_chunk_error(self):
+        exc = Exception()
+        self.batch_mock.side_effect = None
+        self.batch_mock.return_value = [({"items": []}, None), (None, exc)]
+
+        ids = [str(i) for i in range(API_MAX_IDS + 1)]
+        with self.assertRaises(Exception) as context:
+            fetch_titles(self.youtube, self.resource, ids, "snippet", "items")
+        self.assertIs(context.exception, exc)
@@ -0,0 +1,174 @@
+##
+#    Copyright (C) 2019  Matt Molyneaux <moggers87+git@moggers87.co.uk>
+#
+#    This file is part of Subscribae.
+#
+#    Subscribae is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Subscribae is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Subscribae.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from djangae.test import TestCase
+from google.appengine.api import memcache, taskqueue
+import mock
+
+from subscribae import viewed
+from subscribae.generations import BUCKET, SUBSCRIPTION
+from subscribae.models import Bucket, Video
+from subscribae.tests.utils import BucketFactory, SubscriptionFactory, VideoFactory
+from subscribae.viewed import (VIEWED_LEASE_SECONDS, VIEWED_QUEUE, apply_viewed_events, merge_pending_viewed,
+                               pending_viewed_key, record_viewed)
+
+
+class ViewedEventsTestCase(TestCase):
+    def setUp(self):
+        super(ViewedEventsTestCase, self).setUp()
+        self.bucket = BucketFactory()
+        self.videos = VideoFactory.create_batch(4, buckets=[self.bucket])
+        self.videos.sort(key=lambda video: video.ordering_key)
+
+    def leased(self):
+        return taskqueue.Queue(VIEWED_QUEUE).lease_tasks(1, 1000)
+
+    @mock.patch("subscribae.viewed.time")
+    def test_record_viewed(self, time_mock):
+        time_mock.time.return_value = 1000
+        record_viewed(BUCKET, self.bucket.pk, [self.videos[0].pk], self.videos[0].ordering_key)
+        record_viewed(BUCKET, self.bucket.pk, [self.videos[1].pk], self.videos[1].ordering_key)
+
+        self.assertEqual(len(self.leased()), 2)
+        # only one task to apply them
+        self.assertNumTasksEquals(1)
+        self.assertEqual(memcache.get(pending_viewed_key(BUCKET, self.bucket.pk)), self.videos[1].ordering_key)
+
+        self.bucket.refresh_from_db()
+        self.assertEqual(self.bucket.last_watched_video, "")
+        self.assertEqual(Video.objects.filter(viewed=True).count(), 0)
+
+    def test_merge_pending_viewed(self):
+        other_bucket = BucketFactory()
+        record_viewed(BUCKET, self.bucket.pk, [self.videos[2].pk], self.videos[2].ordering_key)
+
+        buckets = merge_pending_viewed(BUCKET, [self.bucket, other_bucket])
+        self.assertEqual([bucket.last_watched_video for bucket in buckets], [self.videos[2].ordering_key, ""])
+
+        # not saved
+        self.bucket.refresh_from_db()
+        self.assertEqual(self.bucket.last_watched_video, "")
+
+    def test_apply_viewed_events(self):
+        subscription = SubscriptionFactory()
+        sub_video = VideoFactory(subscription=subscription)
+
+        # out of order, like skipping back and forth in the player
+        for video in [self.videos[1], self.videos[3], self.videos[2]]:
+            record_viewed(BUCKET, self.bucket.pk, [video.pk], video.ordering_key)
+        record_viewed(SUBSCRIPTION, subscription.pk, [sub_video.pk], sub_video.ordering_key)
+
+        with mock.patch.object(Bucket, "save", autospec=True, side_effect=Bucket.save) as save_mock:
+            apply_viewed_events()
+        # one write for all the bucket's events
+        self.assertEqual(save_mock.call_count, 1)
+
+        self.bucket.refresh_from_db()
+        subscription.refresh_from_db()
+        # the latest event wins
+        self.assertEqual(self.bucket.last_watched_video, self.videos[2].ordering_key)
+        self.assertEqual(subscription.last_watched_video, sub_video.ordering_key)
+        self.assertEqual(set(Video.objects.filter(viewed=True)), {self.videos[1], self.videos[2], self.videos[3],
+                                                                  sub_video})
+
+        self.assertEqual(self.leased(), [])
+        self.assertEqual(memcache.get(pending_viewed_key(BUCKET, self.bucket.pk)), None)
+
+    def test_apply_viewed_events_empty(self):
+        apply_viewed_events()
+        self.assertNumTasksEquals(0)
+
+    def test_apply_viewed_events_newer_pending(self):
+        record_viewed(BUCKET, self.bucket.pk, [self.videos[0].pk], self.videos[0].ordering_key)
+
+        def newer_event(*args, **kwargs):
+            memcache.set(pending_viewed_key(BUCKET, self.bucket.pk), self.videos[1].ordering_key)
+
+        with mock.patch("subscribae.viewed.apply_viewed", side_effect=newer_event):
+            apply_viewed_events()
+
+        self.assertEqual(memcache.get(pending_viewed_key(BUCKET, self.bucket.pk)), self.videos[1].ordering_key)
+
+    def test_apply_viewed_events_race(self):
+        record_viewed(BUCKET, self.bucket.pk, [self.videos[0].pk], self.videos[0].ordering_key)
+        key = pending_viewed_key(BUCKET, self.bucket.pk)
+        gets = memcache.Client.gets
+
+        def newer_event(client, *args, **kwargs):
+            value = gets(client, *args, **kwargs)
+            # between checking the pending value and removing it
+            memcache.set(key, self.videos[1].ordering_key)
+            return value
+
+        with mock.patch.object(memcache.Client, "gets", autospec=True, side_effect=newer_event):
+            apply_viewed_events()
+
+        self.assertEqual(memcache.get(key), self.videos[1].ordering_key)
+
+    def test_apply_viewed_events_deleted_bucket(self):
+        other_bucket = BucketFactory()
+        record_viewed(BUCKET, self.bucket.pk, [self.videos[0].pk], self.videos[0].ordering_key)
+        record_viewed(BUCKET, other_bucket.pk, [self.videos[1].pk], self.videos[1].ordering_key)
+        self.bucket.delete()
+
+        apply_viewed_events()
+
+        other_bucket.refresh_from_db()
+        self.assertEqual(other_bucket.last_watched_video, self.videos[1].ordering_key)
+        self.assertEqual(self.leased(), [])
+
+    @mock.patch("subscribae.viewed.deferred")
+    def test_apply_viewed_events_error(self, defer_mock):
+        other_bucket = BucketFactory()
+        record_viewed(BUCKET, self.bucket.pk, [self.videos[0].pk], self.videos[0].ordering_key)
+        record_viewed(BUCKET, other_bucket.pk, [self.videos[1].pk], self.videos[1].ordering_key)
+        apply_viewed = viewed.apply_viewed
+
+        def fail_other_bucket(kind, obj_id, *args):
+            if obj_id == other_bucket.pk:
+                raise ValueError()
+            return apply_viewed(kind, obj_id, *args)
+
+        with mock.patch("subscribae.viewed.apply_viewed", side_effect=fail_other_bucket):
+            with self.assertRaises(ValueError):
+                apply_viewed_events()
+
+        # the failed event is tried again once its lease is up
+        self.assertEqual(defer_mock.defer.call_args, ((apply_viewed_events,), {"_countdown": VIEWED_LEASE_SECONDS}))
+        self.bucket.refresh_from_db()
+        self.assertEqual(self.bucket.last_watched_video, self.videos[0].ordering_key)
+        # the applied event was deleted, the failed one is still leased
+        self.assertEqual(self.leased(), [])
+        self.assertEqual(taskqueue.Queue(VIEWED_QUEUE).fetch_statistics().tasks, 1)
+
+    @mock.patch("subscribae.viewed.VIEWED_EVENT_BATCH_SIZE", 2)
+    def test_apply_viewed_events_full_batch(self):
+        with mock.patch("subscribae.viewed.schedule_viewed_events"):
+            for video in self.videos[:3]:
+                record_viewed(BUCKET, self.bucket.pk, [video.pk], video.ordering_key)
+
+        apply_viewed_events()
+        # there might be more, so it runs again
+        self.assertNumTasksEquals(1)
+        self.assertEqual(Video.objects.filter(viewed=True).count(), 2)
+
+        apply_viewed_events()
+        self.assertEqual(Video.objects.filter(viewed=True).count(), 3)
+        self.bucket.refresh_from_db()
+        self.assertEqual(self.bucket.last_watched_video, self.videos[2].ordering_key)
@@ -54,7 +54,6 @@ class ViewTestCase(TestCase):
         response = self.client.get(reverse('overview'))
         self.assertEqual(response.status_code, 200)
 
-    @mock.patch('subscribae.utils.subscription_add_titles', lambda x: x)
     def test_overview_has_items(self):
         subscriptions = SubscriptionFactory.create_batch(2, user=self.user)
         buckets = [
@@ -138,7 +137,6 @@ class ViewTestCase(TestCase):
         response = self.client.post(reverse('bucket-edit', kwargs={'bucket': new_bucket.pk}), data)
         self.assertEqual(response.status_code, 200)
 
-    @mock.patch('subscribae.utils.subscription_add_titles', lambda x: x)
     def test_subscription(self):
         response = self.client.get(reverse('subscription', kwargs={'subscription': 1}))
         self.assertEqual(response.status_code, 404)
@@ -174,6 +172,26 @@ class ViewTestCase(TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertNumTasksEquals(1)
 
+    def test_refresh_titles_cron(self):
+        response = self.client.get(reverse('refresh-titles-cron'))
+        self.assertEqual(response.status_code, 403)
+        self.assertNumTasksEquals(0)
+
+        with mock.patch("djangae.environment.is_in_cron"):
+            response = self.client.get(reverse('refresh-titles-cron'))
+            self.assertEqual(response.status_code, 200)
+            self.assertNumTasksEquals(1)
+
+    def test_backfill_titles_task(self):
+        response = self.client.get(reverse('backfill-titles-task'))
+        self.assertEqual(response.status_code, 403)
+        self.assertNumTasksEquals(0)
+
+        with mock.patch("djangae.environment.is_in_cron"):
+            response = self.client.get(reverse('backfill-titles-task'))
+            self.assertEqual(response.status_code, 200)
+            self.assertNumTasksEquals(1)
+
     def test_source(self):
         response = self.client.get(reverse('source'))
         self.assertEqual(response.status_code, 200)
@@ -17,6 +17,7 @@
 #    along with Subscribae.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+from apiclient.errors import HttpError
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 
@@ -47,6 +48,22 @@ class MockExecute(object):
             return self.last_value
 
 
+def fake_batch_execute(youtube, requests):
+    """Stand-in for subscribae.utils.batch_execute
+
+    Executes each request in turn so that mocked API calls can be inspected in
+    the same way as unbatched calls
+    """
+    results = []
+    for request in requests:
+        try:
+            results.append((request.execute(), None))
+        except HttpError as exc:
+            results.append((None, exc))
+
+    return results
+
+
 class UserFactory(factory.django.DjangoModelFactory):
     class Meta:
         model = get_user_model()
@@ -68,6 +68,10 @@ urlpatterns = (
 
     # crons
     url(r'^cron/update_subscriptions$', tasks.update_subscriptions_cron, name='update-subscriptions-cron'),
+    url(r'^cron/refresh_titles$', tasks.refresh_titles_cron, name='refresh-titles-cron'),
+
+    # one-off tasks, visit as an admin
+    url(r'^tasks/backfill_titles$', tasks.backfill_titles_task, name='backfill-titles-task'),
 
     url(r'^_ah/', include('djangae.urls')),
 
@@ -17,11 +17,16 @@
 #    along with Subscribae.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+from collections import OrderedDict, namedtuple
 from datetime import timedelta
 import logging
 import os
+import threading
+import time
 
-from apiclient.discovery import build
+from apiclient.discovery import Resource, build
+from apiclient.errors import HttpError
+from djangae.db import transaction
 from django.conf import settings
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
@@ -33,22 +38,42 @@ from google.appengine.runtime import DeadlineExceededError as RuntimeExceededErr
 from oauth2client import client
 import httplib2
 
-from subscribae.models import Bucket, OauthToken, SiteConfig, Subscription, Video, create_composite_key
+from subscribae.generations import bump_video_generations
+from subscribae.local_cache import tiered_cache
+from subscribae.models import (Bucket, OauthToken, SiteConfig, Subscription, SubscriptionListPage, TitleRefresh, Video,
+                               create_composite_key)
+from subscribae.quota import API_COSTS, MIN_USER_SHARE, QuotaHttpRequest, QuotaScheduler, is_quota_error, quota_ledger
 
 API_NAME = 'youtube'
 API_VERSION = 'v3'
 API_MAX_RESULTS = 10
+# most results a list call will return in one page
+API_MAX_PAGE_SIZE = 50
+API_BATCH_LIMIT = 50
+# most ids a single list call will accept
+API_MAX_IDS = 50
+# ids refresh_model_titles fetches at a time, fetch_titles sends the list
+# calls for them in one batch request
+TITLE_REFRESH_CHUNK_SIZE = API_MAX_IDS * 10
 USER_SHARD = 500
+SERVICE_HTTP_CACHE_SIZE = 20
+# leave some of the 10 minute task deadline for deferring what's left
+IMPORT_TASK_TIME_LIMIT = 8 * 60
 
 CHANNEL_FIELDS = "items(contentDetails(relatedPlaylists))"
 CHANNEL_PARTS = "contentDetails"
 CHANNEL_TITLE_FIELDS = "items(snippet(title, description))"
 CHANNEL_TITLE_PARTS = "snippet"
-SUBSCRIPTION_FIELDS = "items(snippet(resourceId(channelId),thumbnails))"
+SUBSCRIPTION_FIELDS = "etag,items(snippet(resourceId(channelId),thumbnails,title,description))"
 SUBSCRIPTION_PARTS = "snippet"
-PLAYLIST_FIELDS = "items(contentDetails(videoId))"
+# Subscription fields that come from the API and are updated on sync
+SUBSCRIPTION_SYNC_FIELDS = ["thumbnails", "upload_playlist", "title", "description"]
+PLAYLIST_FIELDS = "etag,items(contentDetails(videoId,videoPublishedAt))"
 PLAYLIST_PARTS = "contentDetails"
-VIDEO_FIELDS = "items(snippet(publishedAt,thumbnails))"
+# everything save_videos needs, so videos().list doesn't need to be called
+PLAYLIST_VIDEO_FIELDS = "etag,items(snippet(thumbnails,title,description),contentDetails(videoId,videoPublishedAt))"
+PLAYLIST_VIDEO_PARTS = "snippet,contentDetails"
+VIDEO_FIELDS = "items(snippet(publishedAt,thumbnails,title,description))"
 VIDEO_PARTS = "snippet"
 VIDEO_TITLE_FIELDS = "items(snippet(title, description))"
 VIDEO_TITLE_PARTS = "snippet"
@@ -57,12 +82,38 @@ VIDEO_TITLE_PARTS = "snippet"
 SITE_CONFIG_ID = 19871022
 
 SITE_CONFIG_CACHE_KEY = "subscribae-site-config-%s" % SITE_CONFIG_ID
-SUBSCRIPTION_TITLE_CACHE_PREFIX = "sub-title"
 VIDEO_TITLE_CACHE_PREFIX = "video-title"
 TITLE_CACHE_TIMEOUT = timedelta(days=28).total_seconds()  # 28 days
+OAUTH_TOKEN_CACHE_TIMEOUT = timedelta(hours=1).total_seconds()
+TITLE_REFRESH_PERIOD = timedelta(days=7)
+# videos missing from this many refreshes in a row become tombstones, which
+# are checked less often in case they come back
+TOMBSTONE_MISSES = 3
+TOMBSTONE_REFRESH_PERIOD = timedelta(days=28)
+# refreshed objects are only saved if one of these has changed
+TITLE_REFRESH_FIELDS = ("title", "description", "tombstone", "missed_refreshes")
+# ids the API didn't return anything for, so we don't keep asking about them
+MISSING_CACHE_TIMEOUT = timedelta(days=1).total_seconds()
+MISSING_TITLE = {"title": "", "description": "", "missing": True}
+# XG transactions can touch 25 entity groups
+XG_BATCH_SIZE = 25
+
+# how many users are sharing the API quota, see QuotaScheduler
+SYNC_USERS_CACHE_KEY = "sync-users"
+SYNC_USERS_CACHE_TIMEOUT = timedelta(hours=1).total_seconds()
+# how often update_subscriptions runs, see cron.yaml
+SYNC_INTERVAL = timedelta(hours=6)
+
+# channel id to uploads playlist mappings that playlistItems has accepted
+UPLOAD_PLAYLIST_CACHE_PREFIX = "upload-playlist"
+UPLOAD_PLAYLIST_CACHE_TIMEOUT = timedelta(days=28).total_seconds()
 
 _log = logging.getLogger(__name__)
 
+# a playlist to be imported by import_playlists, starting from `page_token`
+ImportWork = namedtuple("ImportWork", ["subscription_id", "playlist", "bucket_ids", "page_token",
+                                       "only_first_page", "watermark"])
+
 
 def get_oauth_flow(user):
     redirect_uri = "https://%s%s" % (os.environ['HTTP_HOST'], reverse("oauth2callback"))
@@ -85,235 +136,1092 @@ def get_oauth_flow(user):
     return flow
 
 
-def get_service(user_id, cache=True):
-    http_kwargs = {}
-    if cache:
-        http_kwargs["cache"] = memcache
-    token = OauthToken.objects.get(user_id=user_id)
-    credentials = token.get()
-    http = credentials.authorize(httplib2.Http(**http_kwargs))
+def get_oauth_token(user_id):
+    """Get a user's OauthToken, from the cache if possible
 
-    service = build(API_NAME, API_VERSION, http=http)
-    return service
+    Tokens are removed from the cache when they're saved or deleted. They're
+    not put in tiered_cache, so credentials don't sit in every instance's
+    memory and other instances can't keep using a deleted token.
+    """
+    key = OauthToken.cache_key(user_id)
+    data = cache.get(key)
+    if data is None:
+        token = OauthToken.objects.get(user_id=user_id)
+        cache.set(key, token.data, OAUTH_TOKEN_CACHE_TIMEOUT)
+        return token
 
+    return OauthToken(user_id=user_id, data=data)
 
-def subscription_add_titles(objects):
-    objects = list(objects)
-    if len(objects) == 0:
-        return
 
-    channel_data = {}
-    youtube = get_service(objects[0].user_id)
-    channel_ids = []
-    for obj in objects:
-        data = cache.get("{}{}".format(SUBSCRIPTION_TITLE_CACHE_PREFIX, obj.channel_id))
-        if data:
-            channel_data[obj.channel_id] = data
-        else:
-            channel_ids.append(obj.channel_id)
-
-    if len(channel_ids) > 0:
-        channel_list = youtube.channels().list(id=','.join(channel_ids), part=CHANNEL_TITLE_PARTS,
-                                               fields=CHANNEL_TITLE_FIELDS, maxResults=len(objects)).execute()
-
-        for chan in channel_list["items"]:
-            data = {"title": chan["snippet"]["title"], "description": chan["snippet"]["description"]}
-            cache.set(
-                "{}{}".format(SUBSCRIPTION_TITLE_CACHE_PREFIX, chan["id"]),
-                data
-            )
-            channel_data[chan["id"]] = data
-
-    for obj in objects:
-        data = channel_data.get(obj.channel_id, {"title": "", "description": ""})
-        obj.title = data["title"]
-        obj.description = data["description"]
-        yield obj
-
-
-def video_add_titles(objects):
-    objects = list(objects)
-    if len(objects) == 0:
-        return
+class ServiceFactory(object):
+    """Builds YouTube API services
 
-    video_data = {}
-    youtube = get_service(objects[0].user_id, False)
-    video_ids = []
-    for obj in objects:
-        data = cache.get("{}{}".format(VIDEO_TITLE_CACHE_PREFIX, obj.youtube_id))
-        if data:
-            video_data[obj.youtube_id] = data
+    Building a service from scratch means fetching and parsing the discovery
+    document, so that's only done once per instance. Each user then gets a
+    lightweight copy of that resource bound to their own authorised HTTP
+    object.
+
+    Authorised HTTP objects are kept per thread (httplib2 isn't thread safe)
+    so that connections and access tokens can be reused by later calls for the
+    same user.
+    """
+    def __init__(self, max_size=SERVICE_HTTP_CACHE_SIZE):
+        self.max_size = max_size
+        self.reset()
+
+    def reset(self):
+        """Forget the discovery resource, authorised HTTP objects and counters"""
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._resource = None
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.build_time = 0.0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "builds": self.builds,
+            "build_time": self.build_time,
+        }
+
+    def _get_resource(self):
+        with self._lock:
+            if self._resource is None:
+                start = time.time()
+                # the discovery document itself doesn't need an authorised
+                # HTTP object, so cache it in memcache for other instances
+                self._resource = build(API_NAME, API_VERSION, http=httplib2.Http(cache=memcache))
+                self.builds += 1
+                self.build_time += time.time() - start
+
+            return self._resource
+
+    def _get_http(self, token, cache):
+        http_cache = getattr(self._local, "http", None)
+        if http_cache is None:
+            http_cache = self._local.http = OrderedDict()
+
+        key = (token.user_id, cache)
+        data, http = http_cache.pop(key, (None, None))
+        # token data changes if the user authorises us again
+        if http is not None and data == token.data:
+            with self._lock:
+                self.hits += 1
         else:
-            video_ids.append(obj.youtube_id)
+            http_kwargs = {}
+            if cache:
+                http_kwargs["cache"] = memcache
+            credentials = token.get()
+            http = credentials.authorize(httplib2.Http(**http_kwargs))
+            with self._lock:
+                self.misses += 1
+
+        http_cache[key] = (token.data, http)
+        while len(http_cache) > self.max_size:
+            http_cache.popitem(last=False)
+
+        return http
+
+    def get(self, user_id, cache=True):
+        token = get_oauth_token(user_id)
+        http = self._get_http(token, cache)
+        resource = self._get_resource()
+
+        return Resource(
+            http=http,
+            baseUrl=resource._baseUrl,
+            model=resource._model,
+            requestBuilder=QuotaHttpRequest,
+            developerKey=resource._developerKey,
+            resourceDesc=resource._resourceDesc,
+            rootDesc=resource._rootDesc,
+            schema=resource._schema,
+        )
+
+
+service_factory = ServiceFactory()
+
+
+def get_service(user_id, cache=True):
+    return service_factory.get(user_id, cache)
+
+
+def log_stats():
+    """Log this instance's counters, which are kept for as long as it runs"""
+    _log.info("Service factory stats: %s", service_factory.stats())
+    _log.info("Tiered cache stats: %s", tiered_cache.stats())
+
+
+def fetch_titles(youtube, resource, ids, parts, fields):
+    """Fetch titles and descriptions for `ids` from `resource`
+
+    The API only accepts API_MAX_IDS ids per call, so ids are split into
+    chunks. If there's more than one chunk they're all sent in a single batch
+    request rather than one after the other. Returns a dict of id to data.
+    """
+    requests = []
+    for start in range(0, len(ids), API_MAX_IDS):
+        chunk = ids[start:start + API_MAX_IDS]
+        requests.append(resource.list(id=','.join(chunk), part=parts, fields=fields, maxResults=len(chunk)))
+
+    if len(requests) == 1:
+        results = [(requests[0].execute(), None)]
+    else:
+        results = batch_execute(youtube, requests)
+
+    titles = {}
+    for response, exception in results:
+        if exception is not None:
+            raise exception
+        for item in response["items"]:
+            titles[item["id"]] = {"title": item["snippet"]["title"], "description": item["snippet"]["description"]}
 
-    if len(video_ids) > 0:
-        video_list = youtube.videos().list(id=','.join(video_ids), part=VIDEO_TITLE_PARTS,
-                                           fields=VIDEO_TITLE_FIELDS, maxResults=len(objects)).execute()
+    return titles
 
-        for vid in video_list["items"]:
-            data = {"title": vid["snippet"]["title"], "description": vid["snippet"]["description"]}
-            cache.set(
-                "{}{}".format(VIDEO_TITLE_CACHE_PREFIX, vid["id"]),
-                data
-            )
-            video_data[vid["id"]] = data
 
-    for obj in objects:
-        data = video_data.get(obj.youtube_id, {"title": "", "description": ""})
-        obj.title = data["title"]
-        obj.description = data["description"]
-        yield obj
+def cache_titles(prefix, ids, titles):
+    """Cache `titles` fetched for `ids`, along with a marker for those missing"""
+    if titles:
+        tiered_cache.set_many({"{}{}".format(prefix, id): data for id, data in titles.items()}, TITLE_CACHE_TIMEOUT)
+
+    missing = set(ids) - set(titles.keys())
+    if missing:
+        _log.debug("No titles for %s", missing)
+        tiered_cache.set_many({"{}{}".format(prefix, id): MISSING_TITLE for id in missing}, MISSING_CACHE_TIMEOUT)
+
+
+def is_missing(data):
+    return data is not None and data.get("missing", False)
+
+
+def batch_execute(youtube, requests):
+    """Execute API requests using as few HTTP requests as possible
+
+    Requests are sent in multipart batches of up to API_BATCH_LIMIT. Returns a
+    list of `(response, exception)` tuples in the same order as `requests`
+    """
+    results = [(None, None)] * len(requests)
+
+    def callback(request_id, response, exception):
+        results[int(request_id)] = (response, exception)
+
+    for start in range(0, len(requests), API_BATCH_LIMIT):
+        batch = youtube.new_batch_http_request(callback=callback)
+        for idx, request in enumerate(requests[start:start + API_BATCH_LIMIT], start):
+            quota_ledger.charge(request.methodId)
+            batch.add(request, request_id=str(idx))
+        batch.execute()
+
+    return results
+
+
+def is_not_modified(exc):
+    """Returns True if `exc` is the API responding to a conditional request"""
+    return isinstance(exc, HttpError) and exc.resp.status == 304
+
+
+def is_not_found(exc):
+    """Returns True if `exc` is the API telling us something doesn't exist"""
+    return isinstance(exc, HttpError) and exc.resp.status == 404
+
+
+def is_client_error(exc):
+    """Returns True if `exc` is a 4xx from the API that retrying won't fix
+
+    Running out of quota and rate limiting go away by themselves, so they
+    don't count.
+    """
+    if not isinstance(exc, HttpError) or is_quota_error(exc):
+        return False
+    return 400 <= exc.resp.status < 500 and exc.resp.status != 429
+
+
+def derive_upload_playlist(channel_id):
+    """Work out the uploads playlist of a channel from its ID
+
+    Channel IDs are "UC" followed by 22 characters and, for ordinary channels,
+    the uploads playlist is the same ID with "UU" instead. Returns None for IDs
+    that don't look like that.
+    """
+    if len(channel_id) == 24 and channel_id.startswith("UC"):
+        return "UU" + channel_id[2:]
+
+
+def upload_playlist_cache_key(channel_id):
+    return "{}{}".format(UPLOAD_PLAYLIST_CACHE_PREFIX, channel_id)
+
+
+def get_upload_playlists(channel_ids):
+    """Get confirmed uploads playlists for `channel_ids` from the cache"""
+    keys = {upload_playlist_cache_key(channel_id): channel_id for channel_id in channel_ids}
+    if not keys:
+        return {}
+    return {keys[key]: playlist for key, playlist in tiered_cache.get_many(keys.keys()).items()}
+
+
+def confirm_upload_playlists(playlists):
+    """Cache channel ID to uploads playlist mappings that we know work
+
+    These are the same for every user, so they're shared between them
+    """
+    if playlists:
+        tiered_cache.set_many({upload_playlist_cache_key(channel_id): playlist
+                               for channel_id, playlist in playlists.items()}, UPLOAD_PLAYLIST_CACHE_TIMEOUT)
+
+
+def fetch_upload_playlists(youtube, channel_ids):
+    """Ask the channels endpoint for the uploads playlists of `channel_ids`
+
+    Channels the API has no data for are left out
+    """
+    playlists = {}
+    for start in range(0, len(channel_ids), API_MAX_IDS):
+        chunk = channel_ids[start:start + API_MAX_IDS]
+        channel_list = youtube.channels().list(id=','.join(chunk), part=CHANNEL_PARTS, fields=CHANNEL_FIELDS,
+                                               maxResults=API_MAX_RESULTS).execute()
+        for chn in channel_list['items']:
+            playlists[chn['id']] = chn['contentDetails']['relatedPlaylists']['uploads']
+
+    # there are times when a subscription has a channel id, but there
+    # isn't channel data for whatever reason, e.g. I'm subscribed to
+    # UCMzNCTNmDMBO9oueVWpuOMg but there's no data from the channel API
+    missing_channels = set(channel_ids) - set(playlists)
+    extra_channels = set(playlists) - set(channel_ids)
+    _log.info("Missing these IDs from the channel list endpoint: %s", missing_channels)
+    _log.info("Extra IDs from the channel list endpoint: %s", extra_channels)
+
+    return {channel_id: playlist for channel_id, playlist in playlists.items() if channel_id in channel_ids}
+
+
+def subscription_bucket_map(user_id):
+    """Map a user's subscription IDs to the IDs of the buckets they're in
+
+    Saves a query per subscription when syncing
+    """
+    bucket_map = {}
+    for bucket in Bucket.objects.filter(user_id=user_id):
+        for subscription_id in bucket.subs_ids:
+            bucket_map.setdefault(subscription_id, []).append(bucket.pk)
+
+    for bucket_ids in bucket_map.itervalues():
+        bucket_ids.sort()
+
+    return bucket_map
+
+
+def defer_until_quota_reset(func, *args, **kwargs):
+    """Defer a task until some time after the API quota has been reset"""
+    eta = QuotaScheduler().after_reset()
+    _log.warning("Out of API quota, deferring %s until %s", func.__name__, eta)
+    kwargs["_eta"] = eta
+    deferred.defer(func, *args, **kwargs)
+
+
+def defer_until_next_sync(func, *args, **kwargs):
+    """Defer a task that has spent its share of the API quota until the next sync"""
+    _log.info("Share of API quota spent, deferring %s for %s", func.__name__, SYNC_INTERVAL)
+    kwargs["_countdown"] = SYNC_INTERVAL.total_seconds()
+    deferred.defer(func, *args, **kwargs)
+
+
+def sync_user_count():
+    """How many active users share the API quota"""
+    count = memcache.get(SYNC_USERS_CACHE_KEY)
+    if count is None:
+        count = len([obj for obj in OauthToken.objects.all() if obj.user.is_active])
+        memcache.set(SYNC_USERS_CACHE_KEY, count, SYNC_USERS_CACHE_TIMEOUT)
+    return count
 
 
 def update_subscriptions(last_pk=None):
+    """Defer a subscriptions task for each user that has a share of the quota"""
+    scheduler = QuotaScheduler()
     try:
         qs = OauthToken.objects.order_by("pk").all()
         if last_pk:
             qs = qs.filter(pk__gt=last_pk)
 
-        for obj in qs.iterator():
-            if obj.user.is_active:
+        # inactive users can't be synced, so they don't get a share
+        tokens = [obj for obj in qs.iterator() if obj.user.is_active]
+        if last_pk is None:
+            memcache.set(SYNC_USERS_CACHE_KEY, len(tokens), SYNC_USERS_CACHE_TIMEOUT)
+
+        users_left = len(tokens)
+        for obj in tokens:
+            share = scheduler.user_share(users_left)
+            if scheduler.should_sync_user(obj.user, share):
                 deferred.defer(subscriptions, obj.user_id)
+                # the task won't have spent anything yet
+                scheduler.allocate(share)
+            else:
+                _log.info("Not enough API quota to sync %s", obj.user_id)
+            users_left -= 1
             last_pk = obj.pk
     except RuntimeExceededError:
         deferred.defer(update_subscriptions, last_pk)
 
 
-def subscriptions(user_id, page_token=None):
+def subscription_page(youtube, user_id, subscription_list, bucket_map):
+    """Update subscriptions from a page of the subscription list
+
+    Returns a list of work for import_first_pages
+    """
+    now = timezone.now()
+    subscription_data = {}
+    for item in subscription_list['items']:
+        channel_id = item['snippet']['resourceId']['channelId']
+
+        subscription_data[channel_id] = dict(
+            id=create_composite_key(str(user_id), channel_id),
+            user_id=user_id,
+            last_update=now,
+            channel_id=channel_id,
+            thumbnails={size: value.get('url', '') for size, value in item['snippet']['thumbnails'].items()},
+            title=item['snippet'].get('title', ''),
+            description=item['snippet'].get('description', ''),
+            titles_updated=now,
+            upload_playlist=None,
+        )
+
+    keys = [data['id'] for data in subscription_data.itervalues()]
+    existing = {obj.pk: obj for obj in Subscription.objects.filter(pk__in=keys)} if keys else {}
+
+    # most uploads playlists can be worked out from the channel ID, only ask
+    # the channels endpoint about the ones that can't. If a derived playlist
+    # turns out to be wrong, import_first_pages asks the channels endpoint
+    confirmed = get_upload_playlists(subscription_data.keys())
+    lookup = []
+    for channel_id, data in subscription_data.items():
+        obj = existing.get(data['id'])
+        playlist = confirmed.get(channel_id) or (obj and obj.upload_playlist) or derive_upload_playlist(channel_id)
+        if playlist:
+            data['upload_playlist'] = playlist
+        else:
+            lookup.append(channel_id)
+
+    if lookup:
+        playlists = fetch_upload_playlists(youtube, sorted(lookup))
+        for channel_id in lookup:
+            if channel_id in playlists:
+                subscription_data[channel_id]['upload_playlist'] = playlists[channel_id]
+            else:
+                del subscription_data[channel_id]
+
+    work = []
+    new_subscriptions = []
+    for data in subscription_data.itervalues():
+        key = data.pop('id')
+        obj = existing.get(key)
+        if obj is None:
+            obj = Subscription(id=key, **data)
+            new_subscriptions.append(obj)
+            work.append((obj, [], True))
+            continue
+
+        # only write subscriptions that have actually changed
+        if any(getattr(obj, field) != data[field] for field in SUBSCRIPTION_SYNC_FIELDS):
+            for field in SUBSCRIPTION_SYNC_FIELDS:
+                setattr(obj, field, data[field])
+            obj.last_update = data['last_update']
+            obj.titles_updated = data['titles_updated']
+            obj.save()
+            _log.debug("Subscription %s updated", obj.id)
+
+        work.append((obj, bucket_map.get(obj.pk, []), False))
+
+    if new_subscriptions:
+        Subscription.objects.bulk_create(new_subscriptions)
+        _log.debug("Subscriptions %s created", [obj.id for obj in new_subscriptions])
+
+    return work
+
+
+def subscriptions(user_id, page_token=None, bucket_map=None):
     """Import new subscriptions into the system
 
     Loops over subscription data from API, adding new suscriptions and updating
-    old ones
+    old ones. `bucket_map` is passed between tasks of the same sync so it
+    doesn't need to be built for each one
     """
+    if QuotaScheduler().is_exhausted():
+        defer_until_quota_reset(subscriptions, user_id, page_token)
+        return
+
     try:
         try:
-            youtube = get_service(user_id)
+            # conditional requests are made with our own ETags, so don't let
+            # httplib2 turn 304s back into 200s
+            youtube = get_service(user_id, False)
         except OauthToken.DoesNotExist:
             return
 
+        if bucket_map is None:
+            bucket_map = subscription_bucket_map(user_id)
+
         while True:
-            subscription_data = {}
-            subscription_list = youtube.subscriptions().list(mine=True, part=SUBSCRIPTION_PARTS,
-                                                             fields=SUBSCRIPTION_FIELDS,
-                                                             maxResults=API_MAX_RESULTS,
-                                                             pageToken=page_token).execute()
+            page_key = create_composite_key(str(user_id), page_token or "")
+            list_page = SubscriptionListPage.objects.filter(pk=page_key).first()
 
-            for item in subscription_list['items']:
-                channel_id = item['snippet']['resourceId']['channelId']
+            request = youtube.subscriptions().list(mine=True, part=SUBSCRIPTION_PARTS, fields=SUBSCRIPTION_FIELDS,
+                                                   maxResults=API_MAX_PAGE_SIZE, pageToken=page_token)
+            if list_page is not None and list_page.etag:
+                request.headers["If-None-Match"] = list_page.etag
+
+            try:
+                subscription_list = request.execute()
+            except HttpError as exc:
+                if not is_not_modified(exc):
+                    raise
+                subscription_list = None
+
+            if subscription_list is None:
+                # nothing has changed, so there's nothing to update. We still
+                # need to check for new videos though
+                _log.debug("Subscription list page %s not modified", page_key)
+                work = []
+                for obj in list_page.subscriptions.all():
+                    work.append((obj, bucket_map.get(obj.pk, []), False))
+
+                import_first_pages(youtube, user_id, work)
+                next_page_token = list_page.next_page_token
+            else:
+                work = subscription_page(youtube, user_id, subscription_list, bucket_map)
+                import_first_pages(youtube, user_id, work)
+                next_page_token = subscription_list.get('nextPageToken')
 
-                subscription_data[channel_id] = dict(
-                    id=create_composite_key(str(user_id), channel_id),
+                SubscriptionListPage.objects.update_or_create(id=page_key, defaults=dict(
                     user_id=user_id,
-                    last_update=timezone.now(),
-                    channel_id=channel_id,
-                    thumbnails={size: value.get('url', '') for size, value in item['snippet']['thumbnails'].items()},
-                    upload_playlist=None,  # must fetch this from the channel data
-                )
-
-            ids_from_sub = sorted(subscription_data.keys())
-
-            channel_list = youtube.channels().list(id=','.join(ids_from_sub), part=CHANNEL_PARTS,
-                                                   fields=CHANNEL_FIELDS, maxResults=API_MAX_RESULTS).execute()
-            ids_from_chan = [channel['id'] for channel in channel_list['items']]
-
-            # there are times when a subscription has a channel id, but there
-            # isn't channel data for whatever reason, e.g. I'm subscribed to
-            # UCMzNCTNmDMBO9oueVWpuOMg but there's no data from the channel API
-            missing_channels = set(ids_from_sub) - set(ids_from_chan)
-            extra_channels = set(ids_from_chan) - set(ids_from_sub)
-            _log.info("Missing these IDs from the channel list endpoint: %s", missing_channels)
-            _log.info("Extra IDs from the channel list endpoint: %s", extra_channels)
-
-            for chn in channel_list['items']:
-                if chn['id'] in ids_from_sub:
-                    subscription_data[chn['id']]['upload_playlist'] = \
-                            chn['contentDetails']['relatedPlaylists']['uploads']
-
-            for data in subscription_data.itervalues():
-                if data['channel_id'] in missing_channels:
-                    continue
-
-                key = data.pop('id')
-                obj, created = Subscription.objects.update_or_create(id=key, defaults=data)
-                _log.debug("Subscription %s%s created", obj.id, "" if created else " not")
-                bucket_ids = []
-                if not created:
-                    bucket_ids = Bucket.objects.order_by("pk").filter(subs__contains=obj).values_list('pk', flat=True)
-                    bucket_ids = list(bucket_ids)
-                deferred.defer(import_videos, user_id, key, obj.upload_playlist, bucket_ids, only_first_page=created)
-
-            if 'nextPageToken' in subscription_list:
-                page_token = subscription_list['nextPageToken']
+                    page_token=page_token or "",
+                    next_page_token=next_page_token or "",
+                    etag=subscription_list.get('etag', ""),
+                    subscriptions_ids=set(item[0].pk for item in work),
+                ))
+
+            if next_page_token:
+                page_token = next_page_token
             else:
                 break
     except RuntimeExceededError:
-        deferred.defer(subscriptions, user_id, page_token)
+        deferred.defer(subscriptions, user_id, page_token, bucket_map=bucket_map)
+    except HttpError as exc:
+        if not is_quota_error(exc):
+            raise
+        quota_ledger.exhaust()
+        defer_until_quota_reset(subscriptions, user_id, page_token)
+
+    log_stats()
+
+
+def playlist_items_request(youtube, playlist, page_token=None):
+    if settings.IMPORT_VIDEOS_FROM_PLAYLIST:
+        parts, fields = PLAYLIST_VIDEO_PARTS, PLAYLIST_VIDEO_FIELDS
+    else:
+        parts, fields = PLAYLIST_PARTS, PLAYLIST_FIELDS
+
+    return youtube.playlistItems().list(playlistId=playlist, part=parts, fields=fields, pageToken=page_token,
+                                        maxResults=API_MAX_RESULTS)
+
+
+def videos_request(youtube, video_ids):
+    return youtube.videos().list(id=','.join(video_ids), part=VIDEO_PARTS, fields=VIDEO_FIELDS,
+                                 maxResults=API_MAX_RESULTS)
+
+
+def playlist_videos(playlistitem_list, video_ids):
+    """Video data for `video_ids` taken from a page of playlist items
+
+    The result looks like a videos().list response. Private and deleted videos
+    don't have a videoPublishedAt, so they're left out just as videos().list
+    would leave them out.
+    """
+    wanted = set(video_ids)
+    items = []
+    for item in playlistitem_list['items']:
+        details = item['contentDetails']
+        if details['videoId'] not in wanted or 'videoPublishedAt' not in details:
+            continue
+
+        snippet = item.get('snippet', {})
+        items.append({
+            'id': details['videoId'],
+            'snippet': {
+                'publishedAt': details['videoPublishedAt'],
+                'thumbnails': snippet.get('thumbnails', {}),
+                'title': snippet.get('title', ''),
+                'description': snippet.get('description', ''),
+            },
+        })
+
+    return {'items': items}
+
+
+def new_playlist_items(playlistitem_list, watermark):
+    """Split a page of playlist items at `watermark`
+
+    Returns the IDs of videos published after `watermark` and whether or not
+    the watermark was reached
+    """
+    video_ids = []
+    reached_watermark = False
+    for item in playlistitem_list['items']:
+        published = item['contentDetails'].get('videoPublishedAt')
+        if watermark is not None and published is not None and parse_datetime(published) <= watermark:
+            reached_watermark = True
+        else:
+            video_ids.append(item['contentDetails']['videoId'])
+
+    return video_ids, reached_watermark
+
+
+def drop_missing_videos(video_ids):
+    """Remove videos that the API recently told us it doesn't have
+
+    Deleted and private videos stay in playlists, but there's no point asking
+    for them every time we see them
+    """
+    if not video_ids:
+        return video_ids
 
+    keys = ["{}{}".format(VIDEO_TITLE_CACHE_PREFIX, video_id) for video_id in video_ids]
+    missing = {key for key, data in tiered_cache.get_many(keys).items() if is_missing(data)}
+    return [video_id for key, video_id in zip(keys, video_ids) if key not in missing]
 
-def import_videos(user_id, subscription_id, playlist, bucket_ids, page_token=None, only_first_page=False):
+
+def playlist_head(playlistitem_list):
+    if len(playlistitem_list['items']) > 0:
+        return playlistitem_list['items'][0]['contentDetails']['videoId']
+
+
+def save_videos(user_id, subscription_id, bucket_ids, ids_from_playlist, video_list):
+    """Create Video objects from video data
+
+    All the keys are fetched in one go and only videos that don't exist yet
+    are written, in a single batch. Titles are cached as we've got them
+    anyway. Returns a tuple of how many videos were created, how many had been
+    imported before and the newest `published_at` of the videos that were
+    created
+    """
+    ids_from_video = [video['id'] for video in video_list['items']]
+
+    missing_videos = set(ids_from_playlist) - set(ids_from_video)
+    extra_videos = set(ids_from_video) - set(ids_from_playlist)
+    _log.info("Missing these IDs from the video list endpoint: %s", missing_videos)
+    _log.info("Extra IDs from the video list endpoint: %s", extra_videos)
+    if ids_from_playlist:
+        cache_titles(VIDEO_TITLE_CACHE_PREFIX, ids_from_playlist, {
+            video['id']: {"title": video['snippet'].get('title', ''),
+                          "description": video['snippet'].get('description', '')}
+            for video in video_list['items'] if video['id'] in ids_from_playlist
+        })
+
+    now = timezone.now()
+    videos = OrderedDict()
+    for video in video_list['items']:
+        if video['id'] not in ids_from_playlist:
+            continue
+
+        key = create_composite_key(str(user_id), video['id'])
+        videos[key] = Video(
+            id=key,
+            subscription_id=subscription_id,
+            user_id=user_id,
+            published_at=parse_datetime(video['snippet']['publishedAt']),
+            thumbnails={size: value.get('url', '') for size, value in video['snippet']['thumbnails'].items()},
+            youtube_id=video['id'],
+            title=video['snippet'].get('title', ''),
+            description=video['snippet'].get('description', ''),
+            titles_updated=now,
+            buckets_ids=bucket_ids,
+        )
+
+    if len(videos) == 0:
+        return 0, 0, None
+
+    # we've seen these videos before, therefore we've already imported them
+    existing = set(Video.objects.filter(pk__in=videos.keys()).values_list("pk", flat=True))
+    new_videos = [obj for key, obj in videos.items() if key not in existing]
+    _log.debug("Videos %s not created", existing)
+
+    if new_videos:
+        Video.objects.bulk_create(new_videos)
+        _log.debug("Videos %s created", [obj.pk for obj in new_videos])
+        bump_video_generations(new_videos)
+        newest = max(obj.published_at for obj in new_videos)
+    else:
+        newest = None
+
+    return len(new_videos), len(existing), newest
+
+
+def update_playlist_state(subscription, playlistitem_list, newest):
+    """Record what we've seen of the first page of a subscription's playlist"""
+    changes = {}
+    etag = playlistitem_list.get('etag', "")
+    if etag != subscription.playlist_etag:
+        changes["playlist_etag"] = etag
+
+    head = playlist_head(playlistitem_list)
+    if head is not None and head != subscription.head_video_id:
+        changes["head_video_id"] = head
+
+    watermark = subscription.last_video_published_at
+    if newest is not None and (watermark is None or newest > watermark):
+        changes["last_video_published_at"] = newest
+
+    if changes:
+        Subscription.objects.filter(pk=subscription.pk).update(**changes)
+
+
+def defer_imports(user_id, work):
+    """Defer an import_playlists task for each batch of `work`"""
+    batch_size = settings.IMPORT_TASK_BATCH_SIZE
+    for i in range(0, len(work), batch_size):
+        deferred.defer(import_playlists, user_id, work[i:i + batch_size])
+
+
+def import_first_pages(youtube, user_id, work):
+    """Import the first page of videos for several playlists at once
+
+    `work` is a list of `(subscription, bucket_ids, only_first_page)` tuples.
+    Rather than two API calls per subscription, all the playlist pages are
+    fetched in one batch and all the video data in another (or taken from the
+    playlist pages if IMPORT_VIDEOS_FROM_PLAYLIST is set).
+
+    Playlists that haven't changed since we last saw them (either by ETag or
+    by the video at the head of the playlist) are skipped. Only videos newer
+    than the subscription's watermark are fetched and playlists that need more
+    than their first page imported are handed off to import_playlists tasks.
+    Uploads playlists that the API accepts are cached for everyone, derived
+    ones that it doesn't know about are looked up on the channels endpoint.
+    """
+    if len(work) == 0:
+        return
+
+    requests = []
+    for subscription, bucket_ids, only_first_page in work:
+        request = playlist_items_request(youtube, subscription.upload_playlist)
+        if subscription.playlist_etag:
+            request.headers["If-None-Match"] = subscription.playlist_etag
+        requests.append(request)
+
+    playlist_results = batch_execute(youtube, requests)
+
+    later = []
+    pages = []
+    confirmed = {}
+    wrong_playlists = []
+    for item, (playlistitem_list, exception) in zip(work, playlist_results):
+        subscription, bucket_ids, only_first_page = item
+        watermark = subscription.last_video_published_at
+        if exception is None or is_not_modified(exception):
+            confirmed[subscription.channel_id] = subscription.upload_playlist
+
+        if is_not_modified(exception):
+            _log.debug("Playlist %s not modified", subscription.upload_playlist)
+        elif is_not_found(exception) and \
+                subscription.upload_playlist == derive_upload_playlist(subscription.channel_id):
+            wrong_playlists.append(item)
+        elif exception is not None:
+            if is_quota_error(exception):
+                quota_ledger.exhaust()
+            _log.warning("Could not fetch playlist %s in batch, deferring: %s", subscription.upload_playlist,
+                         exception)
+            later.append(ImportWork(subscription.pk, subscription.upload_playlist, bucket_ids, None,
+                                    only_first_page, watermark))
+        elif subscription.head_video_id and playlist_head(playlistitem_list) == subscription.head_video_id:
+            _log.debug("Playlist %s has no new videos", subscription.upload_playlist)
+            update_playlist_state(subscription, playlistitem_list, None)
+        else:
+            video_ids, reached_watermark = new_playlist_items(playlistitem_list, watermark)
+            pages.append((item, playlistitem_list, video_ids, reached_watermark))
+
+    # one cache lookup for all the pages
+    wanted = set(drop_missing_videos([video_id for page in pages for video_id in page[2]]))
+    pages = [(item, playlistitem_list, [video_id for video_id in video_ids if video_id in wanted], reached_watermark)
+             for item, playlistitem_list, video_ids, reached_watermark in pages]
+
+    if settings.IMPORT_VIDEOS_FROM_PLAYLIST:
+        video_results = iter([(playlist_videos(page[1], page[2]), None) for page in pages if page[2]])
+    else:
+        video_results = iter(batch_execute(youtube, [videos_request(youtube, page[2]) for page in pages if page[2]]))
+
+    for item, playlistitem_list, video_ids, reached_watermark in pages:
+        subscription, bucket_ids, only_first_page = item
+        watermark = subscription.last_video_published_at
+        if video_ids:
+            video_list, exception = next(video_results)
+        else:
+            video_list, exception = {'items': []}, None
+
+        if exception is not None:
+            if is_quota_error(exception):
+                quota_ledger.exhaust()
+            _log.warning("Could not fetch videos for playlist %s in batch, deferring: %s",
+                         subscription.upload_playlist, exception)
+            later.append(ImportWork(subscription.pk, subscription.upload_playlist, bucket_ids, None,
+                                    only_first_page, watermark))
+            continue
+
+        created, seen, newest = save_videos(user_id, subscription.pk, bucket_ids, video_ids, video_list)
+        update_playlist_state(subscription, playlistitem_list, newest)
+
+        if 'nextPageToken' in playlistitem_list and not (seen or reached_watermark or only_first_page):
+            later.append(ImportWork(subscription.pk, subscription.upload_playlist, bucket_ids,
+                                    playlistitem_list['nextPageToken'], False, watermark))
+
+    confirm_upload_playlists(confirmed)
+    later.extend(fix_upload_playlists(youtube, wrong_playlists))
+    defer_imports(user_id, later)
+
+
+def fix_upload_playlists(youtube, work):
+    """Ask the channels endpoint for playlists we derived incorrectly
+
+    Subscriptions are updated with the right playlist and their first page is
+    returned as `ImportWork` to be imported later
+    """
+    if not work:
+        return []
+
+    channel_ids = sorted(set(subscription.channel_id for subscription, _, _ in work))
+    playlists = fetch_upload_playlists(youtube, channel_ids)
+    confirm_upload_playlists(playlists)
+
+    later = []
+    for subscription, bucket_ids, only_first_page in work:
+        playlist = playlists.get(subscription.channel_id)
+        if playlist is None:
+            _log.warning("Could not find uploads playlist for channel %s", subscription.channel_id)
+            continue
+        elif playlist == subscription.upload_playlist:
+            # importing it again would just fail again
+            _log.warning("Uploads playlist %s for channel %s could not be found", playlist,
+                         subscription.channel_id)
+            continue
+
+        _log.info("Uploads playlist for channel %s is %s, not %s", subscription.channel_id, playlist,
+                  subscription.upload_playlist)
+        Subscription.objects.filter(pk=subscription.pk).update(upload_playlist=playlist)
+        later.append(ImportWork(subscription.pk, playlist, bucket_ids, None, only_first_page,
+                                subscription.last_video_published_at))
+
+    return later
+
+
+def import_page(youtube, user_id, work):
+    """Import one page of a playlist
+
+    Returns the `ImportWork` for the next page, or None if we've reached videos
+    we've seen, and the API units spent
+    """
+    playlistitem_list = playlist_items_request(youtube, work.playlist, work.page_token).execute()
+    units = API_COSTS["youtube.playlistItems.list"]
+    video_ids, reached_watermark = new_playlist_items(playlistitem_list, work.watermark)
+    video_ids = drop_missing_videos(video_ids)
+
+    if not video_ids:
+        video_list = {'items': []}
+    elif settings.IMPORT_VIDEOS_FROM_PLAYLIST:
+        video_list = playlist_videos(playlistitem_list, video_ids)
+    else:
+        video_list = videos_request(youtube, video_ids).execute()
+        units += API_COSTS["youtube.videos.list"]
+
+    created, seen, newest = save_videos(user_id, work.subscription_id, work.bucket_ids, video_ids, video_list)
+    if work.page_token is None:
+        subscription = Subscription.objects.filter(pk=work.subscription_id).first()
+        if subscription is not None:
+            update_playlist_state(subscription, playlistitem_list, newest)
+
+    if 'nextPageToken' in playlistitem_list and not (seen or reached_watermark or work.only_first_page):
+        return work._replace(page_token=playlistitem_list['nextPageToken']), units
+    return None, units
+
+
+def import_playlists(user_id, work):
+    """Import videos from several playlists in one task
+
+    `work` is a list of `ImportWork`. Playlists are imported one after the
+    other, each until we reach videos we've seen. If we run low on time, only
+    the playlists we've not finished are deferred to a new task. History pages
+    left once the task has spent its share of the quota wait for the next
+    sync, only running out of quota altogether waits for the reset.
+    """
+    started = time.time()
+    remaining = list(work)
+    over_share = []
+    out_of_quota = []
+    scheduler = QuotaScheduler(users=sync_user_count())
+    share = scheduler.user_share()
+    # only what this task spends, other tasks are charged to the same ledger
+    spent = 0
+    try:
+        youtube = get_service(user_id, False)
+    except OauthToken.DoesNotExist:
+        return
+
+    try:
+        while remaining:
+            if time.time() - started > IMPORT_TASK_TIME_LIMIT:
+                _log.info("Import for user %s out of time, %s playlists left", user_id, len(remaining))
+                deferred.defer(import_playlists, user_id, remaining)
+                remaining = []
+                break
+
+            item = remaining[0]
+            if scheduler.is_exhausted():
+                out_of_quota.extend(remaining)
+                remaining = []
+                break
+            elif not scheduler.should_import_page(item.page_token, spent, share):
+                over_share.append(remaining.pop(0))
+                continue
+
+            try:
+                next_item, units = import_page(youtube, user_id, item)
+                spent += units
+            except HttpError as exc:
+                if is_client_error(exc):
+                    # the playlist has gone or was never there, retrying won't help
+                    _log.warning("Could not import playlist %s, giving up: %s", item.playlist, exc)
+                    next_item = None
+                elif is_quota_error(exc) or len(work) == 1:
+                    raise
+                else:
+                    # don't let one broken playlist hold up the others, it can
+                    # fail and retry in its own task
+                    _log.warning("Could not import playlist %s, deferring: %s", item.playlist, exc)
+                    deferred.defer(import_playlists, user_id, [item])
+                    next_item = None
+
+            if next_item is None:
+                remaining.pop(0)
+            else:
+                remaining[0] = next_item
+    except RuntimeExceededError:
+        deferred.defer(import_playlists, user_id, remaining)
+    except HttpError as exc:
+        if not is_quota_error(exc):
+            raise
+        quota_ledger.exhaust()
+        out_of_quota.extend(remaining)
+
+    if over_share:
+        defer_until_next_sync(import_playlists, user_id, over_share)
+    if out_of_quota:
+        defer_until_quota_reset(import_playlists, user_id, out_of_quota)
+
+    log_stats()
+
+
+def import_videos(user_id, subscription_id, playlist, bucket_ids, page_token=None, only_first_page=False,
+                  watermark=None):
+    """Import videos from a playlist, stopping once we reach videos we've seen
+
+    `watermark` is the newest `published_at` we'd imported before this import
+    started. Kept for tasks queued before imports were batched up, new work
+    should use import_playlists.
+    """
     if page_token is not None and only_first_page:
         # initial import to show some videos, we don't need to do a full import of every video
         return
+
+    _log.info("Adding videos to buckets: %s", bucket_ids)
+    import_playlists(user_id, [ImportWork(subscription_id, playlist, bucket_ids, page_token, only_first_page,
+                                          watermark)])
+
+
+def refresh_titles(last_pk=None):
+    """Defer a refresh_user_titles task for each user
+
+    Titles are saved when things are first imported, this picks up any that
+    have been renamed since. Nothing is refreshed unless each user's share of
+    the quota is at least MIN_USER_SHARE.
+    """
     try:
-        _log.info("Adding videos to buckets: %s", bucket_ids)
-        try:
-            youtube = get_service(user_id)
-        except OauthToken.DoesNotExist:
+        qs = OauthToken.objects.order_by("pk").all()
+        if last_pk:
+            qs = qs.filter(pk__gt=last_pk)
+
+        if QuotaScheduler(users=sync_user_count()).user_share() < MIN_USER_SHARE:
+            _log.info("Not enough API quota to refresh titles")
             return
 
-        while True:
-            # TODO: consider
-            # https://developers.google.com/youtube/v3/docs/activities/list it
-            # has things like "publishedAfter" which could be a better way of
-            # working out what we have and have not imported
-            playlistitem_list = youtube.playlistItems().list(playlistId=playlist, part=PLAYLIST_PARTS,
-                                                             fields=PLAYLIST_FIELDS, pageToken=page_token,
-                                                             maxResults=API_MAX_RESULTS).execute()
-            ids_from_playlist = [item['contentDetails']['videoId'] for item in playlistitem_list['items']]
-
-            video_list = youtube.videos().list(id=','.join(ids_from_playlist), part=VIDEO_PARTS, fields=VIDEO_FIELDS,
-                                               maxResults=API_MAX_RESULTS).execute()
-            ids_from_video = [video['id'] for video in video_list['items']]
+        for obj in qs.iterator():
+            if obj.user.is_active:
+                deferred.defer(refresh_user_titles, obj.user_id)
+            last_pk = obj.pk
+    except RuntimeExceededError:
+        deferred.defer(refresh_titles, last_pk)
 
-            missing_videos = set(ids_from_playlist) - set(ids_from_video)
-            extra_videos = set(ids_from_video) - set(ids_from_playlist)
-            _log.info("Missing these IDs from the video list endpoint: %s", missing_videos)
-            _log.info("Extra IDs from the video list endpoint: %s", extra_videos)
 
-            seen_before = False
+def apply_titles(obj, titles, id_field, found=None, missing=None):
+    """Update `obj` from fetched `titles`, returns True if it needs saving"""
+    before = [getattr(obj, name, None) for name in TITLE_REFRESH_FIELDS]
+    youtube_id = getattr(obj, id_field)
+    if youtube_id in titles:
+        obj.title = titles[youtube_id]["title"]
+        obj.description = titles[youtube_id]["description"]
+        if found is not None:
+            found(obj)
+    elif missing is not None:
+        missing(obj)
 
-            for video in video_list['items']:
-                if video['id'] not in ids_from_playlist:
-                    continue
+    if obj.titles_updated is None or before != [getattr(obj, name, None) for name in TITLE_REFRESH_FIELDS]:
+        obj.titles_updated = timezone.now()
+        return True
+    return False
 
-                data = dict(
-                    subscription_id=subscription_id,
-                    user_id=user_id,
-                    published_at=parse_datetime(video['snippet']['publishedAt']),
-                    thumbnails={size: value.get('url', '') for size, value in video['snippet']['thumbnails'].items()},
-                    youtube_id=video['id'],
-                    buckets_ids=bucket_ids,
-                )
-                key = create_composite_key(str(user_id), video['id'])
-                obj, created = Video.objects.get_or_create(id=key, defaults=data)
-                _log.debug("Video %s%s created", obj.id, "" if created else " not")
-                if not created:
-                    # we've seen this video before, therefore we've already imported it
-                    seen_before = True
-
-            if 'nextPageToken' in playlistitem_list and not seen_before and not only_first_page:
-                page_token = playlistitem_list['nextPageToken']
-            else:
-                break
+
+def save_titles(youtube, objects, id_field, resource, parts, fields, found=None, missing=None):
+    """Fetch titles for `objects` and save the ones that have changed"""
+    if not objects:
+        return
+
+    youtube_ids = sorted(set(getattr(obj, id_field) for obj in objects))
+    titles = fetch_titles(youtube, resource, youtube_ids, parts, fields)
+    pks = [obj.pk for obj in objects if apply_titles(obj, titles, id_field, found, missing)]
+    model = type(objects[0])
+    for i in range(0, len(pks), XG_BATCH_SIZE):
+        # one transaction for each batch rather than each object
+        with transaction.atomic(xg=True):
+            for obj in model.objects.filter(pk__in=pks[i:i + XG_BATCH_SIZE]):
+                apply_titles(obj, titles, id_field, found, missing)
+                obj.save()
+
+
+def refresh_model_titles(youtube, user_id, name, qs, id_field, resource, parts, fields, period=TITLE_REFRESH_PERIOD,
+                         found=None, missing=None):
+    """Fetch titles for every object in `qs` once each `period`
+
+    Objects that have never had their titles fetched are done first. The rest
+    are done in pk order, with how far we've got kept in a TitleRefresh
+    called `name` rather than on each object, so only objects that have
+    changed are saved. Objects the API no longer knows about keep their old
+    titles and are passed to `missing` instead, the others are passed to
+    `found`.
+    """
+    new = list(qs.filter(titles_updated__isnull=True))
+    for i in range(0, len(new), TITLE_REFRESH_CHUNK_SIZE):
+        save_titles(youtube, new[i:i + TITLE_REFRESH_CHUNK_SIZE], id_field, resource, parts, fields, found, missing)
+    done = set(obj.pk for obj in new)
+
+    progress = TitleRefresh.objects.filter(pk=create_composite_key(str(user_id), name)).first()
+    if progress is None:
+        progress = TitleRefresh(user_id=user_id, name=name)
+
+    if not progress.last_pk:
+        now = timezone.now()
+        if progress.started is not None and progress.started > now - period:
+            return
+        progress.started = now
+
+    while True:
+        objects = qs.order_by("pk")
+        if progress.last_pk:
+            objects = objects.filter(pk__gt=progress.last_pk)
+        chunk = list(objects[:TITLE_REFRESH_CHUNK_SIZE])
+        save_titles(youtube, [obj for obj in chunk if obj.pk not in done], id_field, resource, parts, fields,
+                    found, missing)
+
+        if len(chunk) < TITLE_REFRESH_CHUNK_SIZE:
+            progress.last_pk = ""
+            progress.save()
+            return
+        progress.last_pk = chunk[-1].pk
+        progress.save()
+
+
+def video_found(video):
+    video.missed_refreshes = 0
+    video.tombstone = False
+
+
+def video_missing(video):
+    # it might only be private for a while
+    video.missed_refreshes += 1
+    if video.missed_refreshes >= TOMBSTONE_MISSES:
+        video.tombstone = True
+
+
+def refresh_user_titles(user_id):
+    """Refresh the titles of a user's subscriptions and videos
+
+    Also acts as a sweep for videos that have been deleted or made private,
+    those are marked as tombstones after TOMBSTONE_MISSES refreshes
+    """
+    try:
+        youtube = get_service(user_id, False)
+    except OauthToken.DoesNotExist:
+        return
+
+    try:
+        refresh_model_titles(youtube, user_id, "subscriptions", Subscription.objects.filter(user_id=user_id),
+                             "channel_id", youtube.channels(), CHANNEL_TITLE_PARTS, CHANNEL_TITLE_FIELDS)
+        videos = Video.objects.filter(user_id=user_id)
+        refresh_model_titles(youtube, user_id, "videos", videos.filter(tombstone=False), "youtube_id",
+                             youtube.videos(), VIDEO_TITLE_PARTS, VIDEO_TITLE_FIELDS, found=video_found,
+                             missing=video_missing)
+        # tombstones probably aren't coming back, so they're checked less often
+        refresh_model_titles(youtube, user_id, "tombstones", videos.filter(tombstone=True), "youtube_id",
+                             youtube.videos(), VIDEO_TITLE_PARTS, VIDEO_TITLE_FIELDS, period=TOMBSTONE_REFRESH_PERIOD,
+                             found=video_found, missing=video_missing)
+    except RuntimeExceededError:
+        deferred.defer(refresh_user_titles, user_id)
+    except HttpError as exc:
+        if not is_quota_error(exc):
+            raise
+        # titles can wait for the next refresh
+        quota_ledger.exhaust()
+
+
+def backfill_titles(model_name="Subscription", last_pk=None):
+    """Save every Subscription and then every Video again
+
+    Entities saved before title, description, titles_updated and tombstone
+    were added don't have those properties, and the datastore doesn't match
+    missing properties in any filter. Once they've been saved,
+    refresh_titles can find them.
+    """
+    models = [Subscription, Video]
+    model = next(model for model in models if model.__name__ == model_name)
+
+    def resave(pks):
+        with transaction.atomic(xg=True):
+            for obj in model.objects.filter(pk__in=pks):
+                obj.save()
+
+    try:
+        qs = model.objects.order_by("pk")
+        if last_pk:
+            qs = qs.filter(pk__gt=last_pk)
+
+        pks = []
+        for pk in qs.values_list("pk", flat=True).iterator():
+            pks.append(pk)
+            if len(pks) == XG_BATCH_SIZE:
+                resave(pks)
+                last_pk = pks[-1]
+                pks = []
+        if pks:
+            resave(pks)
     except RuntimeExceededError:
-        deferred.defer(import_videos, user_id, subscription_id, playlist, bucket_ids,
-                       page_token=page_token, only_first_page=only_first_page)
+        deferred.defer(backfill_titles, model_name, last_pk)
+        return
+
+    if model is not models[-1]:
+        deferred.defer(backfill_titles, models[models.index(model) + 1].__name__)
+    else:
+        deferred.defer(refresh_titles)
 
 
 def get_site_config():
-    config = cache.get(SITE_CONFIG_CACHE_KEY)
+    config = tiered_cache.get(SITE_CONFIG_CACHE_KEY)
     if config is None:
         config, _ = SiteConfig.objects.get_or_create(id=SITE_CONFIG_ID)
-        cache.set(SITE_CONFIG_CACHE_KEY, config)
+        tiered_cache.set(SITE_CONFIG_CACHE_KEY, config)
 
     return config
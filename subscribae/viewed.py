@@ -0,0 +1,170 @@
+##
+#    Copyright (C) 2019  Matt Molyneaux <moggers87+git@moggers87.co.uk>
+#
+#    This file is part of Subscribae.
+#
+#    Subscribae is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Subscribae is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with Subscribae.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from collections import OrderedDict
+from datetime import timedelta
+import json
+import logging
+import time
+
+from djangae.db import transaction
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext.deferred import deferred
+
+from subscribae.generations import BUCKET, SUBSCRIPTION
+from subscribae.models import Bucket, Subscription, Video
+
+# viewed events wait in a pull queue until apply_viewed_events gets to them
+VIEWED_QUEUE = "viewed"
+# how often apply_viewed_events runs while people are watching things
+VIEWED_AGGREGATE_DELAY = 30
+# as long as a push task can run, so events can't be leased again while the
+# run that has them might still be applying them
+VIEWED_LEASE_SECONDS = 10 * 60
+# tasks leased by each run of apply_viewed_events, lease_tasks can't do more
+# than 1000
+VIEWED_EVENT_BATCH_SIZE = 500
+
+# XG transactions can touch 25 entity groups, one of which is the bucket or
+# subscription
+VIEWED_BATCH_SIZE = 24
+
+# last_watched_video for buckets and subscriptions that have events waiting
+PENDING_VIEWED_CACHE_PREFIX = "viewed-pending"
+PENDING_VIEWED_CACHE_TIMEOUT = timedelta(days=1).total_seconds()
+
+MODELS = {
+    BUCKET: Bucket,
+    SUBSCRIPTION: Subscription,
+}
+
+_log = logging.getLogger(__name__)
+
+
+def pending_viewed_key(kind, id):
+    return "{}-{}-{}".format(PENDING_VIEWED_CACHE_PREFIX, kind, id)
+
+
+def apply_viewed(kind, obj_id, keys, last_watched_video):
+    """Mark the videos in `keys` as viewed and move the bucket or subscription on
+
+    Each batch of videos is written in a single transaction and
+    last_watched_video is saved along with the last batch.
+    """
+    model = MODELS[kind]
+    batches = [keys[i:i + VIEWED_BATCH_SIZE] for i in range(0, len(keys), VIEWED_BATCH_SIZE)]
+    for batch in batches:
+        with transaction.atomic(xg=True):
+            if batch is batches[-1]:
+                obj = model.objects.get(id=obj_id)
+                obj.last_watched_video = last_watched_video
+                obj.save()
+
+            for vid in Video.objects.filter(pk__in=batch):
+                if not vid.viewed:
+                    vid.viewed = True
+                    vid.save()
+
+
+def record_viewed(kind, obj_id, keys, last_watched_video):
+    """Leave the videos in `keys` to be marked as viewed by apply_viewed_events
+
+    Until then, merge_pending_viewed will give the bucket or subscription the
+    new last_watched_video.
+    """
+    payload = json.dumps({"kind": kind, "id": obj_id, "keys": keys, "last": last_watched_video})
+    taskqueue.Queue(VIEWED_QUEUE).add(taskqueue.Task(payload=payload, method="PULL"))
+    memcache.set(pending_viewed_key(kind, obj_id), last_watched_video, time=PENDING_VIEWED_CACHE_TIMEOUT)
+
+    schedule_viewed_events()
+
+
+def schedule_viewed_events():
+    # one task for every VIEWED_AGGREGATE_DELAY seconds, however many events
+    # there are
+    name = "apply-viewed-events-{}".format(int(time.time() // VIEWED_AGGREGATE_DELAY))
+    try:
+        deferred.defer(apply_viewed_events, _name=name, _countdown=VIEWED_AGGREGATE_DELAY)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def apply_viewed_events():
+    """Apply events left by record_viewed
+
+    Events are grouped by bucket and subscription, so each one is written once
+    per run no matter how many videos were watched. If applying them fails,
+    the events that are left are tried again once their lease is up.
+    """
+    queue = taskqueue.Queue(VIEWED_QUEUE)
+    tasks = queue.lease_tasks(VIEWED_LEASE_SECONDS, VIEWED_EVENT_BATCH_SIZE)
+    if not tasks:
+        return
+
+    pending = OrderedDict()
+    for task in sorted(tasks, key=lambda task: task.eta_posix):
+        event = json.loads(task.payload)
+        obj_key = (event["kind"], event["id"])
+        keys, _, obj_tasks = pending[obj_key] if obj_key in pending else ([], None, [])
+        keys.extend(key for key in event["keys"] if key not in keys)
+        obj_tasks.append(task)
+        # later events win, like they would have without the queue
+        pending[obj_key] = (keys, event["last"], obj_tasks)
+
+    client = memcache.Client()
+    done = []
+    try:
+        for (kind, obj_id), (keys, last, obj_tasks) in pending.items():
+            try:
+                apply_viewed(kind, obj_id, keys, last)
+            except MODELS[kind].DoesNotExist:
+                _log.info("%s %s has gone away, dropping its viewed events", kind, obj_id)
+            done.extend(obj_tasks)
+
+            # leave it alone if there's been another event since we leased
+            # ours, cas fails if record_viewed has set it since gets. memcache
+            # can't delete conditionally, so it's swapped for a None that
+            # soon expires
+            key = pending_viewed_key(kind, obj_id)
+            if client.gets(key) == last:
+                client.cas(key, None, time=1)
+    except Exception:
+        # nothing else can lease the rest until then
+        deferred.defer(apply_viewed_events, _countdown=VIEWED_LEASE_SECONDS)
+        raise
+    finally:
+        if done:
+            queue.delete_tasks(done)
+
+    if len(tasks) == VIEWED_EVENT_BATCH_SIZE:
+        # there could be more
+        deferred.defer(apply_viewed_events)
+
+
+def merge_pending_viewed(kind, objs):
+    """Give buckets or subscriptions the last_watched_video from events that are still waiting
+
+    Only changes the objects in memory, they are not saved.
+    """
+    keys = {pending_viewed_key(kind, obj.pk): obj for obj in objs}
+    for key, last_watched_video in memcache.get_multi(keys.keys()).items():
+        if last_watched_video is not None:
+            keys[key].last_watched_video = last_watched_video
+
+    return objs
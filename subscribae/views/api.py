@@ -17,30 +17,79 @@
 #    along with Subscribae.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
-from djangae.db import transaction
+import hashlib
+import logging
+
+from djangae.db.utils import get_cursor, set_cursor
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.core import signing
+from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
 from django.http import Http404, JsonResponse
-from django.shortcuts import get_object_or_404
-from django.views.decorators.http import require_http_methods
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition, require_http_methods
+from google.appengine.api import datastore_errors
 
 from subscribae.decorators import active_user
-from subscribae.models import Bucket, Subscription, Video, create_composite_key
+from subscribae.generations import BUCKET, SUBSCRIPTION, get_generation
+from subscribae.models import Video, create_composite_key, pick_thumbnail, prefetch_html_snippets
+from subscribae.viewed import apply_viewed, record_viewed
 
 API_PAGE_SIZE = 10
 
+CURSOR_SALT = "subscribae.views.api.cursor"
+# the datastore doesn't like the cursor, perhaps the query or its indexes
+# have changed since it was made
+CURSOR_ERRORS = (datastore_errors.BadArgumentError, datastore_errors.BadRequestError,
+                 datastore_errors.BadValueError)
+PAGE_FILTERS = ["before", "after", "start", "end"]
+
+_log = logging.getLogger(__name__)
+
 VIDEO_API_MAP = {
     "id": "youtube_id",
     "title": "title",
     "description": "description",
     "published": "published_at",
     "html_snippet": "html_snippet",
+    "thumbnail": "thumbnail",
     "ordering_key": "ordering_key",
 }
 
+# without html_snippet, clients build their own markup from the other fields
+VIDEO_JSON_API_MAP = {k: v for k, v in VIDEO_API_MAP.items() if k != "html_snippet"}
+
+
+class VideoRow(object):
+    """Just the fields of a Video that VIDEO_JSON_API_MAP needs
+
+    Much lighter than a Video, which computes its keys and builds its related
+    sets when it's created
+    """
+    __slots__ = ["youtube_id", "title", "description", "published_at", "thumbnails", "ordering_key"]
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @property
+    def thumbnail(self):
+        return pick_thumbnail(self.thumbnails)
 
-def queryset_to_json(qs, ordering, property_map=None, before=None, after=None, start=None, end=None):
+
+def queryset_to_json(qs, ordering, property_map=None, before=None, after=None, start=None, end=None,
+                     prefetch=None, row_class=None, cursor=None, limit=None):
     """Turn a queryset into a JSON object that can easily serialised into JSON
+
+    `prefetch` is called with the list of objects before any properties are
+    read from them. If `row_class` is given, only the fields in its
+    `__slots__` are fetched and it's used instead of model instances.
+    `limit` is the size of the page, API_PAGE_SIZE by default.
+
+    Forward pages (i.e. not `before` or `end`) can resume from a datastore
+    `cursor` and return the cursor for the next page, which must be used with
+    the same arguments.
     """
     qs = qs.order_by(ordering)
     if ordering.startswith("-"):
@@ -53,6 +102,13 @@ def queryset_to_json(qs, ordering, property_map=None, before=None, after=None, s
     if unique_kwargs.count(None) < (len(unique_kwargs) - 1):  # a maximum of 1 item may be not None
         raise TypeError("queryset_to_json may only take one of: before, after, start, end")
 
+    if limit is None:
+        limit = API_PAGE_SIZE
+
+    forward = before is None and end is None
+    if cursor is not None and not forward:
+        raise TypeError("queryset_to_json can't take a cursor with before or end")
+
     if before is not None:
         qs = qs.filter(**{"{}__lt".format(ordering): before}).reverse()
     elif after is not None:
@@ -62,12 +118,22 @@ def queryset_to_json(qs, ordering, property_map=None, before=None, after=None, s
     elif end is not None:
         qs = qs.filter(**{"{}__lte".format(ordering): end}).reverse()
 
-    qs = qs[:API_PAGE_SIZE]
-    qs = qs.add_titles()
+    if row_class is not None:
+        qs = qs.values_list(*row_class.__slots__)
+    if cursor is not None:
+        qs = set_cursor(qs, start=cursor)
+
+    page = qs[:limit]
+    if row_class is not None:
+        objs = [row_class(*values) for values in page]
+    else:
+        objs = list(page)
+    if prefetch is not None:
+        prefetch(objs)
 
     items = []
     item_orderings = []
-    for obj in qs:
+    for obj in objs:
         items.append({k: getattr(obj, v) for k, v in property_map.items()})
         item_orderings.append(getattr(obj, ordering))
 
@@ -78,12 +144,180 @@ def queryset_to_json(qs, ordering, property_map=None, before=None, after=None, s
         first = None
         last = None
 
-    return (items, first, last)
+    next_cursor = get_cursor(page) if forward else None
+
+    return (items, first, last, next_cursor)
+
+
+def cursor_salt(request):
+    # cursors only work for the query they came from
+    return "{}:{}:{}".format(CURSOR_SALT, request.user.pk, request.path)
+
+
+def sign_cursor(request, page_filter, value, cursor, last):
+    """Make an opaque cursor for the `next` link of the video APIs
+
+    As well as the datastore cursor, it has the filter the page was made with
+    and the last ordering key on the page for when the datastore cursor is no
+    good any more.
+    """
+    return signing.dumps({"filter": page_filter, "value": value, "cursor": cursor, "last": last},
+                         salt=cursor_salt(request), compress=True)
+
+
+def page_limit(request):
+    """Size of the page the client has asked for with `limit`
+
+    Clamped to the user's maximum page size
+    """
+    limit = request.GET.get("limit")
+    if limit is None:
+        limit = API_PAGE_SIZE
+    else:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise Http404
+
+    return max(1, min(limit, request.user.max_page_size))
+
+
+def fetch_video_page(request, qs, url, page_filter, value, cursor=None, last=None):
+    """Fetch a page of videos, falling back to the ordering key if `cursor` is no good
+
+    Returns the data for the page and the arguments to fetch the page after it
+    """
+    options = video_api_options()
+    options["limit"] = page_limit(request)
+    if page_filter is not None:
+        options[page_filter] = value
+    try:
+        videos, first, last, next_cursor = queryset_to_json(qs, "ordering_key", cursor=cursor, **options)
+    except CURSOR_ERRORS as exc:
+        if cursor is None:
+            raise
+        _log.info("Cursor no good, falling back to ordering key: %s", exc)
+        options.pop(page_filter, None)
+        page_filter, value = "after", last
+        options[page_filter] = value
+        videos, first, last, next_cursor = queryset_to_json(qs, "ordering_key", **options)
+
+    data = {"videos": videos}
+    following = None
+
+    if len(videos) > 0:
+        if next_cursor is not None:
+            data["next"] = "{}?cursor={}".format(url, sign_cursor(request, page_filter, value, next_cursor, last))
+            following = (page_filter, value, next_cursor, last)
+        else:
+            data["next"] = "{}?after={}".format(url, last)
+            # pages fetched with before or end carry on in the same direction
+            following = ("before", last) if page_filter in ("before", "end") else ("after", last)
+
+    return data, following
+
+
+def video_page(request, qs, url):
+    """Data for a page of videos from `qs`
+
+    Pages are chosen either by one of PAGE_FILTERS or by a cursor from the
+    previous page's `next` link. With `include_next`, the page after this one
+    is included as `next_page` to save the client a request.
+    """
+    page_filter = next((name for name in PAGE_FILTERS if request.GET.get(name) is not None), None)
+    value = request.GET.get(page_filter)
+    cursor = None
+    last = None
+
+    if request.GET.get("cursor") is not None:
+        try:
+            data = signing.loads(request.GET["cursor"], salt=cursor_salt(request))
+        except signing.BadSignature:
+            raise Http404
+        page_filter, value, cursor, last = data["filter"], data["value"], data["cursor"], data["last"]
+
+    data, following = fetch_video_page(request, qs, url, page_filter, value, cursor, last)
+    if request.GET.get("include_next") and following is not None:
+        data["next_page"], _ = fetch_video_page(request, qs, url, *following)
+
+    return data
+
+
+def mark_viewed(request, kind, obj_id, qs):
+    """Mark the videos POSTed as `id` as viewed
+
+    Takes one or more ids, last_watched_video on the bucket or subscription is
+    moved to the furthest of them, up to the user's max_page_size at a time.
+    With VIEWED_WRITE_BEHIND, the writes are left for apply_viewed_events.
+    """
+    youtube_ids = request.POST.getlist("id")
+    if len(youtube_ids) > request.user.max_page_size:
+        raise Http404
+
+    keys = []
+    for youtube_id in youtube_ids:
+        key = create_composite_key(str(request.user.pk), youtube_id)
+        if key not in keys:
+            keys.append(key)
+
+    if len(keys) == 0:
+        raise Http404
+
+    ordering_keys = dict(qs.filter(pk__in=keys).values_list("pk", "ordering_key"))
+    if len(ordering_keys) != len(keys):
+        raise Http404
+    last_watched_video = max(ordering_keys.values())
+
+    if settings.VIEWED_WRITE_BEHIND:
+        record_viewed(kind, obj_id, keys, last_watched_video)
+    else:
+        try:
+            apply_viewed(kind, obj_id, keys, last_watched_video)
+        except ObjectDoesNotExist:
+            raise Http404
+
+
+def video_api_options():
+    """Keyword arguments to queryset_to_json for the video APIs
+
+    html_snippet needs whole Video objects, otherwise rows will do
+    """
+    if settings.API_HTML_SNIPPETS:
+        return {"property_map": VIDEO_API_MAP, "prefetch": prefetch_html_snippets}
+    else:
+        return {"property_map": VIDEO_JSON_API_MAP, "row_class": VideoRow}
+
+
+def video_api_etag(request, kind, id):
+    """ETag for a page of videos from a bucket or subscription
+
+    Only needs the generation from the cache, so clients that already have the
+    page don't cost us a datastore query
+    """
+    parts = [get_generation(kind, id), str(request.user.pk), request.get_full_path(), str(settings.API_HTML_SNIPPETS),
+             str(page_limit(request))]
+    return hashlib.md5("|".join(parts)).hexdigest()
+
+
+def bucket_video_etag(request, bucket):
+    return video_api_etag(request, BUCKET, bucket)
+
+
+def subscription_video_etag(request, subscription):
+    return video_api_etag(request, SUBSCRIPTION, subscription)
+
+
+def video_api_response(data):
+    response = JsonResponse(data)
+    # make browsers check the ETag every time
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
 @login_required
 @active_user
 @require_http_methods(("GET",))
+@condition(etag_func=bucket_video_etag)
 def bucket_video(request, bucket):
     """Video API for buckets
 
@@ -95,21 +329,9 @@ def bucket_video(request, bucket):
         raise Http404
 
     qs = Video.objects.from_bucket(user=request.user, bucket=bucket_id)
+    data = video_page(request, qs, reverse("bucket-video-api", kwargs={"bucket": bucket_id}))
 
-    videos, first, last = queryset_to_json(qs, "ordering_key", VIDEO_API_MAP,
-                                           before=request.GET.get("before"),
-                                           after=request.GET.get("after"),
-                                           start=request.GET.get("start"),
-                                           end=request.GET.get("end"),
-                                           )
-
-    data = {"videos": videos}
-
-    if len(videos) > 0:
-        next_url = "{}?after={}".format(reverse("bucket-video-api", kwargs={"bucket": bucket_id}), last)
-        data["next"] = next_url
-
-    return JsonResponse(data)
+    return video_api_response(data)
 
 
 @login_required
@@ -121,62 +343,29 @@ def bucket_video_viewed(request, bucket):
     except ValueError:
         raise Http404
 
-    try:
-        key = create_composite_key(str(request.user.pk), request.POST["id"])
-    except KeyError:
-        raise Http404
-
-    with transaction.atomic(xg=True):
-        bucket_obj = get_object_or_404(Bucket, id=bucket_id)
-        vid = get_object_or_404(Video.objects.from_bucket(user=request.user, bucket=bucket_id), id=key)
-
-        bucket_obj.last_watched_video = vid.ordering_key
-        bucket_obj.save()
+    qs = Video.objects.from_bucket(user=request.user, bucket=bucket_id)
+    mark_viewed(request, BUCKET, bucket_id, qs)
 
-        vid.viewed = True
-        vid.save()
     return JsonResponse({})
 
 
 @login_required
 @active_user
 @require_http_methods(("GET",))
+@condition(etag_func=subscription_video_etag)
 def subscription_video(request, subscription):
     """Video API for subscriptions"""
     qs = Video.objects.from_subscription(user=request.user, subscription=subscription)
+    data = video_page(request, qs, reverse("subscription-video-api", kwargs={"subscription": subscription}))
 
-    videos, first, last = queryset_to_json(qs, "ordering_key", VIDEO_API_MAP,
-                                           before=request.GET.get("before"),
-                                           after=request.GET.get("after"),
-                                           start=request.GET.get("start"),
-                                           end=request.GET.get("end"),
-                                           )
-
-    data = {"videos": videos}
-
-    if len(videos) > 0:
-        next_url = "{}?after={}".format(reverse("subscription-video-api", kwargs={"subscription": subscription}), last)
-        data["next"] = next_url
-
-    return JsonResponse(data)
+    return video_api_response(data)
 
 
 @login_required
 @active_user
 @require_http_methods(("POST",))
 def subscription_video_viewed(request, subscription):
-    try:
-        key = create_composite_key(str(request.user.pk), request.POST["id"])
-    except KeyError:
-        raise Http404
-
-    with transaction.atomic(xg=True):
-        subscription_obj = get_object_or_404(Subscription, id=subscription)
-        vid = get_object_or_404(Video.objects.from_subscription(user=request.user, subscription=subscription), id=key)
-
-        subscription_obj.last_watched_video = vid.ordering_key
-        subscription_obj.save()
+    qs = Video.objects.from_subscription(user=request.user, subscription=subscription)
+    mark_viewed(request, SUBSCRIPTION, subscription, qs)
 
-        vid.viewed = True
-        vid.save()
     return JsonResponse({})
@@ -32,8 +32,10 @@ from google.appengine.ext.deferred import deferred
 
 from subscribae.decorators import active_user
 from subscribae.forms import BucketEditForm, BucketForm
+from subscribae.generations import BUCKET, SUBSCRIPTION
 from subscribae.models import Bucket, OauthToken, Subscription
 from subscribae.utils import subscriptions
+from subscribae.viewed import merge_pending_viewed
 
 
 def home(request):
@@ -44,8 +46,8 @@ def home(request):
 @active_user
 def overview(request):
     context = {
-        'subscription_list': request.user.subscription_set.all().add_titles(),
-        'bucket_list': request.user.bucket_set.all(),
+        'subscription_list': request.user.subscription_set.all(),
+        'bucket_list': merge_pending_viewed(BUCKET, list(request.user.bucket_set.all())),
         'form': BucketForm(user=request.user),
     }
     return TemplateResponse(request, 'subscribae/overview.html', context)
@@ -55,6 +57,7 @@ def overview(request):
 @active_user
 def bucket(request, bucket):
     bucket = get_object_or_404(Bucket, pk=bucket, user=request.user)
+    merge_pending_viewed(BUCKET, [bucket])
     video_start_from = request.GET.get("start")
     context = {
         'bucket': bucket,
@@ -95,9 +98,10 @@ def bucket_edit(request, bucket):
 @active_user
 def subscription(request, subscription):
     subscription = get_object_or_404(Subscription, pk=subscription, user=request.user)
+    merge_pending_viewed(SUBSCRIPTION, [subscription])
     buckets = Bucket.objects.filter(subs__contains=subscription)
     context = {
-        'subscription': subscription.add_titles(),
+        'subscription': subscription,
         'buckets': buckets,
     }
     return TemplateResponse(request, 'subscribae/subscription.html', context)
@@ -21,10 +21,23 @@ from djangae.environment import task_or_admin_only
 from django.http import HttpResponse
 from google.appengine.ext.deferred import deferred
 
-from subscribae.utils import update_subscriptions
+from subscribae.utils import backfill_titles, refresh_titles, update_subscriptions
 
 
 @task_or_admin_only
 def update_subscriptions_cron(request):
     deferred.defer(update_subscriptions)
     return HttpResponse("Update started")
+
+
+@task_or_admin_only
+def refresh_titles_cron(request):
+    deferred.defer(refresh_titles)
+    return HttpResponse("Refresh started")
+
+
+@task_or_admin_only
+def backfill_titles_task(request):
+    """One-off, for subscriptions and videos saved before they had titles"""
+    deferred.defer(backfill_titles)
+    return HttpResponse("Backfill started")